@@ -0,0 +1,331 @@
+import argparse
+import os
+import resource
+import time
+import numpy as np
+
+from retrieve.retriever import load_images, dominant_colors, COLOR_MODES, \
+    extract_features, build_model, query_model, retrieve_batch
+from retrieve.image_store import ImageStore
+from retrieve.atlas import TileAtlas
+from retrieve.ann import IVFPQIndex
+from retrieve.assignment import assign_tiles, greedy_assignment, assignment_cost
+from retrieve.index_file import save_index, load_index
+
+
+def rss_mb():
+    # Current resident set size, falling back to the peak where /proc is missing
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def bench_dominant_color(args):
+    # Indexing throughput of the dominant-color extractor per mode
+    images = load_images(args.dataset).paths
+    for mode in args.modes:
+        for workers in args.workers:
+            start = time.perf_counter()
+            dominant_colors(images, mode=mode, workers=workers)
+            elapsed = time.perf_counter() - start
+            print("{:>10s} workers={:<3d} {:8.1f} images/s".format(
+                mode, workers, len(images) / elapsed))
+
+
+def bench_retrieval(args):
+    # Per-tile query_model calls against one retrieve_batch call for a whole mosaic
+    images = load_images(args.dataset)
+    features = extract_features(images)
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 256, (args.tiles, 3))
+    sizes = rng.integers(8, 32, (args.tiles, 2))
+    for algorithm in args.algorithms:
+        model = build_model(features, algorithm=algorithm)
+        size_weight = 0 if algorithm == 'plain' else 0.1
+        start = time.perf_counter()
+        for color, size in zip(colors, sizes):
+            query_model(model, images, color, size, algorithm=algorithm, size_weight=size_weight)
+        per_tile = time.perf_counter() - start
+        start = time.perf_counter()
+        retrieve_batch(colors, sizes, model, algorithm=algorithm)
+        batch = time.perf_counter() - start
+        print("{:>10s} {} tiles: per-tile {:8.1f} ms, batch {:8.1f} ms".format(
+            algorithm, args.tiles, per_tile * 1e3, batch * 1e3))
+
+
+def bench_image_store(args):
+    # Library load time and resident memory of the lazy store against eager handles
+    paths = ImageStore.from_folder(args.dataset).paths
+    paths = (paths * (args.images // len(paths) + 1))[:args.images]
+    before = rss_mb()
+    start = time.perf_counter()
+    store = ImageStore(paths, cache_bytes=args.cache_mb << 20)
+    store.sizes()
+    print("lazy  {} images: load {:8.2f} s, +{:7.1f} MB RSS".format(
+        len(store), time.perf_counter() - start, rss_mb() - before))
+    start = time.perf_counter()
+    for index in range(min(len(store), args.touch)):
+        store.array(index)
+    print("lazy  touched {} images: {:8.2f} s, +{:7.1f} MB RSS (cache bound {} MB)".format(
+        min(len(store), args.touch), time.perf_counter() - start, rss_mb() - before, args.cache_mb))
+
+    # Eager handles are limited by the file descriptor limit, so only the real folder
+    before = rss_mb()
+    start = time.perf_counter()
+    images = load_images(args.dataset, lazy=False)
+    for img in images:
+        img["image"].load()
+    print("eager {} images: load+decode {:8.2f} s, +{:7.1f} MB RSS".format(
+        len(images), time.perf_counter() - start, rss_mb() - before))
+
+
+def bench_atlas(args):
+    # Per-tile decode + resize cost from full resolution against the mipmap atlas
+    import cv2
+    images = load_images(args.dataset)
+    atlas = TileAtlas(args.atlas, expected_paths=images.paths)
+    rng = np.random.default_rng(0)
+    indices = rng.integers(0, len(images), args.tiles)
+    sizes = rng.integers(12, 20, (args.tiles, 2))
+    start = time.perf_counter()
+    for index, size in zip(indices, sizes):
+        cv2.resize(np.asarray(images[index]["image"]), tuple(int(x) for x in size))
+    full = time.perf_counter() - start
+    start = time.perf_counter()
+    for index, size in zip(indices, sizes):
+        atlas.get(index, size)
+    mipmap = time.perf_counter() - start
+    print("{} tiles: full resolution {:8.2f} us/tile, atlas {:8.2f} us/tile".format(
+        args.tiles, full / args.tiles * 1e6, mipmap / args.tiles * 1e6))
+
+
+def bench_ann(args):
+    # recall@1 of the IVF-PQ index against the exact KDTree, and queries per second
+    from sklearn.neighbors import KDTree
+    rng = np.random.default_rng(0)
+    library = rng.uniform(0, 255, (args.entries, args.dim))
+    queries = rng.uniform(0, 255, (args.queries, args.dim))
+
+    start = time.perf_counter()
+    tree = KDTree(library)
+    print("kdtree build {:8.2f} s".format(time.perf_counter() - start))
+    start = time.perf_counter()
+    _, exact = tree.query(queries, k=1)
+    print("kdtree {:>14s} {:10.0f} queries/s".format("", len(queries) / (time.perf_counter() - start)))
+
+    start = time.perf_counter()
+    index = IVFPQIndex().fit(library)
+    print("ivfpq  build {:8.2f} s".format(time.perf_counter() - start))
+    for nprobe in args.nprobe:
+        index.nprobe = nprobe
+        start = time.perf_counter()
+        found = index.query(queries, k=1, return_distance=False)
+        elapsed = time.perf_counter() - start
+        print("ivfpq  nprobe={:<4d} {:10.0f} queries/s, recall@1 {:.4f}".format(
+            nprobe, len(queries) / elapsed, np.mean(found[:, 0] == exact[:, 0])))
+
+
+def bench_assignment(args):
+    # Greedy nearest image against the repeat-aware sparse assignment, on a gradient
+    # mosaic with flat regions where the greedy choice repeats the same images
+    from sklearn.neighbors import KDTree
+    rng = np.random.default_rng(0)
+    features = np.hstack([rng.uniform(0, 255, (args.entries, 3)), np.full((args.entries, 2), 16.0)])
+    side = int(np.sqrt(args.tiles))
+    yy, xx = np.mgrid[0:side, 0:side] / side
+    colors = np.stack([255 * xx, 255 * yy, np.full_like(xx, 128)], axis=-1).reshape(-1, 3)
+    colors = np.round(colors / 32) * 32 + rng.normal(0, 2, colors.shape)
+
+    tree = KDTree(features[:, :3])
+    start = time.perf_counter()
+    distances, indices = tree.query(colors, k=args.candidates)
+    print("top-{} retrieval of {} tiles: {:.2f} s".format(args.candidates, len(colors), time.perf_counter() - start))
+    error, reuse = assignment_cost(greedy_assignment(indices), colors, features)
+    print("greedy                     color error {:12.1f}, max reuse {}".format(error, reuse))
+    for max_repeats in args.max_repeats:
+        start = time.perf_counter()
+        assigned = assign_tiles(indices, distances, max_repeats=max_repeats)
+        elapsed = time.perf_counter() - start
+        error, reuse = assignment_cost(assigned, colors, features)
+        print("max_repeats={:<3d} {:6.2f} s  color error {:12.1f}, max reuse {}".format(
+            max_repeats, elapsed, error, reuse))
+
+
+def bench_index(args):
+    # Cold load of a pickled model against the memory-mapped index folder, plus a first query
+    import pickle
+    import tempfile
+    rng = np.random.default_rng(0)
+    features = np.hstack([rng.uniform(0, 255, (args.entries, 3)), rng.integers(100, 400, (args.entries, 2))])
+    queries = np.hstack([rng.uniform(0, 255, (args.queries, 3)), rng.integers(100, 400, (args.queries, 2)) * 0.1])
+    with tempfile.TemporaryDirectory() as tmp:
+        for algorithm in args.algorithms:
+            model = build_model(features, algorithm=algorithm)
+            with open(os.path.join(tmp, "model.pkl"), "wb") as f:
+                pickle.dump(model, f)
+            save_index(model, os.path.join(tmp, "model.idx"), features)
+            del model
+
+            start = time.perf_counter()
+            with open(os.path.join(tmp, "model.pkl"), "rb") as f:
+                model = pickle.load(f)
+            loaded = time.perf_counter() - start
+            retrieve_batch(queries[:, :3], queries[:, 3:] / 0.1, model, algorithm=algorithm)
+            print("{:>10s} pickle {:8.1f} ms load, {:8.1f} ms load + first query".format(
+                algorithm, loaded * 1e3, (time.perf_counter() - start) * 1e3))
+            del model
+
+            start = time.perf_counter()
+            model, _ = load_index(os.path.join(tmp, "model.idx"))
+            loaded = time.perf_counter() - start
+            retrieve_batch(queries[:, :3], queries[:, 3:] / 0.1, model, algorithm=algorithm)
+            print("{:>10s} mmap   {:8.1f} ms load, {:8.1f} ms load + first query".format(
+                algorithm, loaded * 1e3, (time.perf_counter() - start) * 1e3))
+            del model
+
+
+def bench_daemon(args):
+    # Per-mosaic retrieve + tile fetch: a fresh in-process library against a warm daemon
+    import tempfile
+    import threading
+    import cv2
+    from retrieve.index_file import open_library
+    from retrieve.daemon import TileSource, RetrievalServer, RetrievalClient
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 256, (args.tiles, 3))
+    sizes = rng.integers(12, 20, (args.tiles, 2))
+    with tempfile.TemporaryDirectory() as tmp:
+        index_dir = os.path.join(tmp, "model.idx")
+        open_library(index_dir, args.dataset)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            model, images = open_library(index_dir, args.dataset)
+            indices, _ = retrieve_batch(colors, sizes, model)
+            for index, size in zip(indices[:, 0], sizes):
+                cv2.resize(images.array(index), tuple(int(x) for x in size))
+        print("in-process {} tiles: {:8.1f} ms per mosaic".format(
+            args.tiles, (time.perf_counter() - start) / args.repeat * 1e3))
+
+        socket_path = os.path.join(tmp, "daemon.sock")
+        server = RetrievalServer(socket_path, TileSource(model, images))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = RetrievalClient(socket_path)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            indices, _ = retrieve_batch(colors, sizes, client)
+            client.clear()
+            client.prefetch(indices[:, 0], sizes)
+        print("daemon     {} tiles: {:8.1f} ms per mosaic".format(
+            args.tiles, (time.perf_counter() - start) / args.repeat * 1e3))
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def bench_composite(args):
+    # Compositing time of a mosaic of random rotated tiles on a square canvas, serially and
+    # in parallel bands against the number of cores
+    import torch
+    from concurrent.futures import ThreadPoolExecutor
+    from replaceTile import Tile, TilePlacement, replace_tile_image, draw_bands
+    rng = np.random.default_rng(0)
+    tiles, images = [], []
+    side = args.canvas * args.scale
+    for _ in range(args.tiles):
+        w, h = rng.integers(12, 24, 2) * args.scale
+        pos = rng.integers(0, side - 12 * args.scale, 2)
+        angle = rng.choice([0.0, rng.uniform(-0.3, 0.3)])
+        c, s = np.cos(angle), np.sin(angle)
+        matrix = torch.tensor([[c, -s, rng.uniform(-4, 4)], [s, c, rng.uniform(-4, 4)], [0, 0, 1]])
+        tiles.append(Tile(torch.tensor([w, h]), torch.tensor(pos), np.degrees(angle), torch.zeros(2),
+                          torch.ones(4), matrix))
+        images.append(rng.integers(0, 256, (h, w, 3), dtype=np.uint8))
+    canvas = np.zeros((side, side, 3), dtype=np.uint8)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for tile, image in zip(tiles, images):
+            replace_tile_image(canvas, image, tile)
+    serial = (time.perf_counter() - start) / args.repeat
+    print("{} tiles on {}x{} ({} cores): serial {:8.2f} ms per mosaic".format(
+        args.tiles, side, side, os.cpu_count(), serial * 1e3))
+
+    placements = [TilePlacement(image.shape, tile.matrix.numpy()[0:2].astype(np.float64), tile.pos.tolist(),
+                                canvas.shape) for tile, image in zip(tiles, images)]
+    ids = [id for id, p in enumerate(placements) if not p.empty]
+    for workers in args.workers:
+        banded = np.zeros_like(canvas)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                draw_bands(banded, placements, images, ids, bands=workers, pool=pool)
+            elapsed = (time.perf_counter() - start) / args.repeat
+        print("bands workers={:<3d} {:8.2f} ms per mosaic, speedup {:5.2f}, identical {}".format(
+            workers, elapsed * 1e3, serial / elapsed, np.array_equal(banded, canvas)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_color = subparsers.add_parser("dominant_color", help="library indexing throughput")
+    parser_color.add_argument("--dataset", help="path to dataset", default="retrieve/dataset_demo")
+    parser_color.add_argument("--modes", nargs="+", choices=COLOR_MODES, default=list(COLOR_MODES))
+    parser_color.add_argument("--workers", nargs="+", type=int, default=[1, 4])
+    parser_color.set_defaults(func=bench_dominant_color)
+
+    parser_retrieval = subparsers.add_parser("retrieval", help="per-tile against batch retrieval")
+    parser_retrieval.add_argument("--dataset", help="path to dataset", default="retrieve/dataset_demo")
+    parser_retrieval.add_argument("--algorithms", nargs="+", default=["plain", "kdtree", "balltree", "knn"])
+    parser_retrieval.add_argument("--tiles", type=int, default=10000)
+    parser_retrieval.set_defaults(func=bench_retrieval)
+
+    parser_store = subparsers.add_parser("image_store", help="library load time and memory")
+    parser_store.add_argument("--dataset", help="path to dataset", default="retrieve/dataset_demo")
+    parser_store.add_argument("--images", type=int, default=100000, help="library size, the dataset is repeated")
+    parser_store.add_argument("--touch", type=int, default=5000, help="number of images to decode")
+    parser_store.add_argument("--cache_mb", type=int, default=64)
+    parser_store.set_defaults(func=bench_image_store)
+
+    parser_atlas = subparsers.add_parser("atlas", help="per-tile decode and resize cost")
+    parser_atlas.add_argument("atlas", help="folder of the atlas, see retrieve/atlas.py")
+    parser_atlas.add_argument("--dataset", help="path to dataset", default="retrieve/dataset_demo")
+    parser_atlas.add_argument("--tiles", type=int, default=10000)
+    parser_atlas.set_defaults(func=bench_atlas)
+
+    parser_ann = subparsers.add_parser("ann", help="approximate index recall and latency")
+    parser_ann.add_argument("--entries", type=int, default=1000000)
+    parser_ann.add_argument("--queries", type=int, default=10000)
+    parser_ann.add_argument("--dim", type=int, default=5, help="descriptor dimension")
+    parser_ann.add_argument("--nprobe", nargs="+", type=int, default=[1, 4, 8, 16])
+    parser_ann.set_defaults(func=bench_ann)
+
+    parser_assign = subparsers.add_parser("assignment", help="repeat-aware assignment against greedy")
+    parser_assign.add_argument("--entries", type=int, default=1000000)
+    parser_assign.add_argument("--tiles", type=int, default=10000)
+    parser_assign.add_argument("--candidates", type=int, default=32)
+    parser_assign.add_argument("--max_repeats", nargs="+", type=int, default=[1, 2, 4])
+    parser_assign.set_defaults(func=bench_assignment)
+
+    parser_index = subparsers.add_parser("index", help="cold load of pickled against memory-mapped models")
+    parser_index.add_argument("--entries", type=int, default=1000000)
+    parser_index.add_argument("--queries", type=int, default=200)
+    parser_index.add_argument("--algorithms", nargs="+", default=["kdtree", "plain"])
+    parser_index.set_defaults(func=bench_index)
+
+    parser_daemon = subparsers.add_parser("daemon", help="per-mosaic cost in-process against a warm daemon")
+    parser_daemon.add_argument("--dataset", help="path to dataset", default="retrieve/dataset_demo")
+    parser_daemon.add_argument("--tiles", type=int, default=200)
+    parser_daemon.add_argument("--repeat", type=int, default=10)
+    parser_daemon.set_defaults(func=bench_daemon)
+
+    parser_composite = subparsers.add_parser("composite", help="tile compositing time")
+    parser_composite.add_argument("--tiles", type=int, default=200)
+    parser_composite.add_argument("--canvas", type=int, default=224)
+    parser_composite.add_argument("--scale", type=int, default=1, help="output scale of canvas and tiles")
+    parser_composite.add_argument("--repeat", type=int, default=10)
+    parser_composite.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4, 8])
+    parser_composite.set_defaults(func=bench_composite)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -2,31 +2,92 @@ from math import degrees
 import sys
 import argparse
 import os
+import cv2
 
 sys.path.append("../mosaic_generation/")
 from my_shape import PolygonRect, RotationalShapeGroup
 from replaceTile import prepare_model, read, paint
-from retrieve.retriever import retrieve_API, load_images, train_model
+from retrieve.retriever import retrieve_API, load_images, train_model, extract_layouts
+from retrieve.atlas import TileAtlas
+from retrieve.daemon import connect, DEFAULT_SOCKET
+from stream_writer import STREAM_EXTENSIONS
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model", help="path to model", default="./model.pkl")
+    parser.add_argument("--model", help="path to the retrieval index folder", default="./model.idx")
+    parser.add_argument("--algorithm", help="retrieval algorithm of the index", default="kdtree")
     parser.add_argument("--dataset", help="path to dataset", default="retrieve/dataset_demo")
     parser.add_argument("--shapes", help="path to shapes.pkl", 
                         default="../results/previous_results/clip/exp1/pkls/clip_shapes.pkl")
     parser.add_argument("--shapes_groups", help="path to shape_groups.pkl", 
                         default="../results/previous_results/clip/exp1/pkls/clip_shape_groups.pkl")
     parser.add_argument("--output", help="name of output image", default="result.png")
+    parser.add_argument("--max_repeats", type=int, default=None,
+                        help="maximum number of times one image may be used, enables global assignment")
+    parser.add_argument("--candidates", type=int, default=16, help="candidates per tile for --max_repeats and --reference")
+    parser.add_argument("--reference", default=None,
+                        help="rendered mosaic (e.g. after_scale.png), enables layout re-ranking of the candidates")
+    parser.add_argument("--atlas", help="path to a mipmap atlas of the dataset (see retrieve/atlas.py)", default=None)
+    parser.add_argument("--workers", type=int, default=4, help="threads decoding tile images ahead of the compositor")
+    parser.add_argument("--preview_every", type=int, default=None, help="write a preview snapshot every N tiles")
+    parser.add_argument("--output_scale", type=float, default=1.0,
+                        help="size of the photomosaic relative to the 224x224 optimization canvas")
+    parser.add_argument("--strip_height", type=int, default=None,
+                        help="composite in strips of this many rows into a memory-mapped canvas, for large outputs")
+    parser.add_argument("--composite_workers", type=int, default=1,
+                        help="threads compositing horizontal bands of the output in parallel")
+    parser.add_argument("--daemon", nargs="?", const=DEFAULT_SOCKET, default=None,
+                        help="socket of a retrieval daemon (see retrieve/daemon.py), in-process retrieval if none is running")
     args = parser.parse_args()
-    
-    model, images = prepare_model(args.model, args.dataset)
-    tiles = read(args.shapes, args.shapes_groups)
     outname = args.output
-    if not (outname.endswith(".png") or outname.endswith(".jpg")):
+    if not outname.endswith((".png", ".jpg", ".tif")):
         outname += ".png"
+    if args.strip_height and not outname.lower().endswith(STREAM_EXTENSIONS):
+        parser.error("--strip_height writes .png or .tif outputs, not {}".format(outname))
+    
+    client = connect(args.daemon) if args.daemon else None
+    if args.daemon and client is None:
+        print("No retrieval daemon on {}, retrieving in-process".format(args.daemon))
+    if client is not None:
+        served = client.info().get("dataset")
+        if served is not None and served != os.path.realpath(args.dataset):
+            print("Retrieval daemon on {} serves {}, not {}, retrieving in-process".format(
+                args.daemon, served, args.dataset))
+            client.close()
+            client = None
+        else:
+            ignored = [name for name in ("model", "algorithm", "atlas")
+                       if getattr(args, name) != parser.get_default(name)]
+            if ignored:
+                print("Warning: the retrieval daemon uses its own index and atlas, ignoring {}".format(
+                    ", ".join("--" + name for name in ignored)))
+    if client is not None:
+        model, images = client, None
+    else:
+        model, images = prepare_model(args.model, args.dataset, algorithm = args.algorithm)
+    tiles = read(args.shapes, args.shapes_groups)
     outputpath = "../results/photomosaic/" 
     if not os.path.exists(outputpath):
         os.makedirs(outputpath)
 
-    canvas = paint(tiles, model, images, canvas_size = (224, 224, 3), path = outputpath + outname)
+    try:
+        atlas = client if client is not None else TileAtlas(args.atlas, expected_paths=images.paths) if args.atlas else None
+    except ValueError as e:
+        parser.error(str(e))
+    reference, layouts = None, None
+    if args.reference:
+        reference = cv2.cvtColor(cv2.imread(args.reference), cv2.COLOR_BGR2RGB)
+        if client is not None:
+            layouts = client.layouts()
+        elif getattr(images, "layouts", None) is not None:
+            layouts = images.layouts
+        else:
+            layouts = extract_layouts(images)
+
+    canvas = paint(tiles, model, images, canvas_size = (224, 224, 3), path = outputpath + outname, atlas = atlas,
+                   max_repeats = args.max_repeats, candidates = args.candidates,
+                   reference = reference, layouts = layouts,
+                   workers = args.workers, preview_every = args.preview_every,
+                   output_scale = args.output_scale, strip_height = args.strip_height,
+                   composite_workers = args.composite_workers)
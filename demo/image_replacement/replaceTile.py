@@ -5,10 +5,18 @@ import cv2
 import pydiffvg
 import torch
 import os
+import threading
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append("../mosaic_generation/")
 from my_shape import PolygonRect, RotationalShapeGroup
-from retrieve.retriever import retrieve_API, load_images, train_model
+from retrieve.retriever import retrieve_API, retrieve_batch, load_images, train_model, \
+    layout_descriptor, rerank_by_layout
+from retrieve.assignment import assign_tiles
+from retrieve.index_file import open_library
+from stream_writer import open_stream_writer, check_stream_path
 
 class Tile:
     """
@@ -23,67 +31,126 @@ class Tile:
         self.matrix = matrix
 
 
-def replace_tile_image(canvas, image, tile, output_path="../results/photomosaic/result.png"): 
+class TilePlacement:
+    """
+    where the image of a tile lands on a canvas
+
+    The tile image lives at rows pos[1] + x, cols pos[0] + y of an unwarped canvas and is
+    then warped by the 2x3 matrix of the tile. The part falling outside the canvas before the
+    warp is never drawn. The placement keeps the canvas ROI covered by the warped tile and
+    the matrix from the (cropped) tile image into that ROI, so that the tile can be drawn
+    into the whole canvas or into any band of its rows with the same result.
+    Tiles whose matrix is within fast_path_eps of a pure translation are pasted with a
+    slice copy at the nearest pixel offset.
+    """
+    def __init__(self, shape, mat, pos, canvas_shape, fast_path_eps=1e-3):
+        h, w = shape[:2]
+        px, py = int(pos[0]), int(pos[1])
+        ys, xs = max(0, -py), max(0, -px)
+        ye, xe = max(ys, min(h, canvas_shape[0] - py)), max(xs, min(w, canvas_shape[1] - px))
+        self.crop = (slice(ys, ye), slice(xs, xe))
+        px, py = px + xs, py + ys
+        h, w = ye - ys, xe - xs
+        self.offset, self.local = None, None
+        if h == 0 or w == 0:
+            self.roi = (0, 0, 0, 0)
+        elif fast_path_eps is not None and np.abs(mat[:, :2] - np.eye(2)).max() < fast_path_eps:
+            ox, oy = np.rint(mat[:, :2] @ [px, py] + mat[:, 2]).astype(int)
+            self.offset = (ox, oy)
+            self.roi = (max(ox, 0), max(oy, 0), min(ox + w, canvas_shape[1]), min(oy + h, canvas_shape[0]))
+        else:
+            # one pixel of margin for the bilinear footprint
+            corners = np.array([[-1, -1], [w, -1], [w, h], [-1, h]], dtype=np.float64) + [px, py]
+            warped = corners @ mat[:, :2].T + mat[:, 2]
+            x0, y0 = np.floor(warped.min(axis=0)).astype(int)
+            x1, y1 = np.ceil(warped.max(axis=0)).astype(int) + 1
+            self.roi = (max(x0, 0), max(y0, 0), min(x1, canvas_shape[1]), min(y1, canvas_shape[0]))
+            # tile-local pixel (u, v) lands at mat @ (pos + (u, v)) - (x0, y0) in the ROI
+            self.local = np.hstack([mat[:, :2], (mat @ np.array([px, py, 1.0]) - self.roi[:2])[:, None]])
+
+    @property
+    def empty(self):
+        x0, y0, x1, y1 = self.roi
+        return x0 >= x1 or y0 >= y1
+
+    def warp(self, image):
+        """ the tile image warped into the ROI and its full-coverage mask, None for a slice copy """
+        if self.empty or self.offset is not None:
+            return None
+        image = image[self.crop]
+        x0, y0, x1, y1 = self.roi
+        result = cv2.warpAffine(image, self.local, (x1 - x0, y1 - y0), flags=cv2.INTER_LINEAR)
+        mask = cv2.warpAffine(np.full(image.shape[:2], 255, dtype=np.uint8), self.local, (x1 - x0, y1 - y0),
+                              flags=cv2.INTER_LINEAR) == 255
+        return result, mask
+
+    def draw(self, canvas, image, rows=None, warped=None):
+        """ draw image into canvas, which holds the rows [rows[0], rows[1]) of the full canvas
+
+        warped is the result of warp(image) when already computed.
+        """
+        r0, r1 = rows if rows is not None else (0, canvas.shape[0])
+        x0, y0, x1, y1 = self.roi
+        ya, yb = max(y0, r0), min(y1, r1)
+        if self.empty or ya >= yb:
+            return canvas
+        if self.offset is not None:
+            ox, oy = self.offset
+            canvas[ya - r0:yb - r0, x0:x1] = image[self.crop][ya - oy:yb - oy, x0 - ox:x1 - ox]
+            return canvas
+        result, mask = warped if warped is not None else self.warp(image)
+        result, mask = result[ya - y0:yb - y0], mask[ya - y0:yb - y0]
+        canvas[ya - r0:yb - r0, x0:x1][mask] = result[mask]
+        return canvas
+
+
+def scale_tile(tile, scale=1.0):
+    """ matrix, position and size of a tile on a canvas scaled by scale
+
+    Args:
+        tile (Tile): tile on the optimization canvas
+        scale (float, optional): output scale factor. Defaults to 1.0.
+
+    Returns:
+        tuple: 2x3 matrix, integer position (x, y) and size (w, h) on the scaled canvas
+    """
+    mat = tile.matrix.detach().numpy()[0:2, :].astype(np.float64)
+    pos = np.asarray(tile.pos.tolist(), dtype=np.float64) * scale
+    size = tuple(max(1, int(round(x * scale))) for x in tile.shape.int().tolist())
+    # s * (A p + t) = A (s p) + s t; the fractional part of s p moves into the translation
+    base = np.floor(pos)
+    mat = np.hstack([mat[:, :2], (scale * mat[:, 2] + mat[:, :2] @ (pos - base))[:, None]])
+    return mat, base.astype(int).tolist(), size
+
+
+def replace_tile_image(canvas, image, tile, output_path=None, fast_path_eps=1e-3, verbose=False):
     """
     function for replacing the tile generated by diffvg
     the tile is a rotatable rectangle, and the rotation center is the topleft corner of the canvas
 
-    what we will do is perform the rotation but maintain the center of the tile
+    Only the rotated bounding box of the tile is touched, see TilePlacement.
 
-    canvas: the image to paint
+    canvas: the image to paint, modified in place
     tile: shape(w, h), pos(x, y), rotate(theta), fill(color) 
     image: the image to replace the tile, is already in the shape of the tile
+    output_path: if given, the canvas is also written there
+    fast_path_eps: largest deviation of the rotation part from the identity that is
+        pasted without warping, None to always warp
     """
 
     pos = tile.pos.tolist()
-    angle = tile.rotate
-    translation = tile.translate.tolist()
-
-    mat = tile.matrix.detach().numpy()[0:2, :]
-
-    print("\tPOS= ", pos, ": ", type(pos))
-    print("\tANGLE= ", angle, ": ", type(angle))
-    print("\tTRANS= ", translation, ": ", type(translation))
-    print("\tMAT= ", mat, ": ", type(mat))
-    print("\tSHAPE= ", image.shape, ": ", type(image.shape))
-
-    rotation_centor = (0, 0)
-
-    rot_mat = cv2.getRotationMatrix2D(rotation_centor, angle, 1.0)
-    trans_mat = np.array([[1, 0, translation[0]], [0, 1, translation[1]]])
-    trans_mat = rot_mat * trans_mat
-
-    canvas_sized_image = np.zeros((canvas.shape[0], canvas.shape[1], 3), dtype=np.uint8)
-    mask = np.zeros((canvas.shape[0], canvas.shape[1]), dtype=np.uint8)
-    alpha = np.zeros((canvas.shape[0], canvas.shape[1]), dtype=np.double)
-
-    for x in range(image.shape[0]):
-        for y in range(image.shape[1]):
-            try:
-                cur_pos = (x + pos[1], y + pos[0])
-                canvas_sized_image[cur_pos] = image[x, y] 
-                mask[cur_pos] = 255
-                # alpha[cur_pos] = min(1.0, tile.fill[3].item())
-                alpha[cur_pos] = 1.0
-            except:
-                pass
-
-
-    result = cv2.warpAffine(canvas_sized_image, mat, canvas_sized_image.shape[1::-1], flags=cv2.INTER_LINEAR)
-    mask = cv2.warpAffine(mask, mat, canvas_sized_image.shape[1::-1], flags=cv2.INTER_LINEAR)
-    alpha = cv2.warpAffine(alpha , mat, canvas_sized_image.shape[1::-1], flags=cv2.INTER_LINEAR)
-    
-    for x in range(result.shape[0]):
-        for y in range(result.shape[1]):
-            try:
-                if mask[x, y] == 255:
-                    canvas[x, y] = (result[x, y] * alpha[x, y] + canvas[x, y] * (1 - alpha[x, y])).astype(np.uint8)
-            except:
-                pass
-
-    print("WRITING")
-    cv2.imwrite(output_path, canvas)
-    print("DONE")
+    mat = tile.matrix.detach().numpy()[0:2, :].astype(np.float64)
+
+    if verbose:
+        print("\tPOS= ", pos, ": ", type(pos))
+        print("\tANGLE= ", tile.rotate, ": ", type(tile.rotate))
+        print("\tMAT= ", mat, ": ", type(mat))
+        print("\tSHAPE= ", image.shape, ": ", type(image.shape))
+
+    TilePlacement(image.shape, mat, pos, canvas.shape, fast_path_eps).draw(canvas, image)
+
+    if output_path is not None:
+        cv2.imwrite(output_path, canvas)
     return canvas
 
 def read_tiles(shapes, rotation_groups):
@@ -107,29 +174,24 @@ def read_tiles(shapes, rotation_groups):
     return tiles
 
 #==================== test function ====================
-def prepare_model(MODELPATH, IMAGEPATH, algorithm='kdtree'):
+def prepare_model(MODELPATH, IMAGEPATH, algorithm='kdtree', size_weight=0.1):
     """ return retrieve model and imageset, according to given paths
 
+    The dataset is indexed incrementally by its feature store (see retrieve.feature_store),
+    and the model is kept as a versioned index folder of memory-mapped arrays, see
+    retrieve.index_file.open_library.
+
     Args:
-        MODELPATH (str): path to retrieve model, if not exist, will train one
+        MODELPATH (str): path to the retrieve index folder, if not exist, will build one
         IMAGEPATH (str): path to image dataset
         algorithm (str, optional): algorithm used by retriever. Defaults to 'kdtree'.
+        size_weight (float, optional): weight of the tile size in the model. Defaults to 0.1.
 
     Returns:
-        (_type_, _type_): retrieve model, and corresponding imageset
+        (_type_, ImageStore): retrieve model, and corresponding lazy imageset
     """
-    import pickle
-    import os
-    images = load_images(IMAGEPATH)
     print("Start preparing model...")
-    if os.path.exists(MODELPATH):
-        print("Model already exists, loading...")
-        model = pickle.load(open(MODELPATH, "rb"))
-    else:
-        model = train_model(images, algorithm='kdtree')
-        with open('model.pkl', 'wb') as f:
-            pickle.dump(model, f)
-
+    model, images = open_library(MODELPATH, IMAGEPATH, algorithm=algorithm, size_weight=size_weight)
     print("Done preparing model...")
     return model, images
 
@@ -153,10 +215,245 @@ def read(shapes_file, shape_groups_file):
     tiles = read_tiles(shapes, shape_groups)
     return tiles
 
+def tile_queries(tiles):
+    """ retrieval queries of the tiles
+
+    Args:
+        tiles (List[Tile]): list of tiles to replace
+
+    Returns:
+        (np.ndarray, np.ndarray): (T, 3) RGB colors in [0, 255] and (T, 2) sizes (w, h)
+    """
+    colors = np.array([tile.fill.double().tolist()[0:3] for tile in tiles]).reshape(-1, 3)
+    colors = np.clip((colors * 255).astype(np.int64), 0, 255)
+    sizes = np.array([tile.shape.int().tolist() for tile in tiles], dtype=np.int64).reshape(-1, 2)
+    return colors, sizes
+
+def tile_layouts(reference, tiles, sizes, grid=4):
+    """ layout descriptors of the regions of a rendered mosaic covered by the tiles
+
+    Args:
+        reference (np.ndarray): RGB uint8 rendering of the mosaic, in canvas coordinates
+        tiles (List[Tile]): list of tiles
+        sizes (np.ndarray): (T, 2) tile sizes (w, h), see tile_queries
+        grid (int, optional): cells per side of the descriptor. Defaults to 4.
+
+    Returns:
+        np.ndarray: (T, grid * grid * 3) uint8 descriptors
+    """
+    layouts = []
+    for tile, (w, h) in zip(tiles, sizes):
+        mat = tile.matrix.detach().numpy()[0:2, :].astype(np.float64)
+        pos = tile.pos.tolist()
+        # tile-local pixel (u, v) sits at mat @ (pos + (u, v)) on the canvas
+        local = np.hstack([mat[:, :2], (mat @ np.array([pos[0], pos[1], 1.0]))[:, None]])
+        patch = cv2.warpAffine(reference, local, (max(1, int(w)), max(1, int(h))),
+                               flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        layouts.append(layout_descriptor(patch, grid=grid))
+    return np.array(layouts, dtype=np.uint8).reshape(len(sizes), grid * grid * 3)
+
+_decode_lock = threading.Lock()
+
+def tile_image(images, index, size, color, atlas=None, add_filter=False):
+    """ the retrieved image of one tile, resized and ready to composite
+
+    Args:
+        images (_type_): image set for generateing photomosaic
+        index (int): index of the retrieved image
+        size (tuple): tile size (w, h)
+        color (list): RGB fill color of the tile, used by the filter
+        atlas (TileAtlas, optional): pre-resized mipmap atlas of the image set. Tiles larger
+            than its largest level are resized from the full-resolution image instead of
+            being upsampled, when images is given. Defaults to None.
+        add_filter (bool, optional): blend 15% of the tile color in. Defaults to False.
+
+    Returns:
+        np.ndarray: (h, w, 3) uint8 tile image
+    """
+    if atlas is not None and (images is None or not hasattr(atlas, "covers") or atlas.covers(size)):
+        tile_img = atlas.get(index, size)
+    else:
+        if hasattr(images, "array"):
+            tile_img = images.array(index)
+        else:
+            # images opened lazily by PIL must not be decoded by two threads at once
+            with _decode_lock:
+                tile_img = np.asarray(images[index]["image"])
+        tile_img = cv2.resize(tile_img, size)
+    tile_img = cv2.cvtColor(tile_img, cv2.COLOR_BGR2RGB)
+    if add_filter:
+        color_img = np.zeros_like(tile_img)
+        color_img[:] = color
+        tile_img[:] = 0.85 * tile_img + 0.15 * color_img
+    return tile_img
+
+def ready_tiles(jobs, images, atlas=None, add_filter=False, workers=4, queue_size=None):
+    """ tile images of the jobs (index, size, color), yielded in job order
+
+    Decoding and resizing run in a thread pool at most queue_size jobs ahead of the
+    consumer, so the tiles stream into the compositor in draw order with bounded memory.
+
+    Args:
+        jobs (list): (image index, size (w, h), color) of every tile, in draw order
+        images (_type_): image set for generateing photomosaic
+        atlas (TileAtlas, optional): pre-resized mipmap atlas of the image set. Defaults to None.
+        add_filter (bool, optional): see tile_image. Defaults to False.
+        workers (int, optional): decoding threads, 1 decodes in the calling thread. Defaults to 4.
+        queue_size (int, optional): tiles decoded ahead. Defaults to 2 * workers.
+
+    Yields:
+        np.ndarray: tile image of every job
+    """
+    if workers <= 1:
+        for index, size, color in jobs:
+            yield tile_image(images, index, size, color, atlas, add_filter)
+        return
+    window = max(1, queue_size or 2 * workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for index, size, color in jobs:
+            pending.append(pool.submit(tile_image, images, index, size, color, atlas, add_filter))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def preview_path(path, count):
+    """ path of the preview snapshot after count tiles, next to the final image """
+    root, ext = os.path.splitext(path)
+    return "{}_preview_{:05d}{}".format(root, count, ext)
+
+def draw_bands(canvas, placements, tile_images, ids, rows=None, bands=1, pool=None):
+    """ draw tiles in order into canvas, split into horizontal bands drawn in parallel
+
+    The tiles are first warped into their ROIs in parallel, then every band copies the tiles
+    intersecting it in draw order, clipped to its rows. Since a placement always warps its
+    whole ROI, the result is byte-identical to drawing the tiles one after the other on the
+    whole canvas.
+
+    Args:
+        canvas (np.ndarray): canvas holding the rows [rows[0], rows[1]) of the full canvas
+        placements (List[TilePlacement]): placement of every tile
+        tile_images (_type_): tile image by tile id (list or dict)
+        ids (list): ids of the tiles to draw, in draw order
+        rows (tuple, optional): rows of the full canvas held by canvas. Defaults to all of them.
+        bands (int, optional): number of bands. Defaults to 1.
+        pool (ThreadPoolExecutor, optional): executor of the warps and bands, None draws the
+            tiles one after the other.
+
+    Returns:
+        np.ndarray: canvas
+    """
+    r0, r1 = rows if rows is not None else (0, canvas.shape[0])
+    bounds = np.linspace(r0, r1, max(1, min(bands, r1 - r0)) + 1).astype(int)
+
+    if pool is None:
+        for id in ids:
+            placements[id].draw(canvas, tile_images[id], rows=(r0, r1))
+        return canvas
+    # warp every tile once, tiles crossing bands are not warped again per band
+    warped = dict(zip(ids, pool.map(lambda id: placements[id].warp(tile_images[id]), ids)))
+
+    def draw_band(b0, b1):
+        band = canvas[b0 - r0:b1 - r0]
+        for id in ids:
+            _, y0, _, y1 = placements[id].roi
+            if y0 < b1 and y1 > b0:
+                placements[id].draw(band, tile_images[id], rows=(b0, b1), warped=warped[id])
+
+    list(pool.map(draw_band, bounds[:-1], bounds[1:]))
+    return canvas
+
+def paint_strips(placements, jobs, images, canvas_shape, path, strip_height=512, atlas=None,
+                 add_filter=False, workers=4, queue_size=None, keep_canvas=False, composite_workers=1):
+    """ composite placed tiles into a memory-mapped canvas strip by strip and stream it to path
+
+    Each strip of rows only draws the tiles intersecting it, in draw order and clipped to
+    the strip, so the result equals compositing the whole canvas at once. Tile images are
+    decoded when their first strip is reached and dropped after their last one, and only
+    one strip of the canvas is mapped at a time, so the memory does not grow with the
+    output size.
+
+    Args:
+        placements (List[TilePlacement]): placement of every tile on the canvas, in draw order
+        jobs (list): (image index, size (w, h), color) of every tile, see ready_tiles
+        images (_type_): image set for generateing photomosaic
+        canvas_shape (tuple): (H, W, 3) shape of the output
+        path (str): output image, .png or .tif
+        strip_height (int, optional): rows per strip. Defaults to 512.
+        atlas (TileAtlas, optional): pre-resized mipmap atlas of the image set. Defaults to None.
+        add_filter (bool, optional): see tile_image. Defaults to False.
+        workers (int, optional): decoding threads, see ready_tiles. Defaults to 4.
+        queue_size (int, optional): tiles decoded ahead. Defaults to 2 * workers.
+        keep_canvas (bool, optional): keep the canvas (<path>.canvas.npy). Defaults to False.
+        composite_workers (int, optional): threads compositing bands of every strip, see
+            draw_bands. Defaults to 1.
+
+    Returns:
+        np.memmap: read-only canvas if keep_canvas, else None
+    """
+    height = canvas_shape[0]
+    n_strips = -(-height // strip_height)
+    first, last = {}, {}
+    strips = [[] for _ in range(n_strips)]
+    for id, placement in enumerate(placements):
+        if placement.empty:
+            continue
+        first[id], last[id] = placement.roi[1] // strip_height, (placement.roi[3] - 1) // strip_height
+        for s in range(first[id], last[id] + 1):
+            strips[s].append(id)
+    # tiles are decoded in the order of their first strip
+    order = sorted(first, key=lambda id: (first[id], id))
+    ready = ready_tiles([jobs[id] for id in order], images, atlas=atlas, add_filter=add_filter,
+                        workers=workers, queue_size=queue_size)
+
+    canvas_path = os.path.splitext(path)[0] + ".canvas.npy"
+    canvas = np.lib.format.open_memmap(canvas_path, mode="w+", dtype=np.uint8, shape=tuple(canvas_shape))
+    del canvas
+    live, cursor = {}, 0
+    pool = ThreadPoolExecutor(max_workers=composite_workers) if composite_workers > 1 else None
+    with open_stream_writer(path, canvas_shape[1], height) as writer:
+        for s in range(n_strips):
+            r0, r1 = s * strip_height, min(height, (s + 1) * strip_height)
+            while cursor < len(order) and first[order[cursor]] == s:
+                live[order[cursor]] = next(ready)
+                cursor += 1
+            canvas = np.load(canvas_path, mmap_mode="r+")
+            strip = canvas[r0:r1]
+            draw_bands(strip, placements, live, strips[s], rows=(r0, r1), bands=composite_workers, pool=pool)
+            for id in strips[s]:
+                if last[id] == s:
+                    del live[id]
+            # the canvas is BGR like the cv2 images
+            writer.write(strip[..., ::-1])
+            canvas.flush()
+            del strip, canvas
+    if pool is not None:
+        pool.shutdown()
+    if not keep_canvas:
+        os.remove(canvas_path)
+        return None
+    return np.load(canvas_path, mmap_mode="r")
+
 def paint(tiles, model, images, 
           canvas_size = (224, 224, 3), 
           path = "../results/photomosaic/result.png", 
-          add_filter = False):
+          add_filter = False,
+          algorithm = None,
+          atlas = None,
+          max_repeats = None,
+          candidates = 16,
+          repeat_penalty = 0.0,
+          reference = None,
+          layouts = None,
+          layout_weight = 1.0,
+          workers = 4,
+          queue_size = None,
+          preview_every = None,
+          output_scale = 1.0,
+          strip_height = None,
+          keep_canvas = False,
+          composite_workers = 1):
     """ replace tiles with retrieved images and save the generated photomosaic image
 
     Args:
@@ -165,29 +462,90 @@ def paint(tiles, model, images,
         images (_type_): image set for generateing photomosaic
         canvas_size (tuple, optional): size of canvas. Defaults to (224, 224, 3).
         name (str, optional): filename of generated image. Defaults to "result.png".
+        algorithm (str, optional): algorithm of the retrieve model, inferred when None.
+        atlas (TileAtlas, optional): pre-resized mipmap atlas of the image set, built in the
+            same order as the model, or a retrieve.daemon.RetrievalClient serving the tiles.
+            Defaults to None, resizing from full resolution.
+        max_repeats (int, optional): if given, tiles are assigned globally over their top
+            candidates so that no image is used more than max_repeats times (see
+            retrieve.assignment). Defaults to None, every tile takes its nearest image.
+        candidates (int, optional): candidates per tile for the global assignment. Defaults to 16.
+        repeat_penalty (float, optional): extra cost of every further use of an image. Defaults to 0.
+        reference (np.ndarray, optional): RGB rendering of the mosaic. Together with layouts,
+            enables two-stage retrieval: the top candidates of the model are re-ranked by
+            how well their spatial color layout matches the tile's rendered region.
+        layouts (np.ndarray, optional): (N, D) layout descriptors of the image set, see
+            retrieve.retriever.extract_layouts. Defaults to None.
+        layout_weight (float, optional): weight of the layout distance. Defaults to 1.0.
+        workers (int, optional): threads decoding and resizing the tile images ahead of the
+            compositor, see ready_tiles. Defaults to 4.
+        queue_size (int, optional): tiles decoded ahead of the compositor. Defaults to 2 * workers.
+        preview_every (int, optional): write a snapshot of the canvas next to path every
+            preview_every tiles. Defaults to None.
+        output_scale (float, optional): scale of the photomosaic relative to canvas_size, the
+            tile geometry of the optimization canvas is mapped onto the larger output.
+            Defaults to 1.0.
+        strip_height (int, optional): if given, composite into a memory-mapped canvas in
+            horizontal strips of this many rows and stream them to path (.png or .tif),
+            see paint_strips. Defaults to None, compositing in memory.
+        keep_canvas (bool, optional): keep the memory-mapped canvas of the strip mode next
+            to path and return it. Defaults to False.
+        composite_workers (int, optional): threads compositing horizontal bands of the
+            canvas in parallel, see draw_bands. The result does not depend on it. Without
+            previews, all tile images are decoded before compositing. Defaults to 1.
 
     Returns:
-        tuple: generated photomosaic image
+        tuple: generated photomosaic image, None for the strip mode unless keep_canvas
     """
-    canvas = np.zeros(canvas_size, dtype=np.uint8)
-    for id, tile in enumerate(tiles):
-        tile_shape = tile.shape.int().tolist()
-        tile_color = tile.fill.double().tolist()[0:3]
-        tile_color = [int(x * 255) for x in tile_color]
-        tile_color = [tile_color[2], tile_color[1], tile_color[0]]
-        tile_color = [max(0, min(x, 255)) for x in tile_color]
+    if strip_height is not None:
+        # fail before retrieval, not after compositing the first strip
+        check_stream_path(path)
+        if preview_every:
+            warnings.warn("preview_every is not supported with strip_height, no previews are written")
+    out_shape = (int(round(canvas_size[0] * output_scale)), int(round(canvas_size[1] * output_scale))) + \
+        tuple(canvas_size[2:])
+    # Retrieve the images of all tiles in one query before compositing
+    colors, sizes = tile_queries(tiles)
+    two_stage = reference is not None and layouts is not None
+    if max_repeats or two_stage:
+        indices, distances = retrieve_batch(colors, sizes, model, k=candidates, algorithm=algorithm)
+        if two_stage:
+            grid = int(round(np.sqrt(layouts.shape[1] // 3)))
+            indices, distances = rerank_by_layout(indices, distances, tile_layouts(reference, tiles, sizes, grid),
+                                                  layouts, layout_weight=layout_weight)
+        if max_repeats:
+            indices = assign_tiles(indices, distances, max_repeats=max_repeats,
+                                   repeat_penalty=repeat_penalty)[:, None]
+    else:
+        indices, _ = retrieve_batch(colors, sizes, model, algorithm=algorithm)
 
-        tile_color = [tile_color[2], tile_color[1], tile_color[0]]
-        tile_img = np.asarray(retrieve_API(tile_color, tile_shape, model, images)) #, 'kdtree'))
-        tile_img = cv2.resize(tile_img, (tile_shape))
-        tile_img = cv2.cvtColor(tile_img, cv2.COLOR_BGR2RGB)
-        color_img = np.zeros((tile_img.shape[0], tile_img.shape[1], 3), dtype=np.uint8)
-        color_img[:] = tile_color
-        color_img.dtype = np.uint8
-        if add_filter:
-            tile_img[:] = 0.85 * tile_img + 0.15 * color_img
-        print("COLOR: ", tile_color)
-        replace_tile_image(canvas, tile_img, tile, output_path=path)
+    placements, jobs = [], []
+    for id, tile in enumerate(tiles):
+        mat, pos, size = scale_tile(tile, output_scale)
+        placements.append(TilePlacement(size[::-1], mat, pos, out_shape))
+        jobs.append((indices[id, 0], size, colors[id].tolist()))
+    if strip_height is None and hasattr(atlas, "prefetch"):
+        # tiles served by a retrieval daemon, fetch the whole mosaic in one request
+        atlas.prefetch([job[0] for job in jobs], [job[1] for job in jobs])
+    if strip_height is not None:
+        return paint_strips(placements, jobs, images, out_shape, path, strip_height=strip_height, atlas=atlas,
+                            add_filter=add_filter, workers=workers, queue_size=queue_size, keep_canvas=keep_canvas,
+                            composite_workers=composite_workers)
+
+    canvas = np.zeros(out_shape, dtype=np.uint8)
+    ready = ready_tiles(jobs, images, atlas=atlas, add_filter=add_filter, workers=workers, queue_size=queue_size)
+    if composite_workers > 1 and not preview_every:
+        tile_images = list(ready)
+        with ThreadPoolExecutor(max_workers=composite_workers) as pool:
+            draw_bands(canvas, placements, tile_images, [id for id, p in enumerate(placements) if not p.empty],
+                       bands=composite_workers, pool=pool)
+    else:
+        for id, (placement, tile_img) in enumerate(zip(placements, ready)):
+            placement.draw(canvas, tile_img)
+            if preview_every and path is not None and (id + 1) % preview_every == 0 and id + 1 < len(tiles):
+                cv2.imwrite(preview_path(path, id + 1), canvas)
+    if path is not None:
+        cv2.imwrite(path, canvas)
     return canvas
     
 def test_read():
@@ -0,0 +1,164 @@
+import numpy as np
+
+
+def _assign(X, centroids, chunk=65536):
+    """ index of, and squared distance to, the nearest centroid of every row of X """
+    c_norm = (centroids ** 2).sum(axis=1)
+    labels = np.empty(len(X), dtype=np.int64)
+    dists = np.empty(len(X))
+    for start in range(0, len(X), chunk):
+        x = X[start:start + chunk]
+        d = (x ** 2).sum(axis=1)[:, None] - 2 * x @ centroids.T + c_norm[None, :]
+        labels[start:start + chunk] = np.argmin(d, axis=1)
+        dists[start:start + chunk] = np.maximum(d[np.arange(len(x)), labels[start:start + chunk]], 0)
+    return labels, dists
+
+
+def kmeans(X, k, n_iter=10, seed=0):
+    """ plain Lloyd iterations, initialized from a random sample of the rows """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(X))
+    centroids = X[rng.choice(len(X), k, replace=False)].astype(np.float64)
+    for _ in range(n_iter):
+        labels, _ = _assign(X, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=X[:, d], minlength=k) for d in range(X.shape[1])], axis=1)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # re-seed empty clusters with random rows
+        centroids[empty] = X[rng.choice(len(X), empty.sum())]
+    return centroids
+
+
+class IVFPQIndex:
+    """
+    approximate nearest-neighbor index: inverted file with product quantization
+
+    Vectors are assigned to n_lists coarse centroids. Their residuals are encoded with
+    n_subvectors codebooks of 2**n_bits entries each. A query scans the nprobe nearest lists
+    with asymmetric distances from lookup tables, then re-ranks the best `rerank` candidates
+    with exact distances. nprobe and rerank trade recall for latency.
+    The interface follows sklearn's KDTree: query(X, k) -> (distances, indices).
+
+    The exact re-ranking needs the vectors themselves, kept as float32: 4 * dim bytes per
+    vector next to its n_subvectors code bytes, half the size of the float64 feature matrix
+    of a PlainIndex. With rerank=0 they are not kept at all and the index holds only the
+    codes, at the cost of approximate distances and a lower recall.
+    """
+    def __init__(self, n_lists=None, n_subvectors=None, n_bits=8, nprobe=8, rerank=16,
+                 train_size=65536, seed=0):
+        self.n_lists = n_lists
+        self.n_subvectors = n_subvectors
+        self.n_bits = n_bits
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.train_size = train_size
+        self.seed = seed
+
+    def fit(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        n, self.dim = X.shape
+        rng = np.random.default_rng(self.seed)
+        sample = X[rng.choice(n, min(n, self.train_size), replace=False)]
+        n_lists = self.n_lists or max(1, int(np.sqrt(n)))
+        m = self.n_subvectors or min(self.dim, 8)
+        self.sub_dim = -(-self.dim // m)
+
+        self.centroids = kmeans(sample, n_lists, seed=self.seed)
+        labels, _ = _assign(sample, self.centroids)
+        residuals = self._pad(sample - self.centroids[labels]).reshape(len(sample), m, self.sub_dim)
+        # 64 training points per codeword are plenty
+        residuals = residuals[:64 * 2 ** self.n_bits]
+        self.codebooks = np.stack([kmeans(residuals[:, j], 2 ** self.n_bits, seed=self.seed + j)
+                                   for j in range(m)])
+
+        labels, _ = _assign(X, self.centroids)
+        self.order = np.argsort(labels, kind='stable')
+        self.list_offsets = np.searchsorted(labels[self.order], np.arange(len(self.centroids) + 1))
+        self.codes = self._encode(X[self.order] - self.centroids[labels[self.order]])
+        # float32 is exact enough for re-ranking 8-bit colors and pixel sizes
+        self.vectors = X.astype(np.float32) if self.rerank else None
+        return self
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _pad(self, X):
+        m = len(self.codebooks) if hasattr(self, 'codebooks') else (self.n_subvectors or min(self.dim, 8))
+        width = m * self.sub_dim
+        return X if X.shape[1] == width else np.hstack([X, np.zeros((len(X), width - X.shape[1]))])
+
+    def _encode(self, residuals):
+        m = len(self.codebooks)
+        residuals = self._pad(residuals).reshape(len(residuals), m, self.sub_dim)
+        codes = np.empty((len(residuals), m), dtype=np.uint8 if self.n_bits <= 8 else np.uint16)
+        for j in range(m):
+            codes[:, j], _ = _assign(residuals[:, j], self.codebooks[j])
+        return codes
+
+    def query(self, X, k=1, return_distance=True):
+        X = np.asarray(X, dtype=np.float64).reshape(-1, self.dim)
+        if k > len(self):
+            raise ValueError("k = {} is larger than the {} indexed vectors".format(k, len(self)))
+        nprobe = min(self.nprobe, len(self.centroids))
+        n_cand = max(k, self.rerank)
+        best_d, best_i = self._probe(X, nprobe, n_cand)
+        # widen the probe of queries whose lists hold fewer than k vectors; probing every
+        # list sees all vectors, so this ends with k candidates for every query
+        short = (best_i >= 0).sum(1) < k
+        while short.any() and nprobe < len(self.centroids):
+            nprobe = min(2 * nprobe, len(self.centroids))
+            best_d[short], best_i[short] = self._probe(X[short], nprobe, n_cand)
+            short = (best_i >= 0).sum(1) < k
+
+        # exact re-ranking of the shortlisted candidates
+        valid = best_i >= 0
+        if self.rerank:
+            exact = ((self.vectors[np.where(valid, best_i, 0)].astype(np.float64) - X[:, None, :]) ** 2).sum(-1)
+            exact = np.where(valid, exact, np.inf)
+        else:
+            exact = np.where(valid, best_d, np.inf)
+        order = np.argsort(exact, axis=1, kind='stable')[:, :k]
+        indices = np.take_along_axis(best_i, order, axis=1)
+        if not return_distance:
+            return indices
+        return np.sqrt(np.take_along_axis(exact, order, axis=1)), indices
+
+    def _probe(self, X, nprobe, n_cand):
+        """ (Q, n_cand) approximate distances and ids of the best candidates in the nprobe
+        nearest lists of every query, padded with inf / -1 """
+        m = len(self.codebooks)
+
+        # nearest coarse lists of every query
+        cd = (X ** 2).sum(1)[:, None] - 2 * X @ self.centroids.T + (self.centroids ** 2).sum(1)[None, :]
+        probes = np.argpartition(cd, nprobe - 1, axis=1)[:, :nprobe] if nprobe < cd.shape[1] else \
+            np.broadcast_to(np.arange(cd.shape[1]), cd.shape)
+
+        best_d = np.full((len(X), n_cand), np.inf)
+        best_i = np.full((len(X), n_cand), -1, dtype=np.int64)
+        # visit list by list, scoring all queries that probe it at once
+        query_ids = np.repeat(np.arange(len(X)), probes.shape[1])
+        lists = probes.reshape(-1)
+        by_list = np.argsort(lists, kind='stable')
+        bounds = np.searchsorted(lists[by_list], np.arange(len(self.centroids) + 1))
+        for l in range(len(self.centroids)):
+            start, stop = self.list_offsets[l], self.list_offsets[l + 1]
+            if start == stop or bounds[l] == bounds[l + 1]:
+                continue
+            q = query_ids[by_list[bounds[l]:bounds[l + 1]]]
+            r = self._pad(X[q] - self.centroids[l]).reshape(len(q), m, self.sub_dim)
+            # lookup tables (Q, m, 2**bits) of squared sub-distances
+            lut = ((r[:, :, None, :] - self.codebooks[None]) ** 2).sum(-1)
+            codes = self.codes[start:stop]
+            d = np.zeros((len(q), stop - start))
+            for j in range(m):
+                d += lut[:, j, codes[:, j]]
+            ids = np.broadcast_to(self.order[start:stop], d.shape)
+            merged_d = np.hstack([best_d[q], d])
+            merged_i = np.hstack([best_i[q], ids])
+            if merged_d.shape[1] > n_cand:
+                keep = np.argpartition(merged_d, n_cand - 1, axis=1)[:, :n_cand]
+                merged_d = np.take_along_axis(merged_d, keep, axis=1)
+                merged_i = np.take_along_axis(merged_i, keep, axis=1)
+            best_d[q], best_i[q] = merged_d, merged_i
+        return best_d, best_i
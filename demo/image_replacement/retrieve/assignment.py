@@ -0,0 +1,85 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+
+def greedy_assignment(indices):
+    """ every tile takes its nearest candidate, independently of the others """
+    return np.asarray(indices)[:, 0].copy()
+
+
+def assign_tiles(indices, distances, max_repeats=2, repeat_penalty=0.0, overflow_penalty=None):
+    """ repeat-aware tile-to-image assignment over sparse top-k candidates
+
+    Each candidate image is expanded into max_repeats copy slots, the r-th copy costing an
+    extra repeat_penalty * r, and the tiles are matched to slots by a sparse minimum-weight
+    bipartite matching. The dense (tiles x library) cost matrix is never built: the graph
+    only has the T x k candidate edges per slot. Every tile also has a private fallback slot
+    with its nearest candidate at distance + overflow_penalty, so the problem is always
+    feasible; fallbacks are the only way an image can exceed max_repeats.
+
+    Args:
+        indices (np.ndarray): (T, k) candidate image indices per tile, see retrieve_batch
+        distances (np.ndarray): (T, k) candidate distances
+        max_repeats (int, optional): usage cap per image. Defaults to 2.
+        repeat_penalty (float, optional): extra cost of every further use. Defaults to 0.
+        overflow_penalty (float, optional): extra cost of a fallback. Defaults to twice the
+            largest candidate distance plus the largest repeat penalty.
+
+    Returns:
+        np.ndarray: (T,) assigned image index per tile
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    distances = np.asarray(distances, dtype=np.float64)
+    n_tiles, k = indices.shape
+    finite = np.isfinite(distances)
+    if not finite.all():
+        # NaN / inf distances (e.g. 'svm', which has none) rank after every finite one, in
+        # candidate order, instead of poisoning the overflow penalty and the matching
+        worst = distances[finite].max() if finite.any() else 0.0
+        distances = np.where(finite, distances, worst + 1 + np.arange(k)[None, :])
+    if overflow_penalty is None:
+        overflow_penalty = 2 * distances.max() + repeat_penalty * max_repeats + 1
+
+    images, inverse = np.unique(indices, return_inverse=True)
+    inverse = inverse.reshape(n_tiles, k)
+    # A tile listing an image twice keeps its cheaper entry only, csr_matrix would sum the
+    # weights of duplicate edges
+    key = (np.arange(n_tiles)[:, None] * len(images) + inverse).ravel()
+    order = np.lexsort((distances.ravel(), key))
+    unique = np.zeros(n_tiles * k, dtype=bool)
+    unique[order[np.unique(key[order], return_index=True)[1]]] = True
+    unique = unique.reshape(n_tiles, k)
+    # Slots of an image: no more copies than tiles listing it, and at most max_repeats
+    n_slots = np.minimum(np.bincount(inverse[unique], minlength=len(images)), max_repeats)
+    slot_start = np.concatenate([[0], np.cumsum(n_slots)])
+
+    rows, cols, costs = [], [], []
+    for r in range(max_repeats):
+        has_copy = (n_slots[inverse] > r) & unique
+        t, c = np.nonzero(has_copy)
+        rows.append(t)
+        cols.append(slot_start[inverse[t, c]] + r)
+        costs.append(distances[t, c] + repeat_penalty * r)
+    # private fallback slot of every tile
+    fallback = slot_start[-1] + np.arange(n_tiles)
+    rows.append(np.arange(n_tiles))
+    cols.append(fallback)
+    costs.append(distances[:, 0] + overflow_penalty)
+
+    rows, cols, costs = np.concatenate(rows), np.concatenate(cols), np.concatenate(costs)
+    # shift every weight by one: zero entries would count as missing edges
+    graph = csr_matrix((costs - costs.min() + 1.0, (rows, cols)), shape=(n_tiles, slot_start[-1] + n_tiles))
+    tile_ids, slot_ids = min_weight_full_bipartite_matching(graph)
+    matched = np.empty(n_tiles, dtype=np.int64)
+    matched[tile_ids] = slot_ids
+
+    slot_image = np.repeat(images, n_slots)
+    return np.where(matched < slot_start[-1], slot_image[np.minimum(matched, slot_start[-1] - 1)],
+                    indices[:, 0])
+
+
+def assignment_cost(assigned, colors, features):
+    """ total color error and the largest reuse count of an assignment """
+    error = np.linalg.norm(np.asarray(colors, dtype=np.float64) - features[assigned, :3], axis=1).sum()
+    return error, int(np.bincount(assigned).max())
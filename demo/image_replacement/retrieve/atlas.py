@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def level_shape(aspect, level):
+    """ (height, width) of a mipmap level: height 2**level, width following the aspect ratio w/h """
+    height = 2 ** level
+    return height, max(1, int(round(height * aspect)))
+
+
+def center_crop(image, aspect):
+    """ center crop an (H, W, C) array to the aspect ratio w/h """
+    h, w = image.shape[:2]
+    if w / h > aspect:
+        cw = max(1, int(round(h * aspect)))
+        x0 = (w - cw) // 2
+        return image[:, x0:x0 + cw]
+    ch = max(1, int(round(w / aspect)))
+    y0 = (h - ch) // 2
+    return image[y0:y0 + ch]
+
+
+class TileAtlas:
+    """
+    memory-mapped mipmap atlas of a tile library
+
+    Every library image is center-cropped to a few aspect-ratio buckets and stored at
+    power-of-two heights in one uint8 file of shape (N, bytes_per_image). All images share
+    the same block layout, so a level is located by a constant offset inside its row.
+    Paint-time resizes start from the nearest larger level, and resized tiles are kept in
+    a small LRU cache keyed by (image, size). Given the paths of the image set it serves,
+    in retrieval model order, the atlas refuses to open when it was built from other images.
+    """
+    META = 'atlas.json'
+    DATA = 'atlas.dat'
+
+    def __init__(self, atlas_dir, cache_entries=4096, expected_paths=None):
+        self.atlas_dir = Path(atlas_dir)
+        with open(self.atlas_dir / self.META) as f:
+            meta = json.load(f)
+        self.aspects = meta['aspects']
+        self.levels = meta['levels']
+        self.paths = meta['paths']
+        if expected_paths is not None:
+            self.check_paths(expected_paths)
+        self.layout, self.bytes_per_image = self.make_layout(self.aspects, self.levels)
+        self.data = np.memmap(self.atlas_dir / self.DATA, dtype=np.uint8, mode='r',
+                              shape=(len(self.paths), self.bytes_per_image))
+        self.cache_entries = cache_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def check_paths(self, paths):
+        """ raise ValueError unless the atlas holds exactly these images, in this order """
+        paths = [os.path.realpath(p) for p in paths]
+        if paths != [os.path.realpath(p) for p in self.paths]:
+            raise ValueError('atlas {} was built from another set or order of images ({} vs {} images), '
+                             'rebuild it with retrieve/atlas.py'.format(self.atlas_dir, len(self.paths), len(paths)))
+
+    @staticmethod
+    def make_layout(aspects, levels):
+        """ {(bucket, level): (offset, shape)} inside an image row, and the row size in bytes """
+        layout, offset = {}, 0
+        for b, aspect in enumerate(aspects):
+            for level in levels:
+                shape = level_shape(aspect, level) + (3,)
+                layout[(b, level)] = (offset, shape)
+                offset += int(np.prod(shape))
+        return layout, offset
+
+    @classmethod
+    def build(cls, paths, atlas_dir, aspects=(0.75, 1.0, 4 / 3), levels=(3, 4, 5, 6), workers=None):
+        """ build the atlas of the given library images (in retrieval model order) """
+        atlas_dir = Path(atlas_dir)
+        atlas_dir.mkdir(parents=True, exist_ok=True)
+        paths = [str(p) for p in paths]
+        _, bytes_per_image = cls.make_layout(aspects, levels)
+        data = np.memmap(atlas_dir / cls.DATA, dtype=np.uint8, mode='w+',
+                         shape=(max(1, len(paths)), bytes_per_image))
+        del data
+        jobs = [(str(atlas_dir / cls.DATA), len(paths), i, p, list(aspects), list(levels))
+                for i, p in enumerate(paths)]
+        if workers == 1:
+            for job in jobs:
+                _build_row(job)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(_build_row, jobs, chunksize=64))
+        with open(atlas_dir / cls.META, 'w') as f:
+            json.dump({'version': 1, 'aspects': list(aspects), 'levels': list(levels), 'paths': paths}, f)
+        return cls(atlas_dir)
+
+    def bucket(self, size):
+        """ index of the aspect bucket closest to size (w, h) in log space """
+        aspect = np.log(size[0] / size[1])
+        return int(np.argmin([abs(aspect - np.log(a)) for a in self.aspects]))
+
+    def covers(self, size):
+        """ whether the largest level of size's bucket is at least size (w, h), i.e. get does not upsample """
+        lh, lw = level_shape(self.aspects[self.bucket(size)], self.levels[-1])
+        return lh >= size[1] and lw >= size[0]
+
+    def level(self, index, bucket, level):
+        offset, shape = self.layout[(bucket, level)]
+        return self.data[index, offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def get(self, index, size):
+        """ RGB uint8 array of image index resized to size (w, h) """
+        key = (int(index), int(size[0]), int(size[1]))
+        with self._lock:
+            tile = self._cache.get(key)
+            if tile is not None:
+                self._cache.move_to_end(key)
+                return tile
+        w, h = key[1:]
+        b = self.bucket((w, h))
+        # nearest level at least as large as the tile, or the largest one
+        level = self.levels[-1]
+        for candidate in self.levels:
+            lh, lw = level_shape(self.aspects[b], candidate)
+            if lh >= h and lw >= w:
+                level = candidate
+                break
+        src = self.level(key[0], b, level)
+        tile = src.copy() if src.shape[:2] == (h, w) else cv2.resize(src, (w, h), interpolation=cv2.INTER_AREA)
+        with self._lock:
+            self._cache[key] = tile
+            if len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+        return tile
+
+
+def _build_row(job):
+    data_path, n, index, path, aspects, levels = job
+    _, bytes_per_image = TileAtlas.make_layout(aspects, levels)
+    data = np.memmap(data_path, dtype=np.uint8, mode='r+', shape=(max(1, n), bytes_per_image))
+    with Image.open(path) as im:
+        # JPEG draft decoding, the largest level never needs the full resolution
+        top = 2 ** levels[-1]
+        im.draft('RGB', (int(top * max(aspects)), top))
+        image = np.asarray(im.convert('RGB'))
+    offset = 0
+    for aspect in aspects:
+        crop = center_crop(image, aspect)
+        for level in levels:
+            lh, lw = level_shape(aspect, level)
+            block = cv2.resize(crop, (lw, lh), interpolation=cv2.INTER_AREA)
+            data[index, offset:offset + block.size] = block.reshape(-1)
+            offset += block.size
+    data.flush()
+
+
+if __name__ == "__main__":
+    from retrieve.feature_store import FeatureStore
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset", help="path to dataset")
+    parser.add_argument("output", help="folder of the atlas")
+    parser.add_argument("--max_level", type=int, default=6, help="largest level is 2**max_level pixels high")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    # same image order as the retrieval model of replaceTile.prepare_model
+    store = FeatureStore(args.dataset)
+    store.update(workers=args.workers)
+    if store.dirty:
+        store.save()
+    paths = store.paths()
+    start = time.perf_counter()
+    atlas = TileAtlas.build(paths, args.output, levels=tuple(range(3, args.max_level + 1)), workers=args.workers)
+    print("Built atlas of {} images ({:.1f} MB) in {:.2f}s".format(
+        len(atlas), os.path.getsize(Path(args.output) / TileAtlas.DATA) / 2**20, time.perf_counter() - start))
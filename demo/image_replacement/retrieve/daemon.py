@@ -0,0 +1,320 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from retrieve.retriever import retrieve_batch, model_algorithm, extract_layouts
+from retrieve.index_file import open_library
+from retrieve.atlas import TileAtlas
+
+
+
+def runtime_dir():
+    """ per-user directory of the daemon socket: $XDG_RUNTIME_DIR, else ~/.cache """
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        return os.path.join(base, 'text2photomosaic')
+    return os.path.join(os.path.expanduser('~'), '.cache', 'text2photomosaic')
+
+
+DEFAULT_SOCKET = os.path.join(runtime_dir(), 'daemon.sock')
+
+
+def _encode(obj, arrays):
+    # JSON-able copy of obj with its numpy arrays moved to arrays
+    if isinstance(obj, np.ndarray):
+        arrays.append(obj)
+        return {'__array__': len(arrays) - 1}
+    if isinstance(obj, dict):
+        return {k: _encode(v, arrays) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(v, arrays) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def _decode(obj, arrays):
+    if isinstance(obj, dict):
+        if '__array__' in obj:
+            return arrays[obj['__array__']]
+        return {k: _decode(v, arrays) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_decode(v, arrays) for v in obj]
+    return obj
+
+
+def send_message(sock, obj):
+    """
+    length-prefixed JSON header of obj followed by the raw bytes of its numpy arrays
+
+    The header holds the dtype and shape of every array. Nothing on the wire is unpickled,
+    so a message can carry data but never code.
+    """
+    arrays = []
+    message = _encode(obj, arrays)
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    if any(a.dtype.hasobject for a in arrays):
+        raise TypeError('object arrays cannot be sent')
+    header = json.dumps({'message': message,
+                         'arrays': [[a.dtype.str, a.shape] for a in arrays]}).encode()
+    sock.sendall(b''.join([struct.pack('<Q', len(header)), header] + [a.tobytes() for a in arrays]))
+
+
+def _recv_exact(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    n, = struct.unpack('<Q', _recv_exact(sock, 8))
+    header = json.loads(_recv_exact(sock, n))
+    arrays = []
+    for dtype, shape in header['arrays']:
+        dtype = np.dtype(dtype)
+        if dtype.hasobject:
+            raise ValueError('object arrays are not accepted')
+        count = int(np.prod(shape, dtype=np.int64))
+        data = _recv_exact(sock, count * dtype.itemsize)
+        arrays.append(np.frombuffer(data, dtype=dtype, count=count).reshape(shape).copy())
+    return _decode(header['message'], arrays)
+
+
+def peer_uid(sock):
+    """ uid of the process at the other end of a Unix socket, None where SO_PEERCRED is missing """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    return uid
+
+
+class TileSource:
+    """
+    retrieval model, image set and resized-tile cache of a tile library, held in memory
+
+    Tiles are served from the mipmap atlas when there is one, otherwise resized from the
+    decoded images (kept in the image store's LRU cache) exactly as paint does, and the
+    resized tiles are kept in an LRU cache of their own. dataset is the library folder,
+    reported by info so that clients can tell which library they are served.
+    """
+    def __init__(self, model, images, atlas=None, cache_entries=65536, dataset=None):
+        self.model = model
+        self.images = images
+        self.atlas = atlas
+        self.dataset = None if dataset is None else os.path.realpath(dataset)
+        self.algorithm = model_algorithm(model)
+        self.cache_entries = cache_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._layouts = getattr(images, 'layouts', None)
+
+    def info(self):
+        return {'entries': len(self.images), 'algorithm': self.algorithm, 'atlas': self.atlas is not None,
+                'dataset': self.dataset, 'pid': os.getpid()}
+
+    def retrieve(self, colors, sizes, k=1, size_weight=None):
+        return retrieve_batch(colors, sizes, self.model, k=k, algorithm=self.algorithm, size_weight=size_weight)
+
+    def tile(self, index, size):
+        """ RGB uint8 array of image index resized to size (w, h) """
+        if self.atlas is not None and self.atlas.covers(size):
+            return self.atlas.get(index, size)
+        key = (int(index), int(size[0]), int(size[1]))
+        with self._lock:
+            tile = self._cache.get(key)
+            if tile is not None:
+                self._cache.move_to_end(key)
+                return tile
+        tile = cv2.resize(self.images.array(key[0]), key[1:])
+        with self._lock:
+            self._cache[key] = tile
+            if len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+        return tile
+
+    def tiles(self, indices, sizes):
+        return [self.tile(i, s) for i, s in zip(indices, sizes)]
+
+    def layouts(self):
+        if self._layouts is None:
+            self._layouts = extract_layouts(self.images)
+        return self._layouts
+
+    def handle(self, request):
+        op = request.pop('op')
+        if op == 'info':
+            return self.info()
+        if op == 'retrieve':
+            indices, distances = self.retrieve(**request)
+            return {'indices': indices, 'distances': distances}
+        if op == 'tiles':
+            return {'tiles': self.tiles(**request)}
+        if op == 'layouts':
+            return {'layouts': self.layouts()}
+        raise ValueError('unknown op {}'.format(op))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if peer_uid(self.connection) not in (None, os.getuid()):
+            return
+        while True:
+            try:
+                request = recv_message(self.connection)
+            except ConnectionError:
+                return
+            except (ValueError, KeyError, TypeError) as e:
+                # malformed message: the stream cannot be resynchronized, report and hang up
+                send_message(self.connection, {'error': 'malformed request, {}: {}'.format(type(e).__name__, e)})
+                return
+            try:
+                reply = self.server.source.handle(request)
+            except Exception as e:  # reported to the client, the daemon keeps serving
+                reply = {'error': '{}: {}'.format(type(e).__name__, e)}
+            send_message(self.connection, reply)
+
+
+class RetrievalServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Unix domain socket server of a TileSource, one thread per connection
+
+    The socket lives in a directory only its owner can enter (mode 0700), and
+    connections from other users are dropped.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, source):
+        socket_dir = os.path.dirname(os.path.abspath(socket_path))
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        if os.stat(socket_dir).st_uid != os.getuid():
+            raise PermissionError('{} is owned by another user'.format(socket_dir))
+        os.chmod(socket_dir, 0o700)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.source = source
+        super().__init__(socket_path, _Handler)
+        os.chmod(socket_path, 0o600)
+
+
+class RetrievalClient:
+    """
+    client of a retrieval daemon
+
+    It stands in for both the retrieval model (retrieve_batch) and the tile atlas (get) of
+    paint: retrieval runs in the daemon, and the tiles of a mosaic are fetched in one
+    request by prefetch before compositing. A daemon run by another user is refused with
+    PermissionError.
+    """
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=None):
+        self.socket_path = socket_path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(socket_path)
+        uid = peer_uid(self._sock)
+        if uid is None:
+            uid = os.stat(socket_path).st_uid
+        if uid != os.getuid():
+            self._sock.close()
+            raise PermissionError('retrieval daemon on {} runs as another user'.format(socket_path))
+        self._lock = threading.Lock()
+        self._tiles = {}
+
+    def _call(self, op, **kwargs):
+        with self._lock:
+            send_message(self._sock, dict(op=op, **kwargs))
+            reply = recv_message(self._sock)
+        if isinstance(reply, dict) and 'error' in reply:
+            raise RuntimeError('retrieval daemon: ' + reply['error'])
+        return reply
+
+    def info(self):
+        return self._call('info')
+
+    def retrieve_batch(self, colors, sizes, k=1, size_weight=None):
+        reply = self._call('retrieve', colors=np.asarray(colors), sizes=np.asarray(sizes), k=k,
+                           size_weight=size_weight)
+        return reply['indices'], reply['distances']
+
+    def layouts(self):
+        return self._call('layouts')['layouts']
+
+    def prefetch(self, indices, sizes):
+        """ fetch the resized tiles of a whole mosaic in one request, replacing the previous ones """
+        keys = list(dict.fromkeys((int(i), int(s[0]), int(s[1])) for i, s in zip(indices, sizes)))
+        self._tiles = {key: self._tiles[key] for key in keys if key in self._tiles}
+        missing = [key for key in keys if key not in self._tiles]
+        if missing:
+            tiles = self._call('tiles', indices=[k[0] for k in missing], sizes=[k[1:] for k in missing])['tiles']
+            self._tiles.update(zip(missing, tiles))
+
+    def get(self, index, size):
+        """ RGB uint8 array of image index resized to size (w, h), see TileAtlas.get """
+        key = (int(index), int(size[0]), int(size[1]))
+        tile = self._tiles.get(key)
+        if tile is None:
+            tile = self._call('tiles', indices=[key[0]], sizes=[key[1:]])['tiles'][0]
+            self._tiles[key] = tile
+        return tile
+
+    def clear(self):
+        self._tiles.clear()
+
+    def close(self):
+        self._sock.close()
+
+
+def connect(socket_path=DEFAULT_SOCKET):
+    """ client of the daemon listening on socket_path, None when no daemon is running """
+    try:
+        client = RetrievalClient(socket_path, timeout=60)
+    except OSError:
+        return None
+    try:
+        client.info()
+    except OSError:
+        client.close()
+        return None
+    return client
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset", help="path to dataset")
+    parser.add_argument("--model", help="path to the retrieval index folder", default="./model.idx")
+    parser.add_argument("--algorithm", help="retrieval algorithm of the index", default="kdtree")
+    parser.add_argument("--atlas", help="path to a mipmap atlas of the dataset", default=None)
+    parser.add_argument("--socket", help="path of the Unix domain socket", default=DEFAULT_SOCKET)
+    parser.add_argument("--cache_mb", type=int, default=1024, help="decoded image cache")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    model, images = open_library(args.model, args.dataset, algorithm=args.algorithm)
+    images.cache_bytes = args.cache_mb << 20
+    try:
+        atlas = TileAtlas(args.atlas, expected_paths=images.paths) if args.atlas else None
+    except ValueError as e:
+        parser.error(str(e))
+    source = TileSource(model, images, atlas=atlas, dataset=args.dataset)
+    source.layouts()
+    with RetrievalServer(args.socket, source) as server:
+        print("Serving {} images on {} (ready in {:.2f}s)".format(len(images), args.socket, time.perf_counter() - start))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.socket)
@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+from retrieve.retriever import extract_features_and_layouts, extract_layouts, build_model
+from retrieve.image_store import ImageStore
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FeatureStore:
+    """
+    on-disk feature store of a tile image library
+
+    The store keeps a manifest (relative path, size, mtime, content hash) next to the
+    raw (N, 5) feature matrix [r, g, b, width, height] and the (N, 48) uint8 layout
+    descriptors; row i of the matrices belongs to manifest entry i. Re-indexing only
+    extracts features for added or changed files.
+
+    Every save writes the three files to a new version folder and then points the CURRENT
+    file at it with one atomic rename, so a store on disk is always complete. A store that
+    is still inconsistent on load (e.g. one written by the older in-place save) is rebuilt.
+    """
+    MANIFEST = 'manifest.json'
+    FEATURES = 'features.npy'
+    LAYOUTS = 'layouts.npy'
+    CURRENT = 'CURRENT'
+    LAYOUT_GRID = 4
+
+    def __init__(self, image_folder, store_dir=None):
+        self.image_folder = Path(image_folder)
+        self.store_dir = Path(store_dir) if store_dir is not None else self.image_folder / '.features'
+        self.entries = []
+        self.features = np.zeros((0, 5), dtype=np.float64)
+        self.layouts = np.zeros((0, 3 * self.LAYOUT_GRID ** 2), dtype=np.uint8)
+        self.dirty = False
+        data_dir = self.data_dir()
+        if (data_dir / self.MANIFEST).exists():
+            self.load(data_dir)
+
+    def data_dir(self):
+        """ folder of the current version, the store folder itself for stores saved in place """
+        current = self.store_dir / self.CURRENT
+        if current.exists():
+            return self.store_dir / current.read_text().strip()
+        return self.store_dir
+
+    def load(self, data_dir):
+        try:
+            with open(data_dir / self.MANIFEST) as f:
+                entries = json.load(f)['entries']
+            features = np.load(data_dir / self.FEATURES)
+            # stores written before layouts existed get them on the next update
+            layouts = np.load(data_dir / self.LAYOUTS) if (data_dir / self.LAYOUTS).exists() else None
+        except (OSError, ValueError, KeyError) as e:
+            print("Feature store {} is unreadable ({}), rebuilding it".format(data_dir, e))
+            return
+        if len(entries) != len(features):
+            print("Feature store {} has {} entries for {} features, rebuilding it".format(
+                data_dir, len(entries), len(features)))
+            return
+        if layouts is not None and len(layouts) != len(features):
+            layouts = None
+        self.entries, self.features, self.layouts = entries, features, layouts
+
+    def __len__(self):
+        return len(self.entries)
+
+    def paths(self):
+        return [self.image_folder / e['path'] for e in self.entries]
+
+    def scan(self, recursive=False):
+        """ return {relative path: (size, mtime)} of the image files currently in the library """
+        found = {}
+        stack = [self.image_folder]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if recursive and not entry.name.startswith('.'):
+                            stack.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        st = entry.stat()
+                        rel = os.path.relpath(entry.path, self.image_folder)
+                        found[rel] = (st.st_size, st.st_mtime)
+        return found
+
+    def update(self, recursive=False, color_mode='histogram', workers=None):
+        """ bring the store in sync with the library folder
+
+        Returns:
+            dict: number of added, changed, removed and unchanged files
+        """
+        found = self.scan(recursive=recursive)
+        keep, stale = [], []
+        for i, e in enumerate(self.entries):
+            stat = found.pop(e['path'], None)
+            if stat is None:
+                continue
+            if (e['size'], e['mtime']) == stat:
+                keep.append(i)
+            else:
+                stale.append((i, stat))
+
+        # Size or mtime changed: only re-extract if the content really changed
+        changed = []
+        for i, (size, mtime) in stale:
+            e = self.entries[i]
+            digest = file_hash(self.image_folder / e['path'])
+            e['size'], e['mtime'] = size, mtime
+            if digest == e['hash']:
+                keep.append(i)
+            else:
+                e['hash'] = digest
+                changed.append(i)
+        removed = len(self.entries) - len(keep) - len(changed)
+
+        added = [{'path': rel, 'size': size, 'mtime': mtime,
+                  'hash': file_hash(self.image_folder / rel)}
+                 for rel, (size, mtime) in sorted(found.items())]
+        new_entries = [self.entries[i] for i in changed] + added
+        new_paths = [str(self.image_folder / e['path']) for e in new_entries]
+        new_features, new_layouts = extract_features_and_layouts(new_paths, color_mode=color_mode,
+                                                                 grid=self.LAYOUT_GRID, workers=workers)
+
+        keep.sort()
+        missing_layouts = self.layouts is None
+        if missing_layouts:
+            self.layouts = np.zeros((len(self.entries), 3 * self.LAYOUT_GRID ** 2), dtype=np.uint8)
+            self.layouts[keep] = extract_layouts([str(self.image_folder / self.entries[i]['path']) for i in keep],
+                                                 grid=self.LAYOUT_GRID, workers=workers)
+        self.layouts = self.layouts[keep]
+        self.entries = [self.entries[i] for i in keep] + new_entries
+        self.features = np.vstack([self.features[keep], new_features])
+        self.layouts = np.vstack([self.layouts, new_layouts])
+        self.check()
+        self.dirty = bool(stale or added or removed or missing_layouts)
+        return {'added': len(added), 'changed': len(changed), 'removed': removed, 'unchanged': len(keep)}
+
+    def add(self, paths, features, layouts=None):
+        """ append already-extracted features (and layouts) of files inside the library folder """
+        entries = []
+        for p in paths:
+            st = os.stat(p)
+            entries.append({'path': os.path.relpath(p, self.image_folder), 'size': st.st_size,
+                            'mtime': st.st_mtime, 'hash': file_hash(p)})
+        # stores without layouts are backfilled for their current entries only
+        if self.layouts is None:
+            self.layouts = extract_layouts([str(p) for p in self.paths()], grid=self.LAYOUT_GRID)
+        if layouts is None:
+            layouts = extract_layouts([str(p) for p in paths], grid=self.LAYOUT_GRID, workers=1)
+        self.entries.extend(entries)
+        self.features = np.vstack([self.features, np.asarray(features, dtype=np.float64).reshape(-1, 5)])
+        self.layouts = np.vstack([self.layouts, np.asarray(layouts, dtype=np.uint8)])
+        self.check()
+        self.dirty = True
+
+    def check(self):
+        """ raise ValueError unless the manifest, features and layouts have one row per entry """
+        rows = (len(self.entries), len(self.features), len(self.layouts))
+        if len(set(rows)) != 1:
+            raise ValueError("feature store rows out of sync: {} entries, {} features, {} layouts".format(*rows))
+
+    def save(self):
+        # Write a complete new version folder, then swap the CURRENT pointer to it in one
+        # os.replace: an interrupted save leaves the previous version in use
+        self.check()
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        previous = self.data_dir()
+        version = 'v{}'.format(time.time_ns())
+        version_dir = self.store_dir / version
+        version_dir.mkdir()
+        np.save(version_dir / self.FEATURES, self.features)
+        np.save(version_dir / self.LAYOUTS, self.layouts)
+        with open(version_dir / self.MANIFEST, 'w') as f:
+            json.dump({'version': 1, 'entries': self.entries}, f)
+        with open(self.store_dir / 'CURRENT.tmp', 'w') as f:
+            f.write(version)
+        os.replace(self.store_dir / 'CURRENT.tmp', self.store_dir / self.CURRENT)
+
+        # Older versions (and the files of an in-place store) are no longer referenced
+        if previous == self.store_dir:
+            for name in (self.MANIFEST, self.FEATURES, self.LAYOUTS):
+                (self.store_dir / name).unlink(missing_ok=True)
+        for path in self.store_dir.glob('v*'):
+            if path.is_dir() and path.name != version:
+                shutil.rmtree(path, ignore_errors=True)
+        self.dirty = False
+
+    def manifest_hash(self):
+        h = hashlib.blake2b(digest_size=16)
+        for e in self.entries:
+            h.update('{}\0{}\n'.format(e['path'], e['hash']).encode())
+        return h.hexdigest()
+
+    def build_model(self, algorithm='kdtree', size_weight=0.1):
+        return build_model(self.features, algorithm=algorithm, size_weight=size_weight)
+
+    def load_images(self, cache_bytes=256 << 20):
+        """ lazy image set in store order, with sizes, features and layouts taken from the store """
+        return ImageStore(self.paths(), sizes=self.features[:, 3:5], features=self.features,
+                          layouts=self.layouts, cache_bytes=cache_bytes)
+
+
+def index_library(image_folder, store_dir=None, algorithm='kdtree', size_weight=0.1,
+                  recursive=False, color_mode='histogram', workers=None):
+    """ incrementally re-index the library and rebuild the retrieval model from the stored features
+
+    Returns:
+        (_type_, FeatureStore): retrieve model, and the updated feature store
+    """
+    store = FeatureStore(image_folder, store_dir)
+    stats = store.update(recursive=recursive, color_mode=color_mode, workers=workers)
+    if store.dirty:
+        store.save()
+    print("Feature store: {added} added, {changed} changed, {removed} removed, {unchanged} unchanged".format(**stats))
+    return store.build_model(algorithm=algorithm, size_weight=size_weight), store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset", help="path to dataset")
+    parser.add_argument("--store", help="feature store folder, defaults to <dataset>/.features", default=None)
+    parser.add_argument("--algorithm", help="retrieval model to rebuild", default="kdtree")
+    parser.add_argument("--recursive", action="store_true", help="index sub-folders as well")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index_library(args.dataset, args.store, algorithm=args.algorithm, recursive=args.recursive, workers=args.workers)
+    print("Re-indexed in {:.2f}s".format(time.perf_counter() - start))
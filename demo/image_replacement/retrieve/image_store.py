@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+
+class ImageStore:
+    """
+    lazy image set of a tile library
+
+    Only the paths and cached metadata (size, features, layouts) are kept; images are
+    decoded on demand into an LRU cache bounded by bytes. Indexing returns the same record as the
+    eager load_images list, {"image": PIL.Image, "filename": str}, so it can be used as
+    a drop-in replacement.
+    """
+    def __init__(self, paths, sizes=None, features=None, layouts=None, cache_bytes=256 << 20):
+        self.paths = [Path(p) for p in paths]
+        self._sizes = None if sizes is None else np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+        self.features = features
+        self.layouts = layouts
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_folder(cls, image_folder, **kwargs):
+        return cls(sorted(f for f in Path(image_folder).iterdir() if f.is_file()), **kwargs)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return {"image": self.image(index), "filename": self.paths[index].name}
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def sizes(self):
+        """ (N, 2) sizes (width, height), read from the file headers only once """
+        if self._sizes is None:
+            sizes = []
+            for p in self.paths:
+                with Image.open(p) as im:
+                    sizes.append(im.size)
+            self._sizes = np.array(sizes, dtype=np.int64).reshape(-1, 2)
+        return self._sizes
+
+    def size(self, index):
+        return tuple(self.sizes()[index])
+
+    def image(self, index):
+        """ decoded PIL image, served from the LRU cache when possible """
+        with self._lock:
+            im = self._cache.get(index)
+            if im is not None:
+                self._cache.move_to_end(index)
+                return im
+        # Decode outside the lock so concurrent readers do not serialize on I/O
+        im = Image.open(self.paths[index])
+        im.load()
+        nbytes = im.width * im.height * len(im.getbands())
+        with self._lock:
+            if index not in self._cache:
+                self._cache[index] = im
+                self._cached_bytes += nbytes
+            while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+                _, old = self._cache.popitem(last=False)
+                self._cached_bytes -= old.width * old.height * len(old.getbands())
+        return im
+
+    def array(self, index):
+        return np.asarray(self.image(index))
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self._cached_bytes = 0
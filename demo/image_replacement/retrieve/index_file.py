@@ -0,0 +1,169 @@
+import json
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+import numpy as np
+import sklearn
+from sklearn.metrics import DistanceMetric
+from sklearn.neighbors import BallTree, KDTree
+
+try:
+    from retrieve.retriever import PlainIndex, model_algorithm
+    from retrieve.ann import IVFPQIndex
+    from retrieve.feature_store import FeatureStore
+except ImportError:  # run from inside retrieve/
+    from retriever import PlainIndex, model_algorithm
+    from ann import IVFPQIndex
+    from feature_store import FeatureStore
+
+INDEX_VERSION = 1
+META = 'meta.json'
+FEATURES = 'features.npy'
+# array part of the pickled state of sklearn's KDTree / BallTree, the rest are scalars
+TREE_ARRAYS = ('data', 'idx_array', 'node_data', 'node_bounds')
+TREE_SCALARS = ('leaf_size', 'n_levels', 'n_nodes', 'n_trims', 'n_leaves', 'n_splits', 'n_calls')
+TREES = {'kdtree': KDTree, 'balltree': BallTree}
+
+
+def save_index(model, index_dir, features, manifest_hash=None, size_weight=0.1):
+    """ write a retrieval model as a versioned index folder of raw arrays
+
+    The folder holds meta.json (format version, algorithm, library versions, manifest hash
+    of the indexed library) and one .npy file per array: the raw (N, 5) feature matrix and
+    the arrays of the model. Trees and IVF-PQ indexes are stored as raw arrays only, the
+    plain index is the feature matrix itself; 'knn' and 'svm' models are pickled.
+
+    Args:
+        model (_type_): retrieval model, see retrieve.retriever.build_model
+        index_dir (str): output folder, replaced if it exists
+        features (np.ndarray): raw (N, 5) feature matrix the model was built from
+        manifest_hash (str, optional): FeatureStore.manifest_hash of the library. Defaults to None.
+        size_weight (float, optional): size weight the model was built with. Defaults to 0.1.
+    """
+    index_dir = Path(index_dir)
+    tmp_dir = index_dir.with_name(index_dir.name + '.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    algorithm = model_algorithm(model)
+    meta = {'version': INDEX_VERSION, 'algorithm': algorithm, 'sklearn': sklearn.__version__,
+            'numpy': np.__version__, 'manifest_hash': manifest_hash, 'size_weight': size_weight,
+            'entries': len(features)}
+    np.save(tmp_dir / FEATURES, np.asarray(features, dtype=np.float64))
+
+    if algorithm in TREES:
+        state = model.__getstate__()
+        for name, array in zip(TREE_ARRAYS, state):
+            np.save(tmp_dir / (name + '.npy'), array)
+        meta['state'] = dict(zip(TREE_SCALARS, [int(x) for x in state[4:11]]))
+        meta['state_length'] = len(state)
+    elif algorithm == 'ivfpq':
+        state = {}
+        for name, value in vars(model).items():
+            if isinstance(value, np.ndarray):
+                np.save(tmp_dir / (name + '.npy'), value)
+            else:
+                state[name] = value
+        meta['state'] = state
+    elif algorithm != 'plain':
+        with open(tmp_dir / 'model.pkl', 'wb') as f:
+            pickle.dump(model, f)
+
+    with open(tmp_dir / META, 'w') as f:
+        json.dump(meta, f, indent=1)
+    # swap the complete folder in, an interrupted save leaves the old index intact
+    if index_dir.exists():
+        shutil.rmtree(index_dir)
+    os.replace(tmp_dir, index_dir)
+
+
+def read_meta(index_dir):
+    with open(Path(index_dir) / META) as f:
+        return json.load(f)
+
+
+def load_index(index_dir, manifest_hash=None, algorithm=None, mmap=True):
+    """ open an index folder written by save_index, arrays are memory-mapped
+
+    Args:
+        index_dir (str): index folder
+        manifest_hash (str, optional): expected manifest hash of the library, checked if given.
+        algorithm (str, optional): expected algorithm, checked if given.
+        mmap (bool, optional): memory-map the arrays instead of reading them. Defaults to True.
+
+    Raises:
+        FileNotFoundError: there is no index
+        ValueError: the index is stale or was written by an incompatible version
+
+    Returns:
+        (_type_, dict): retrieval model and the index metadata
+    """
+    index_dir = Path(index_dir)
+    meta = read_meta(index_dir)
+    if meta.get('version') != INDEX_VERSION:
+        raise ValueError("index format version {} is not {}".format(meta.get('version'), INDEX_VERSION))
+    if manifest_hash is not None and meta['manifest_hash'] != manifest_hash:
+        raise ValueError("index was built from another version of the library")
+    if algorithm is not None and meta['algorithm'] != algorithm:
+        raise ValueError("index holds a '{}' model, not '{}'".format(meta['algorithm'], algorithm))
+
+    mmap_mode = 'r' if mmap else None
+    load = lambda name: np.load(index_dir / (name + '.npy'), mmap_mode=mmap_mode)
+    algorithm = meta['algorithm']
+    if algorithm == 'plain':
+        model = PlainIndex(load('features'))
+    elif algorithm in TREES:
+        # the pickled tree state is sklearn-version specific
+        if meta['sklearn'] != sklearn.__version__:
+            raise ValueError("index was written by sklearn {}, this is {}".format(meta['sklearn'], sklearn.__version__))
+        state = [load(name) for name in TREE_ARRAYS] + [meta['state'][name] for name in TREE_SCALARS] + \
+            [DistanceMetric.get_metric('euclidean')]
+        state += [None] * (meta['state_length'] - len(state))
+        model = TREES[algorithm].__new__(TREES[algorithm])
+        model.__setstate__(tuple(state))
+    elif algorithm == 'ivfpq':
+        model = IVFPQIndex.__new__(IVFPQIndex)
+        model.__dict__.update(meta['state'])
+        for f in index_dir.glob('*.npy'):
+            if f.stem != 'features':
+                setattr(model, f.stem, load(f.stem))
+    else:
+        with open(index_dir / 'model.pkl', 'rb') as f:
+            model = pickle.load(f)
+    return model, meta
+
+
+def open_library(index_dir, image_folder, algorithm='kdtree', size_weight=0.1):
+    """ retrieval model and lazy image set of a tile library, indexing what changed
+
+    The library is brought in sync with its feature store, and the model is opened from
+    index_dir, or rebuilt from the stored features when it is missing, stale or of another
+    algorithm.
+
+    Raises:
+        ValueError: index_dir is a legacy pickled model file. Its indices follow the
+            directory listing order of the dataset at the time it was trained, which cannot
+            be checked against the store order of the image set.
+
+    Returns:
+        (_type_, ImageStore): retrieval model, and the image set in model order
+    """
+    if os.path.isfile(index_dir):
+        raise ValueError("{} is a legacy pickled model, its image order cannot be matched to the dataset. "
+                         "Pass an index folder path (e.g. ./model.idx) to rebuild it from the feature store."
+                         .format(index_dir))
+    store = FeatureStore(image_folder)
+    stats = store.update()
+    if store.dirty:
+        store.save()
+        print("Feature store: {added} added, {changed} changed, {removed} removed".format(**stats))
+    images = store.load_images()
+    try:
+        model, _ = load_index(index_dir, manifest_hash=store.manifest_hash(), algorithm=algorithm)
+        print("Index already exists, loading...")
+    except (FileNotFoundError, ValueError) as e:
+        print("Building index ({})...".format(e))
+        model = store.build_model(algorithm=algorithm, size_weight=size_weight)
+        save_index(model, index_dir, store.features, manifest_hash=store.manifest_hash(), size_weight=size_weight)
+    return model, images
@@ -0,0 +1,233 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from retrieve.retriever import image_features, COLOR_MODES
+from retrieve.feature_store import FeatureStore, IMAGE_EXTENSIONS
+
+
+def find_images(source):
+    """ relative paths of the image files below source, recursively, in sorted order """
+    found = []
+    for root, dirs, files in os.walk(source):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        found.extend(os.path.relpath(os.path.join(root, f), source)
+                     for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(found)
+
+
+def square_crops(image, height=200):
+    """ resize an image to the given height and slice it top to bottom into square crops
+
+    The last crop holds the remaining rows (up to a full square, aligned to the bottom);
+    images wider than high are kept whole.
+    """
+    h, w = image.shape[:2]
+    w = w * height / h
+    h = height
+    image = cv2.resize(image, (int(w), int(h)), interpolation=cv2.INTER_AREA)
+    crops = [image[int(i * w):int((i + 1) * w), 0:int(w)] for i in range(int(h / w))]
+    rest_h = h - int(h / w) * w
+    if rest_h > 0:
+        crops.append(image[int(h - rest_h):int(h), 0:int(w)])
+    return crops
+
+
+def crop_name(rel, index):
+    """ flat, stable file name of a crop of the source image rel
+
+    The short hash of rel keeps sources that flatten to the same stem apart (x.jpg and
+    x.png, a/b.jpg and a__b.jpg).
+    """
+    stem = os.path.splitext(rel)[0].replace(os.sep, '__').replace('/', '__')
+    digest = hashlib.blake2b(rel.replace(os.sep, '/').encode(), digest_size=4).hexdigest()
+    return '{}-{}-{}.jpg'.format(stem, digest, index)
+
+
+def check_crop_names(rels):
+    """ raise ValueError if two source images would write crops of the same name """
+    seen = {}
+    for rel in rels:
+        other = seen.setdefault(crop_name(rel, 0), rel)
+        if other != rel:
+            raise ValueError("{} and {} would write the same crops".format(other, rel))
+
+
+def _ingest_job(job):
+    source, rel, output, height, color_mode, grid = job
+    try:
+        with Image.open(os.path.join(source, rel)) as im:
+            # JPEG draft decoding at the smallest scale still at least `height` rows high
+            # once upright: the EXIF orientation (as cv2.imread applies it) swaps the sides
+            # of images stored rotated by 90 degrees
+            w, h = im.size
+            if im.getexif().get(0x0112) in (5, 6, 7, 8):
+                w, h = h, w
+            draft = (max(1, w * height // h), height)
+            im.draft('RGB', draft if (w, h) == im.size else draft[::-1])
+            image = np.asarray(ImageOps.exif_transpose(im).convert('RGB'))
+        records = []
+        for i, crop in enumerate(square_crops(image, height)):
+            name = crop_name(rel, i)
+            path = os.path.join(output, name)
+            cv2.imwrite(path, cv2.cvtColor(crop, cv2.COLOR_RGB2BGR))
+            # features of the written JPEG, exactly what a later re-index would compute
+            feature, layout = image_features(path, mode=color_mode, grid=grid)
+            records.append({'crop': name, 'feature': [float(x) for x in feature], 'layout': layout.tolist()})
+        return {'source': rel, 'crops': records}
+    except (OSError, ValueError, cv2.error) as e:
+        return {'source': rel, 'crops': [], 'error': str(e)}
+
+
+class Journal:
+    """
+    append-only record of the processed source images of an ingestion
+
+    Every line holds one source image with the names, features and layouts of its crops,
+    so an interrupted run resumes where it stopped and the feature store can always be
+    brought up to date from the journal alone. A source that failed is journaled with its
+    error and attempt count, and is retried by later runs until it has failed max_attempts
+    times.
+    """
+    NAME = 'ingest_journal.jsonl'
+
+    def __init__(self, store_dir, max_attempts=3):
+        self.path = Path(store_dir) / self.NAME
+        self.max_attempts = max_attempts
+        self.records = {}
+        if self.path.exists():
+            good = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    self.records[record['source']] = record
+                    good += len(line)
+            # drop the torn last line of an interrupted run
+            os.truncate(self.path, good)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'a')
+
+    def __contains__(self, rel):
+        """ whether rel is done: ingested, or failed max_attempts times """
+        record = self.records.get(rel)
+        if record is None:
+            return False
+        return 'error' not in record or self.attempts(rel) >= self.max_attempts
+
+    def attempts(self, rel):
+        """ number of failed attempts of rel so far, 0 once it was ingested """
+        record = self.records.get(rel)
+        if record is None or 'error' not in record:
+            return 0
+        # failures journaled before attempts were counted
+        return record.get('attempts', 1)
+
+    def append(self, record):
+        self.records[record['source']] = record
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def sync_store(store, journal):
+    """ append the journaled crops missing from the feature store, return their number """
+    known = {e['path'] for e in store.entries}
+    crops = [c for r in journal.records.values() for c in r['crops'] if c['crop'] not in known]
+    if crops:
+        store.add([str(store.image_folder / c['crop']) for c in crops],
+                  np.array([c['feature'] for c in crops], dtype=np.float64),
+                  np.array([c['layout'] for c in crops], dtype=np.uint8))
+        store.save()
+    return len(crops)
+
+
+def ingest(source, output, store_dir=None, height=200, color_mode='histogram', workers=None, save_every=1000,
+           max_attempts=3):
+    """ crop every image below source into output and index the crops, in a single pass
+
+    Args:
+        source (str): folder of source images, walked recursively
+        output (str): folder of the square crops, i.e. the tile library
+        store_dir (str, optional): feature store of the library. Defaults to <output>/.features.
+        height (int, optional): height the sources are resized to before cropping. Defaults to 200.
+        color_mode (str, optional): see retrieve.retriever.dominant_color. Defaults to 'histogram'.
+        workers (int, optional): process pool size, 1 runs serially. Defaults to os.cpu_count().
+        save_every (int, optional): source images between feature store saves. Defaults to 1000.
+        max_attempts (int, optional): runs a failing source image is tried in before it is
+            skipped, 1 skips every failed image. Defaults to 3.
+
+    Returns:
+        FeatureStore: the updated feature store of the library
+    """
+    os.makedirs(output, exist_ok=True)
+    store = FeatureStore(output, store_dir)
+    journal = Journal(store.store_dir, max_attempts=max_attempts)
+    # crops of a previous, interrupted run that never reached the store
+    resumed = sync_store(store, journal)
+    found = find_images(source)
+    check_crop_names(found)
+    todo = [rel for rel in found if rel not in journal]
+    print("Ingesting {} images ({} already done, {} crops recovered from the journal)".format(
+        len(todo), sum(rel in journal for rel in journal.records), resumed))
+
+    grid = FeatureStore.LAYOUT_GRID
+    jobs = [(str(source), rel, str(output), height, color_mode, grid) for rel in todo]
+    start = time.perf_counter()
+    n_crops, failed = 0, 0
+    pool = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    try:
+        results = pool.map(_ingest_job, jobs, chunksize=16) if pool else map(_ingest_job, jobs)
+        for i, record in enumerate(results, 1):
+            if 'error' in record:
+                # transient errors (a file still being copied, a timeout) get another run
+                record['attempts'] = journal.attempts(record['source']) + 1
+                failed += 1
+                print("Failed {} (attempt {} of {}{}): {}".format(
+                    record['source'], record['attempts'], max_attempts,
+                    ", skipped from now on" if record['attempts'] >= max_attempts else "", record['error']))
+            journal.append(record)
+            n_crops += len(record['crops'])
+            if i % save_every == 0:
+                sync_store(store, journal)
+                print("{} / {} images, {:.1f} images/s".format(i, len(jobs), i / (time.perf_counter() - start)))
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+        sync_store(store, journal)
+        journal.close()
+    elapsed = time.perf_counter() - start
+    print("Ingested {} images into {} crops in {:.2f}s, {:.1f} images/s ({} failed)".format(
+        len(jobs), n_crops, elapsed, len(jobs) / max(elapsed, 1e-9), failed))
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="folder of source images, walked recursively")
+    parser.add_argument("output", help="folder of the square crops (the tile library)")
+    parser.add_argument("--store", help="feature store folder, defaults to <output>/.features", default=None)
+    parser.add_argument("--height", type=int, default=200, help="height of the crops")
+    parser.add_argument("--color_mode", choices=COLOR_MODES, default="histogram")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--save_every", type=int, default=1000, help="images between feature store saves")
+    parser.add_argument("--max_attempts", type=int, default=3,
+                        help="runs a failing image is retried in before it is skipped")
+    parser.add_argument("--skip_failed", "--skip-failed", action="store_true",
+                        help="skip every image that failed in a previous run instead of retrying it")
+    args = parser.parse_args()
+
+    ingest(args.source, args.output, args.store, height=args.height, color_mode=args.color_mode,
+           workers=args.workers, save_every=args.save_every, max_attempts=1 if args.skip_failed else args.max_attempts)
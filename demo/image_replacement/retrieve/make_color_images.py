@@ -0,0 +1,33 @@
+import argparse
+import os
+
+import numpy as np
+from PIL import Image
+
+
+def generate_color_image(color, size):
+    image = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+    image[:, :] = color
+    return Image.fromarray(image)
+
+
+if __name__ == "__main__":
+    # Solid-color test images for the retrievers: red, green and blue, plus random colors
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image_dir", nargs="?", default="/content/images")
+    parser.add_argument("--random", type=int, default=100, help="number of random-color images")
+    parser.add_argument("--size", type=int, nargs=2, default=(100, 100))
+    args = parser.parse_args()
+
+    # Create the directory if it doesn't exist
+    os.makedirs(args.image_dir, exist_ok=True)
+
+    for name, color in zip(['red', 'green', 'blue'], [(255, 0, 0), (0, 255, 0), (0, 0, 255)]):
+        generate_color_image(color, args.size).save(os.path.join(args.image_dir, f"{name}.png"))
+
+    for i in range(args.random):
+        # Generate a random RGB color
+        color = np.random.randint(0, 256, size=3)
+        generate_color_image(color, args.size).save(os.path.join(args.image_dir, f"{i}.png"))
+
+    print("Images saved successfully.")
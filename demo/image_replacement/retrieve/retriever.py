@@ -1,59 +1,364 @@
 from pathlib import Path
 from PIL import Image
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.neighbors import KNeighborsClassifier, BallTree, KDTree
 from sklearn.svm import SVC
+from concurrent.futures import ProcessPoolExecutor
 import pickle
 import colorsys
+import cv2
 
-def dominant_color(image, k=3, n_init=10):
-    image_arr = np.array(image.convert('RGB')).reshape(-1, 3)
-    kmeans = KMeans(n_clusters=k, n_init=n_init).fit(image_arr)
-    # print (kmeans.cluster_centers_[0])
-    return kmeans.cluster_centers_[0]
+try:
+    from retrieve.image_store import ImageStore
+    from retrieve.ann import IVFPQIndex
+except ImportError:  # run from inside retrieve/
+    from image_store import ImageStore
+    from ann import IVFPQIndex
 
-def load_images(image_folder='/content/images'):
+COLOR_MODES = ('histogram', 'minibatch', 'kmeans')
+
+def thumbnail(image, max_size=64):
+    """ decode an image at reduced size and return it as an (H, W, 3) uint8 RGB array
+
+    JPEGs are decoded at a reduced scale via PIL draft mode, so the full-resolution
+    buffer is never materialized. Opened handles are reopened by filename so the
+    caller's handle is left untouched.
+    """
+    if isinstance(image, (str, Path)) or getattr(image, 'filename', None):
+        path = image if isinstance(image, (str, Path)) else image.filename
+        with Image.open(path) as im:
+            im.draft('RGB', (max_size, max_size))
+            im = im.convert('RGB')
+            im.thumbnail((max_size, max_size))
+            return np.asarray(im)
+    im = image.convert('RGB')
+    im.thumbnail((max_size, max_size))
+    return np.asarray(im)
+
+def thumbnail_pixels(image, max_size=64):
+    """ pixels of the reduced-size image as (N, 3) uint8, see thumbnail. Arrays are taken as already reduced """
+    arr = image if isinstance(image, np.ndarray) else thumbnail(image, max_size)
+    return np.ascontiguousarray(arr[:, :, :3]).reshape(-1, 3)
+
+def dominant_color(image, k=3, n_init=10, mode='histogram', max_size=64, bits=4):
+    """ return the color of the most populous cluster of the image
+
+    Args:
+        image (PIL.Image | str | np.ndarray): image handle, path, or RGB uint8 array
+        k (int, optional): number of clusters for the kmeans modes. Defaults to 3.
+        n_init (int, optional): kmeans restarts. Defaults to 10.
+        mode (str, optional): 'histogram' (quantized color histogram), 'minibatch'
+            (MiniBatchKMeans) or 'kmeans'. Defaults to 'histogram'.
+        max_size (int, optional): longest side the image is decoded at. Defaults to 64.
+        bits (int, optional): bits per channel kept by the histogram mode. Defaults to 4.
+
+    Returns:
+        np.ndarray: RGB color, shape (3,)
+    """
+    image_arr = thumbnail_pixels(image, max_size)
+    if mode == 'histogram':
+        q = (image_arr >> (8 - bits)).astype(np.int64)
+        codes = (q[:, 0] << (2 * bits)) | (q[:, 1] << bits) | q[:, 2]
+        counts = np.bincount(codes, minlength=1 << (3 * bits))
+        # mean of the pixels falling into the fullest bin, not the bin center
+        return image_arr[codes == np.argmax(counts)].mean(axis=0)
+    if mode == 'minibatch':
+        kmeans = MiniBatchKMeans(n_clusters=k, n_init=3, batch_size=1024, random_state=0).fit(image_arr)
+    elif mode == 'kmeans':
+        kmeans = KMeans(n_clusters=k, n_init=n_init).fit(image_arr)
+    else:
+        raise ValueError("Invalid mode specified. Use 'histogram', 'minibatch', or 'kmeans'.")
+    largest = np.argmax(np.bincount(kmeans.labels_, minlength=k))
+    return kmeans.cluster_centers_[largest]
+
+def _dominant_color_job(job):
+    path, mode = job
+    return dominant_color(path, mode=mode)
+
+def dominant_colors(images, mode='histogram', workers=None):
+    """ dominant color of every image, computed across a process pool
+
+    Args:
+        images (list): paths or image handles opened from files
+        mode (str, optional): see dominant_color. Defaults to 'histogram'.
+        workers (int, optional): pool size, 1 runs serially. Defaults to os.cpu_count().
+
+    Returns:
+        np.ndarray: colors, shape (N, 3)
+    """
+    paths = [str(img if isinstance(img, (str, Path)) else img.filename) for img in images]
+    if workers == 1 or len(paths) < 2:
+        colors = [dominant_color(p, mode=mode) for p in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            colors = list(pool.map(_dominant_color_job, [(p, mode) for p in paths], chunksize=64))
+    return np.array(colors, dtype=np.float64).reshape(-1, 3)
+
+def layout_descriptor(image, grid=4, max_size=64):
+    """ compact spatial color layout: grid x grid Lab means, flattened to uint8 (grid * grid * 3,)
+
+    Args:
+        image (PIL.Image | str | np.ndarray): image handle, path, or RGB uint8 array
+        grid (int, optional): cells per side. Defaults to 4.
+        max_size (int, optional): longest side the image is decoded at. Defaults to 64.
+    """
+    arr = image if isinstance(image, np.ndarray) else thumbnail(image, max_size)
+    lab = cv2.cvtColor(np.ascontiguousarray(arr[:, :, :3]), cv2.COLOR_RGB2Lab)
+    return cv2.resize(lab, (grid, grid), interpolation=cv2.INTER_AREA).reshape(-1)
+
+def _layout_job(job):
+    path, grid = job
+    return layout_descriptor(path, grid=grid)
+
+def extract_layouts(images, grid=4, workers=None):
+    """ (N, grid * grid * 3) uint8 layout descriptors of the given images, across a process pool """
+    if isinstance(images, ImageStore):
+        images = images.paths
+    paths = [str(img if isinstance(img, (str, Path)) else img.filename) for img in images]
+    if workers == 1 or len(paths) < 2:
+        layouts = [layout_descriptor(p, grid=grid) for p in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            layouts = list(pool.map(_layout_job, [(p, grid) for p in paths], chunksize=64))
+    return np.array(layouts, dtype=np.uint8).reshape(len(paths), grid * grid * 3)
+
+def image_features(path, mode='histogram', grid=4, max_size=64):
+    """ feature row [r, g, b, width, height] and layout descriptor of one image file, decoded once
+
+    Returns:
+        (np.ndarray, np.ndarray): features, shape (5,), and layout, shape (grid * grid * 3,)
+    """
+    with Image.open(path) as im:
+        size = im.size
+    arr = thumbnail(path, max_size)
+    feature = np.concatenate([dominant_color(arr, mode=mode), np.array(size, dtype=np.float64)])
+    return feature, layout_descriptor(arr, grid=grid)
+
+def _image_features_job(job):
+    path, mode, grid = job
+    return image_features(path, mode=mode, grid=grid)
+
+def extract_features_and_layouts(paths, color_mode='histogram', grid=4, workers=None):
+    """ raw (N, 5) feature matrix and (N, grid * grid * 3) uint8 layouts of the given image files
+
+    One pass over the files: every image is decoded once for both its color and its layout,
+    unlike extract_features followed by extract_layouts.
+    """
+    paths = [str(p) for p in paths]
+    if workers == 1 or len(paths) < 2:
+        rows = [image_features(p, mode=color_mode, grid=grid) for p in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(_image_features_job, [(p, color_mode, grid) for p in paths], chunksize=64))
+    features = np.array([f for f, _ in rows], dtype=np.float64).reshape(len(paths), 5)
+    layouts = np.array([l for _, l in rows], dtype=np.uint8).reshape(len(paths), grid * grid * 3)
+    return features, layouts
+
+def rerank_by_layout(indices, distances, query_layouts, layouts, layout_weight=1.0):
+    """ second retrieval stage: add the layout distance to the shortlisted candidates
+
+    Args:
+        indices (np.ndarray): (T, k) shortlisted candidates, see retrieve_batch
+        distances (np.ndarray): (T, k) first-stage distances
+        query_layouts (np.ndarray): (T, D) layout descriptors of the tiles' rendered regions
+        layouts (np.ndarray): (N, D) layout descriptors of the library
+        layout_weight (float, optional): weight of the layout term. Defaults to 1.0.
+
+    Returns:
+        (np.ndarray, np.ndarray): (T, k) candidates re-sorted by combined distance, and
+            the combined distances
+    """
+    cells = layouts.shape[1] // 3
+    diff = layouts[indices].astype(np.float32) - query_layouts[:, None, :].astype(np.float32)
+    # RMS distance per cell, in the same units as the single dominant color distance
+    layout_dist = np.sqrt((diff ** 2).sum(axis=-1) / cells)
+    combined = distances + layout_weight * layout_dist
+    order = np.argsort(combined, axis=1, kind='stable')
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(combined, order, axis=1)
+
+def load_images(image_folder='/content/images', lazy=True, cache_bytes=256 << 20):
+    if lazy:
+        return ImageStore.from_folder(image_folder, cache_bytes=cache_bytes)
     return [{"image": Image.open(f), "filename": f.name} for f in Path(image_folder).iterdir() if f.is_file()]
 
-def train_model(images, algorithm='plain', size_weight=0.1):
+def extract_features(images, color_mode='histogram', workers=None):
+    """ raw (N, 5) feature matrix [r, g, b, width, height] of the given image handles or paths """
+    if isinstance(images, ImageStore):
+        colors = dominant_colors(images.paths, mode=color_mode, workers=workers)
+        return np.hstack([colors, images.sizes().astype(np.float64)])
+    colors = dominant_colors(images, mode=color_mode, workers=workers)
+    sizes = []
+    for img in images:
+        if isinstance(img, (str, Path)):
+            with Image.open(img) as im:
+                sizes.append(im.size)
+        else:
+            sizes.append(img.size)
+    return np.hstack([colors, np.array(sizes, dtype=np.float64).reshape(-1, 2)])
+
+class PlainIndex:
+    """
+    exact brute-force search over a raw (N, 5) feature matrix, see extract_features
+
+    the distance is the color L2 distance plus size_weight times the L1 size difference,
+    evaluated for a whole batch of queries at once in chunks of bounded memory
+    """
+    def __init__(self, features, max_elements=1 << 22):
+        self.features = np.asarray(features, dtype=np.float64)
+        self.max_elements = max_elements
+
+    def __len__(self):
+        return len(self.features)
+
+    def query(self, colors, sizes, k=1, size_weight=0):
+        """
+        Args:
+            colors (np.ndarray): (T, 3) query colors
+            sizes (np.ndarray): (T, 2) query sizes
+            k (int, optional): number of neighbors. Defaults to 1.
+            size_weight (float, optional): weight of the size difference. Defaults to 0.
+
+        Returns:
+            (np.ndarray, np.ndarray): (T, k) distances and indices, nearest first
+        """
+        colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+        sizes = np.asarray(sizes, dtype=np.float64).reshape(-1, 2)
+        k = min(k, len(self.features))
+        lib_colors, lib_sizes = self.features[:, :3], self.features[:, 3:5]
+        distances = np.empty((len(colors), k))
+        indices = np.empty((len(colors), k), dtype=np.int64)
+        step = max(1, self.max_elements // max(1, len(self.features)))
+        for start in range(0, len(colors), step):
+            c, s = colors[start:start + step], sizes[start:start + step]
+            d = np.sqrt(((c[:, None, :] - lib_colors[None, :, :]) ** 2).sum(axis=-1))
+            if size_weight:
+                d += size_weight * np.abs(s[:, None, :] - lib_sizes[None, :, :]).sum(axis=-1)
+            if k == 1:
+                # np.argmin returns the first minimum, as the per-image loop did
+                idx = np.argmin(d, axis=1)[:, None]
+            else:
+                idx = np.argpartition(d, k - 1, axis=1)[:, :k] if k < d.shape[1] else \
+                    np.broadcast_to(np.arange(d.shape[1]), d.shape)
+                order = np.lexsort((idx, np.take_along_axis(d, idx, axis=1)), axis=1)
+                idx = np.take_along_axis(idx, order, axis=1)
+            dk = np.take_along_axis(d, idx, axis=1)
+            distances[start:start + step], indices[start:start + step] = dk, idx
+        return distances, indices
+
+def build_model(features, algorithm='kdtree', size_weight=0.1):
+    """ build a retrieval model from a raw (N, 5) feature matrix, see extract_features """
     if algorithm == 'plain':
-        return None
+        return PlainIndex(features)
 
-    features = [np.hstack([dominant_color(img['image']), img['image'].size[0] * size_weight, img['image'].size[1] * size_weight]) for img in images]
-    features = np.array(features)
+    features = np.hstack([features[:, :3], features[:, 3:5] * size_weight])
 
     if algorithm == 'knn':
-        model = KNeighborsClassifier(n_neighbors=1).fit(features, range(len(images)))
+        model = KNeighborsClassifier(n_neighbors=1).fit(features, range(len(features)))
     elif algorithm in ('balltree', 'kdtree'):
         model = {'balltree': BallTree, 'kdtree': KDTree}[algorithm](features)
     elif algorithm == 'svm':
-        model = SVC(kernel='linear', C=1).fit(features, range(len(images)))
+        model = SVC(kernel='linear', C=1).fit(features, range(len(features)))
+    elif algorithm == 'ivfpq':
+        model = IVFPQIndex().fit(features)
     else:
-        raise ValueError("Invalid algorithm specified. Use 'plain', 'knn', 'balltree', 'kdtree', or 'svm'.")
+        raise ValueError("Invalid algorithm specified. Use 'plain', 'knn', 'balltree', 'kdtree', 'ivfpq', or 'svm'.")
 
     return model
 
+def train_model(images, algorithm='plain', size_weight=0.1, color_mode='histogram', workers=None):
+    if not isinstance(images, ImageStore):
+        images = [img['image'] for img in images]
+    features = extract_features(images, color_mode=color_mode, workers=workers)
+    return build_model(features, algorithm=algorithm, size_weight=size_weight)
+
+# (image set, PlainIndex) of the last image set query_model had to index itself
+_plain_index = (None, None)
+
+def plain_index(images):
+    """ PlainIndex of an image set, from its stored features if any, built once per image set """
+    global _plain_index
+    cached_images, index = _plain_index
+    if cached_images is not images or len(index) != len(images):
+        features = getattr(images, 'features', None)
+        index = PlainIndex(features) if features is not None else train_model(images, algorithm='plain')
+        _plain_index = (images, index)
+    return index
+
 def query_model(model, images, target_color, target_size, algorithm='plain', size_weight=0):
     if algorithm == 'plain':
-        size_diffs = [np.linalg.norm(target_color - dominant_color(img['image'])) + size_weight * (abs(target_size[0] - img['image'].size[0]) + abs(target_size[1] - img['image'].size[1])) for img in images]
-        closest_img = images[np.argmin(size_diffs)]
-        return closest_img["image"]
+        if not isinstance(model, PlainIndex):
+            # no precomputed features, the library is indexed on the first query only
+            model = plain_index(images)
+        _, index = model.query([target_color], [target_size], k=1, size_weight=size_weight)
+        return images[index[0, 0]]["image"]
 
     query_point = np.hstack([target_color, target_size[0] * size_weight, target_size[1] * size_weight])
 
     if algorithm in ('knn', 'svm'):
         index = model.predict([query_point])[0]
-    elif algorithm in ('balltree', 'kdtree'):
+    elif algorithm in ('balltree', 'kdtree', 'ivfpq'):
         index = model.query([query_point], return_distance=False)[0][0]
     else:
-        raise ValueError("Invalid algorithm specified. Use 'plain', 'knn', 'balltree', 'kdtree', or 'svm'.")
+        raise ValueError("Invalid algorithm specified. Use 'plain', 'knn', 'balltree', 'kdtree', 'ivfpq', or 'svm'.")
 
     return images[index]["image"]
 
 def retrieve_API(target_color, target_size, model, images, algorithm='plain'):
     return query_model(model, images, target_color, target_size, algorithm=algorithm)
 
+def model_algorithm(model):
+    """ name of the algorithm a retrieval model was built with """
+    for cls, name in ((PlainIndex, 'plain'), (KDTree, 'kdtree'), (BallTree, 'balltree'),
+                      (IVFPQIndex, 'ivfpq'), (KNeighborsClassifier, 'knn'), (SVC, 'svm')):
+        if isinstance(model, cls):
+            return name
+    raise ValueError("Unknown retrieval model type: {}".format(type(model).__name__))
+
+def retrieve_batch(colors, sizes, model, k=1, algorithm=None, size_weight=None):
+    """ retrieve the k closest library images for a whole batch of tiles in one query
+
+    Args:
+        colors (np.ndarray): (T, 3) tile colors
+        sizes (np.ndarray): (T, 2) tile sizes (width, height)
+        model (_type_): retrieval model, see build_model, or a retrieve.daemon.RetrievalClient
+        k (int, optional): number of candidates per tile. Defaults to 1.
+        algorithm (str, optional): algorithm of the model, inferred when None.
+        size_weight (float, optional): weight of the size term. Defaults to 0 for 'plain'
+            (as retrieve_API) and to 0.1 for the other models (as train_model).
+
+    Returns:
+        (np.ndarray, np.ndarray): (T, k) indices into the image set, and their distances
+            (NaN for 'svm', which does not provide any)
+    """
+    if hasattr(model, 'retrieve_batch'):
+        # client of a retrieval daemon, see retrieve.daemon
+        return model.retrieve_batch(colors, sizes, k=k, size_weight=size_weight)
+    algorithm = algorithm or model_algorithm(model)
+    colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+    sizes = np.asarray(sizes, dtype=np.float64).reshape(-1, 2)
+    if size_weight is None:
+        size_weight = 0 if algorithm == 'plain' else 0.1
+
+    if algorithm == 'plain':
+        distances, indices = model.query(colors, sizes, k=k, size_weight=size_weight)
+        return indices, distances
+
+    query_points = np.hstack([colors, sizes * size_weight])
+    if algorithm in ('balltree', 'kdtree', 'ivfpq'):
+        distances, indices = model.query(query_points, k=k)
+    elif algorithm == 'knn':
+        distances, indices = model.kneighbors(query_points, n_neighbors=k)
+        indices = model.classes_[indices]
+    elif algorithm == 'svm':
+        if k != 1:
+            raise ValueError("'svm' can only retrieve a single candidate per tile.")
+        indices = model.predict(query_points).reshape(-1, 1)
+        distances = np.full(indices.shape, np.nan)
+    else:
+        raise ValueError("Invalid algorithm specified. Use 'plain', 'knn', 'balltree', 'kdtree', 'ivfpq', or 'svm'.")
+    return np.asarray(indices, dtype=np.int64), distances
+
 if __name__ == "__main__":
     image_folder = './dataset_demo'
     algorithm = 'kdtree'
@@ -12,195 +12,106 @@ def build_image_pyramid(image, levels=4):
         pyramid.append(image)
     return pyramid
   
-def get_dominant_color(image):
+def get_dominant_color(image, bits=8):
+    """ mode color of the image, counted over packed 24-bit codes
+
+    bits < 8 quantizes each channel first (the returned color is the center of the winning
+    bin); bits=8 gives exactly the most frequent color, ties going to the smallest code
+    """
+    shift = 8 - bits
     if len(image.shape) == 2:
         # Grayscale image
-        pixel_count = np.zeros(256)
-        for pixel_value in image.flatten():
-            pixel_count[pixel_value] += 1
-        index = np.argmax(pixel_count)
+        counts = np.bincount(image.reshape(-1).astype(np.int64) >> shift, minlength=1 << bits)
+        index = (np.argmax(counts) << shift) + ((1 << shift) >> 1)
         r, g, b = index, index, index
     elif len(image.shape) == 3 and image.shape[2] == 3:
         # RGB image
-        pixel_count = np.zeros((256, 256, 256))
-        for r, g, b in image.reshape(-1, 3):
-            pixel_count[r, g, b] += 1
-        indices = np.unravel_index(np.argmax(pixel_count), pixel_count.shape)
-        r, g, b = indices[0], indices[1], indices[2]
+        q = image.reshape(-1, 3).astype(np.int64) >> shift
+        codes = (q[:, 0] << (2 * bits)) | (q[:, 1] << bits) | q[:, 2]
+        if bits <= 5:
+            code = np.argmax(np.bincount(codes, minlength=1 << (3 * bits)))
+        else:
+            # a dense 2**24 histogram would cost 128 MB per call, count the present codes only
+            values, counts = np.unique(codes, return_counts=True)
+            code = values[np.argmax(counts)]
+        mask = (1 << bits) - 1
+        half = (1 << shift) >> 1
+        r = (((code >> (2 * bits)) & mask) << shift) + half
+        g = (((code >> bits) & mask) << shift) + half
+        b = ((code & mask) << shift) + half
     else:
         raise ValueError("Unsupported image format. Expected RGB or grayscale image.")
     
     return np.array([r, g, b])
 
 
+def build_pyramid_index(image_dir, index_path=None, levels=4, bits=8):
+    """ compute the mode color and size of every pyramid level of every image once
 
-def retrieve_closest_image(target_color, target_size, image_dir):
-    min_distance = float('inf')
-    closest_image_path = None
-    
-    for file_name in os.listdir(image_dir):
+    Returns:
+        dict: paths (F,), and per level: file_ids (F*L,), rank (F*L,) (0 is the smallest level),
+            colors (F*L, 3), sizes (F*L, 2)
+    """
+    paths, files, ranks, colors, sizes = [], [], [], [], []
+    for file_name in sorted(os.listdir(image_dir)):
         if file_name.endswith('.png') or file_name.endswith('.jpg'):
             file_path = os.path.join(image_dir, file_name)
             try:
                 img = np.array(Image.open(file_path))
-            except:
+                pyramid = build_image_pyramid(img, levels)
+                level_colors = [get_dominant_color(level, bits) for level in pyramid[::-1]]
+            except Exception:
                 continue
-            
-            img_size = (img.shape[1], img.shape[0])
-            pyramid = build_image_pyramid(img)
-            
-            for i, level in enumerate(pyramid[::-1]):
-                level_size = (level.shape[1], level.shape[0])
-                if i == 0:
-                    distance_weight = 1.0
-                else:
-                    distance_weight = 0.1
-                size_weight = ((level_size[0] / target_size[0]) + (level_size[1] / target_size[1])) * 0.1
-                
-                dominant_color = get_dominant_color(level)
-                distance = np.linalg.norm(dominant_color - target_color)
-                total_distance = distance * distance_weight + size_weight
-                
-                if total_distance < min_distance:
-                    min_distance = total_distance
-                    closest_image_path = file_path
-    
-    return closest_image_path
-
-target_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]  # sequence of RGB colors
-target_size = (100, 100)  # Example target size
-image_dir = '/content/images'
-
-for color in target_colors:
-    closest_image_path = retrieve_closest_image(color, target_size, image_dir)
-    
-    if closest_image_path is not None:
-        closest_image = Image.open(closest_image_path)
-        closest_image.show() 
-    else:
-        print("No closest image found for the color:", color)
-
-from pathlib import Path
-from PIL import Image
-import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.neighbors import KNeighborsClassifier, BallTree, KDTree
-from sklearn.svm import SVC
-import pickle
-
-def dominant_color(image, k=3, n_init=10, color_space='RGB'):
-    if color_space.upper() == 'HSV':
-        image = image.convert('HSV')
-    elif color_space.upper() != 'RGB':
-        raise ValueError("Invalid color space specified. Use 'RGB' or 'HSV'.")
-    image_arr = np.array(image).reshape(-1, 3)
-    kmeans = KMeans(n_clusters=k, n_init=n_init).fit(image_arr)
-    return kmeans.cluster_centers_[0]
-
-def load_images(image_folder='/content/images'):
-    return [{"image": Image.open(f), "filename": f.name} for f in Path(image_folder).iterdir() if f.is_file()]
-
-def train_model(images, algorithm='plain', size_weight=0.1, color_space='RGB'):
-    if algorithm == 'plain':
+            for i, (level, color) in enumerate(zip(pyramid[::-1], level_colors)):
+                files.append(len(paths))
+                ranks.append(i)
+                colors.append(color)
+                sizes.append((level.shape[1], level.shape[0]))
+            paths.append(file_path)
+    index = {
+        'paths': np.array(paths),
+        'file_ids': np.array(files, dtype=np.int64),
+        'rank': np.array(ranks, dtype=np.int64),
+        'colors': np.array(colors, dtype=np.float64).reshape(-1, 3),
+        'sizes': np.array(sizes, dtype=np.float64).reshape(-1, 2),
+    }
+    if index_path is not None:
+        np.savez(index_path, **index)
+    return index
+
+
+def load_pyramid_index(index_path):
+    with np.load(index_path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def retrieve_closest_image(target_color, target_size, index):
+    """ vectorized scan over a pyramid index, see build_pyramid_index
+
+    the score of a level is its color distance (weighted 1.0 for the smallest level and 0.1
+    for the others) plus 0.1 times the relative size, as in the per-file search
+    """
+    if isinstance(index, str):
+        index = load_pyramid_index(index) if index.endswith('.npz') else build_pyramid_index(index)
+    if len(index['file_ids']) == 0:
         return None
-
-    features = [np.hstack([dominant_color(img['image'], color_space=color_space), img['image'].size[0] * size_weight, img['image'].size[1] * size_weight]) for img in images]
-    features = np.array(features)
-
-    if algorithm == 'knn':
-        model = KNeighborsClassifier(n_neighbors=1).fit(features, range(len(images)))
-    elif algorithm in ('balltree', 'kdtree'):
-        model = {'balltree': BallTree, 'kdtree': KDTree}[algorithm](features)
-    elif algorithm == 'svm':
-        model = SVC(kernel='linear', C=1).fit(features, range(len(images)))
-    else:
-        raise ValueError("Invalid algorithm specified. Use 'plain', 'knn', 'balltree', 'kdtree', or 'svm'.")
-
-    return model
-
-def query_model(model, images, target_color, target_size, algorithm='plain', size_weight=0.1, color_space='RGB'):
-    if algorithm == 'plain':
-        size_diffs = [np.linalg.norm(target_color - dominant_color(img['image'], color_space=color_space)) + size_weight * (abs(target_size[0] - img['image'].size[0]) + abs(target_size[1] - img['image'].size[1])) for img in images]
-        closest_img = images[np.argmin(size_diffs)]
-        return closest_img["image"]
-
-    query_point = np.hstack([target_color, target_size[0] * size_weight, target_size[1] * size_weight])
-
-    if algorithm in ('knn', 'svm'):
-        index = model.predict([query_point])[0]
-    elif algorithm in ('balltree', 'kdtree'):
-        index = model.query([query_point], return_distance=False)[0][0]
-    else:
-        raise ValueError("Invalid algorithm specified. Use 'plain', 'knn', 'balltree', 'kdtree', or 'svm'.")
-
-    return images[index]["image"]
-
-def retrieve_API(target_color, target_size, model, images, algorithm='plain', color_space='RGB'):
-    return query_model(model, images, target_color, target_size, algorithm=algorithm, color_space=color_space)
+    distance = np.linalg.norm(index['colors'] - np.asarray(target_color, dtype=np.float64), axis=1)
+    distance_weight = np.where(index['rank'] == 0, 1.0, 0.1)
+    size_weight = ((index['sizes'][:, 0] / target_size[0]) + (index['sizes'][:, 1] / target_size[1])) * 0.1
+    total_distance = distance * distance_weight + size_weight
+    return str(index['paths'][index['file_ids'][np.argmin(total_distance)]])
 
 if __name__ == "__main__":
-    image_folder = '/content/images'
-    algorithm = 'svm'
-    color_space = 'RGB' #HSV sometimes works not so well
-
-    images = load_images(image_folder)
-    model = train_model(images, algorithm=algorithm, color_space=color_space)
-
-    with open('model.pkl', 'wb') as f:
-        pickle.dump(model, f)
-
-    with open('model.pkl', 'rb') as f:
-        loaded_model = pickle.load(f)
-
-    query_colors = [np.array([100, 150, 200]), np.array([255, 20, 10]), np.array([10, 255, 20])]
-    query_sizes = [(600, 400), (800, 600), (1024, 768)]
-
-    for query_color, query_size in zip(query_colors, query_sizes):
-        retrieved_image = retrieve_API(query_color, query_size, loaded_model, images, algorithm=algorithm, color_space=color_space)
-        print(f"Closest image (Color: {query_color}, Size: {query_size}): {retrieved_image.filename}")
-        retrieved_image.show()
-
-import numpy as np
-from PIL import Image
-import os
-
-def generate_color_image(color, size):
-    image = np.zeros((size[1], size[0], 3), dtype=np.uint8)
-    image[:, :] = color
-    return Image.fromarray(image)
-
-target_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
-target_size = (100, 100)
-image_dir = '/content/images'
-
-# Create the directory if it doesn't exist
-os.makedirs(image_dir, exist_ok=True)
-
-for i, color in enumerate(target_colors):
-    image = generate_color_image(color, target_size)
-    image_path = os.path.join(image_dir, f"{['red', 'green', 'blue'][i]}.png")
-    image.save(image_path)
-
-import numpy as np
-from PIL import Image
-import os
-
-def generate_color_image(color, size):
-    image = np.zeros((size[1], size[0], 3), dtype=np.uint8)
-    image[:, :] = color
-    return Image.fromarray(image)
-
-target_size = (100, 100)
-image_dir = '/content/images'
-
-# Create the directory if it doesn't exist
-os.makedirs(image_dir, exist_ok=True)
-
-for i in range(100):
-    # Generate a random RGB color
-    color = np.random.randint(0, 256, size=3)
-    image = generate_color_image(color, target_size)
-    image_path = os.path.join(image_dir, f"{i}.png")
-    image.save(image_path)
-
-print("Images saved successfully.")
\ No newline at end of file
+    target_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]  # sequence of RGB colors
+    target_size = (100, 100)  # Example target size
+    image_dir = '/content/images'
+
+    index = build_pyramid_index(image_dir, os.path.join(image_dir, 'pyramid_index.npz'))
+    for color in target_colors:
+        closest_image_path = retrieve_closest_image(color, target_size, index)
+
+        if closest_image_path is not None:
+            closest_image = Image.open(closest_image_path)
+            closest_image.show() 
+        else:
+            print("No closest image found for the color:", color)
@@ -0,0 +1,155 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+
+class PNGStreamWriter:
+    """
+    8-bit RGB PNG written strip by strip, top to bottom
+
+    Rows are Sub-filtered and deflated incrementally, every strip becomes one IDAT chunk,
+    so only the current strip is ever held in memory.
+    """
+    def __init__(self, path, width, height, level=1):
+        self.width, self.height = width, height
+        self.rows = 0
+        self._z = zlib.compressobj(level)
+        self._file = open(path, 'wb')
+        self._file.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self._file.write(struct.pack('>I', len(data)) + kind + data)
+        self._file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write(self, rows):
+        """ append (n, width, 3) RGB uint8 rows """
+        rows = np.ascontiguousarray(rows, dtype=np.uint8).reshape(-1, self.width * 3)
+        filtered = np.empty((len(rows), self.width * 3 + 1), dtype=np.uint8)
+        # filter type 1 (Sub): difference to the same channel of the previous pixel
+        filtered[:, 0] = 1
+        filtered[:, 1:4] = rows[:, :3]
+        np.subtract(rows[:, 3:], rows[:, :-3], out=filtered[:, 4:])
+        data = self._z.compress(filtered.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+        self.rows += len(rows)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._chunk(b'IDAT', self._z.flush())
+        self._chunk(b'IEND', b'')
+        self._file.close()
+        if self.rows != self.height:
+            raise ValueError('wrote {} rows of a {} rows PNG'.format(self.rows, self.height))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # on an error the partial file is left unterminated, the row count check would hide it
+        if exc[0] is not None:
+            self._file.close()
+        else:
+            self.close()
+
+
+class TIFFStreamWriter:
+    """
+    uncompressed 8-bit RGB baseline TIFF written strip by strip, top to bottom
+
+    Strips are appended as they come; the directory with their offsets is written last.
+    Classic TIFF offsets are 32 bits, so the image must stay below 4 GB.
+    """
+    def __init__(self, path, width, height):
+        if width * height * 3 >= 2 ** 32 - 4096:
+            raise ValueError('image too large for a classic TIFF, write a PNG instead')
+        self.width, self.height = width, height
+        self.rows = 0
+        self._strips = []
+        self._file = open(path, 'wb')
+        # little-endian header, the directory offset is patched in close()
+        self._file.write(b'II*\x00' + struct.pack('<I', 0))
+
+    def write(self, rows):
+        """ append (n, width, 3) RGB uint8 rows """
+        data = np.ascontiguousarray(rows, dtype=np.uint8).tobytes()
+        self._strips.append((self._file.tell(), len(data), len(rows)))
+        self._file.write(data)
+        self.rows += len(rows)
+
+    def close(self):
+        if self._file.closed:
+            return
+        f = self._file
+        if f.tell() % 2:
+            f.write(b'\x00')
+        bits_offset = f.tell()
+        f.write(struct.pack('<3H', 8, 8, 8))
+        offsets_offset = f.tell()
+        f.write(struct.pack('<{}I'.format(len(self._strips)), *[s[0] for s in self._strips]))
+        counts_offset = f.tell()
+        f.write(struct.pack('<{}I'.format(len(self._strips)), *[s[1] for s in self._strips]))
+        rows_per_strip = max([s[2] for s in self._strips] + [1])
+
+        def long_or_offset(values, offset):
+            # a single value is stored in the entry itself
+            return values[0] if len(values) == 1 else offset
+
+        n = len(self._strips)
+        entries = [
+            (256, 4, 1, self.width),                                        # ImageWidth
+            (257, 4, 1, self.height),                                       # ImageLength
+            (258, 3, 3, bits_offset),                                       # BitsPerSample
+            (259, 3, 1, 1),                                                 # Compression: none
+            (262, 3, 1, 2),                                                 # Photometric: RGB
+            (273, 4, n, long_or_offset([s[0] for s in self._strips], offsets_offset)),  # StripOffsets
+            (277, 3, 1, 3),                                                 # SamplesPerPixel
+            (278, 4, 1, rows_per_strip),                                    # RowsPerStrip
+            (279, 4, n, long_or_offset([s[1] for s in self._strips], counts_offset)),   # StripByteCounts
+            (284, 3, 1, 1),                                                 # PlanarConfiguration
+        ]
+        ifd_offset = f.tell()
+        f.write(struct.pack('<H', len(entries)))
+        for tag, kind, count, value in entries:
+            if kind == 3 and count == 1:
+                f.write(struct.pack('<HHIHH', tag, kind, count, value, 0))
+            else:
+                f.write(struct.pack('<HHII', tag, kind, count, value))
+        f.write(struct.pack('<I', 0))
+        f.seek(4)
+        f.write(struct.pack('<I', ifd_offset))
+        f.close()
+        if self.rows != self.height:
+            raise ValueError('wrote {} rows of a {} rows TIFF'.format(self.rows, self.height))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # on an error the partial file is left unterminated, the row count check would hide it
+        if exc[0] is not None:
+            self._file.close()
+        else:
+            self.close()
+
+
+STREAM_EXTENSIONS = ('.png', '.tif', '.tiff')
+
+
+def check_stream_path(path):
+    """ raise ValueError unless path has an extension open_stream_writer can write """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in STREAM_EXTENSIONS:
+        raise ValueError('no streaming writer for {}, use .png or .tif'.format(ext or path))
+
+
+def open_stream_writer(path, width, height):
+    """ streaming RGB writer for path, chosen by its extension (.png, .tif, .tiff) """
+    check_stream_path(path)
+    if os.path.splitext(path)[1].lower() == '.png':
+        return PNGStreamWriter(path, width, height)
+    return TIFFStreamWriter(path, width, height)
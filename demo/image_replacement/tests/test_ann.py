@@ -0,0 +1,26 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from retrieve.ann import IVFPQIndex  # noqa: E402
+
+
+def test_query_widens_probe_for_large_k():
+    # 16 lists of ~20 vectors probed one at a time hold fewer than k = 50 candidates
+    rng = np.random.default_rng(0)
+    X = rng.uniform(0, 255, (300, 5))
+    index = IVFPQIndex(n_lists=16, n_bits=4, nprobe=1, rerank=0).fit(X)
+    distances, indices = index.query(X[:10], k=50)
+    assert indices.shape == (10, 50)
+    assert (indices >= 0).all() and np.isfinite(distances).all()
+    assert all(len(set(row)) == 50 for row in indices.tolist())
+
+
+def test_query_rejects_k_larger_than_index():
+    X = np.random.default_rng(0).uniform(0, 255, (20, 5))
+    index = IVFPQIndex(n_lists=4, n_bits=2, nprobe=1).fit(X)
+    with pytest.raises(ValueError):
+        index.query(X[:1], k=21)
@@ -0,0 +1,426 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import torch
+
+from scorer import load_scorer, SCORER_BACKENDS
+
+
+def bench_scorer(args):
+    # Throughput of encode_images per backend, with and without gradients
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    batch = torch.rand(args.batch_size, 3, 224, 224, device=device)
+    for backend in args.backends:
+        scorer = load_scorer(backend, device)
+        for grad in (False, True):
+            if grad and backend in ("traced_frozen", "quantized"):
+                continue
+            images = batch.clone().requires_grad_(grad)
+            with torch.set_grad_enabled(grad):
+                scorer.encode_images(images)  # warm-up
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    features = scorer.encode_images(images)
+                    if grad:
+                        features.sum().backward()
+                elapsed = time.perf_counter() - start
+            print(
+                "{:>14s} grad={:<5} {:8.1f} images/s".format(
+                    backend, str(grad), args.batch_size * args.repeat / elapsed
+                )
+            )
+
+
+def run_target(**kwargs):
+    # target_best_params.generate in a scratch folder, quietly, with its run time
+    import target_best_params
+
+    with tempfile.TemporaryDirectory() as results_path:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = target_best_params.generate(
+                results_path=os.path.join(results_path, ""), video=False, **kwargs
+            )
+    return result, time.perf_counter() - start
+
+
+def bench_init(args):
+    # Iterations until the pixel loss reaches the threshold, per initialization
+    for init in args.inits:
+        torch.manual_seed(args.seed)
+        result, elapsed = run_target(
+            target_image=args.target_image,
+            num_iterations=args.num_iterations,
+            init=init,
+            loss_threshold=args.loss_threshold,
+        )
+        print(
+            "{:>7s} iterations to {}: {} final pixel loss {:.5f} ({:.1f}s)".format(
+                init,
+                args.loss_threshold,
+                result["iterations_to_threshold"],
+                result["pixel_loss"],
+                elapsed,
+            )
+        )
+
+
+def bench_layout(args):
+    # Grid against quadtree at the same tile count: pixel loss of the layout filled
+    # with its mean colors, after num_iterations, and after the same wall-clock time
+    from target_best_params import load_target
+    from layout import grid_layout, quadtree_layout, variance_cost
+    from block_stats import BlockStats
+
+    stats = BlockStats(load_target(args.target_image))
+    width, height = stats.width, stats.height
+    grid = grid_layout(width, height, width // 10, height // 10)
+    layouts = {
+        "grid": grid,
+        "quadtree": quadtree_layout(width, height, len(grid), variance_cost(stats)),
+    }
+    for name, cells in layouts.items():
+        print(
+            "{:>8s} {} tiles, mean colors: pixel loss {:.5f}".format(
+                name, len(cells), stats.pixel_loss(cells)
+            )
+        )
+
+    seconds = args.seconds
+    for name in layouts:
+        torch.manual_seed(args.seed)
+        result, elapsed = run_target(
+            target_image=args.target_image,
+            num_iterations=args.num_iterations,
+            init=args.init,
+            layout=name,
+        )
+        seconds = seconds or elapsed
+        print(
+            "{:>8s} {} iterations: pixel loss {:.5f} ({:.1f}s)".format(
+                name, result["iterations"], result["pixel_loss"], elapsed
+            )
+        )
+    for name in layouts:
+        torch.manual_seed(args.seed)
+        result, elapsed = run_target(
+            target_image=args.target_image,
+            num_iterations=10 * args.num_iterations,
+            init=args.init,
+            layout=name,
+            max_seconds=seconds,
+        )
+        print(
+            "{:>8s} {:.1f}s: pixel loss {:.5f} ({} iterations)".format(
+                name, seconds, result["pixel_loss"], result["iterations"]
+            )
+        )
+
+
+def rss_mb(field):
+    # VmRSS / VmHWM (peak) of this process in MB, from /proc
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+
+
+def bench_memory_run(args):
+    # One configuration of bench_memory: peak memory above the loaded model and
+    # time of a cal_loss forward and backward pass
+    from clip_best_params import augment_transform
+    from utils import cal_loss
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    scorer = load_scorer(
+        args.backend, device, activation_checkpointing=args.activation_checkpointing
+    )
+    coe_dict = {
+        "neg_clip_coe": 0.3,
+        "delta_coe": torch.tensor([0.0, 0.0]),
+        "displacement_coe": torch.tensor([0.0, 0.0]),
+        "angle_coe": torch.tensor(0.0),
+        "image_coe": torch.tensor(0.0),
+        "overlap_coe": torch.tensor(0.0),
+        "neighbor_num": 1,
+        "neighbor_coe": torch.tensor(0.0),
+        "joint_coe": torch.tensor(0.0),
+        "threshold": "mean",
+    }
+    with torch.no_grad():
+        text_features = scorer.encode_text("a red heart")
+        text_features_neg = scorer.encode_text("an ugly, messy picture.")
+    image = torch.rand(224, 224, 4, device=device, requires_grad=True)
+    augment_trans = augment_transform()
+
+    # Writing 5 to clear_refs resets the peak RSS of the process
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    baseline = rss_mb("VmRSS")
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated() / 2**20
+    times = []
+    for _ in range(args.repeat + 1):
+        start = time.perf_counter()
+        loss, _ = cal_loss(
+            image,
+            [],
+            [],
+            scorer,
+            text_features,
+            coe_dict,
+            use_aug=True,
+            augment_trans=augment_trans,
+            use_neg=True,
+            text_features_neg=text_features_neg,
+            verbose=False,
+            num_augs=args.num_augs,
+            micro_batch=args.micro_batch or None,
+        )
+        loss.backward()
+        image.grad = None
+        times.append(time.perf_counter() - start)
+    peak = rss_mb("VmHWM")
+    if device == "cuda":
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    print(
+        json.dumps(
+            {"peak_mb": peak - baseline, "seconds": sum(times[1:]) / args.repeat}
+        )
+    )
+
+
+def bench_memory(args):
+    # Peak memory against iteration time of cal_loss per configuration, every
+    # configuration in a fresh process so that peaks do not carry over
+    print(
+        "{:>8s} {:>5s} {:>11s} {:>9s} {:>10s}".format(
+            "views", "ckpt", "micro_batch", "peak MB", "s / iter"
+        )
+    )
+    for num_augs, checkpointing, micro_batch in itertools.product(
+        args.num_augs, (False, True), args.micro_batches
+    ):
+        if micro_batch >= num_augs:
+            continue
+        command = [
+            sys.executable,
+            __file__,
+            "memory_run",
+            "--backend",
+            args.backend,
+            "--num_augs",
+            str(num_augs),
+            "--micro_batch",
+            str(micro_batch),
+            "--repeat",
+            str(args.repeat),
+        ]
+        if checkpointing:
+            command.append("--activation_checkpointing")
+        output = subprocess.run(
+            command, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            "{:>8d} {:>5s} {:>11s} {:>9.1f} {:>10.3f}".format(
+                num_augs,
+                "on" if checkpointing else "off",
+                str(micro_batch or "-"),
+                result["peak_mb"],
+                result["seconds"],
+            )
+        )
+
+
+def tile_mosaic(colors, size=224, cell=16, fill=14):
+    # NCHW image of a grid of square tiles of the given (rows, columns, 3) colors
+    # on white, fill of every cell pixels wide as clip_best_params lays them out
+    mask = (torch.arange(cell) < fill).float()
+    mask = (mask[:, None] * mask[None, :]).repeat(size // cell, size // cell)
+    tiles = colors.repeat_interleave(cell, 0).repeat_interleave(cell, 1)
+    image = mask[..., None] * tiles + 1 - mask[..., None]
+    return image.permute(2, 0, 1).unsqueeze(0)
+
+
+def delete_candidates(colors, alive):
+    # The mosaic with every alive tile deleted in turn, as delete_rect_iter ranks
+    batch = []
+    for i, j in alive:
+        candidate = colors.clone()
+        candidate[i, j] = 1.0
+        batch.append(tile_mosaic(candidate))
+    return torch.cat(batch)
+
+
+def clip_losses(scorer, text_features, images, batch_size):
+    # pos_clip_loss of every image, batch_size images per encode_images call
+    with torch.no_grad():
+        features = torch.cat(
+            [scorer.encode_images(batch) for batch in images.split(batch_size)]
+        )
+        return -torch.cosine_similarity(text_features, features.float(), dim=1)
+
+
+def rank_correlation(a, b):
+    # Spearman correlation of two 1-D tensors (ties are rare for float losses)
+    ranks_a = a.argsort().argsort().double()
+    ranks_b = b.argsort().argsort().double()
+    return torch.corrcoef(torch.stack([ranks_a, ranks_b]))[0, 1].item()
+
+
+def bench_ranking(args):
+    # fp32 CLIP against the int8 quantized scorer on the post-processing
+    # candidate sets: speed per candidate, agreement of the candidate rankings
+    # and of the accept decision (margin EPS, as in delete_rect_iter)
+    from scorer import QuantizedCLIPScorer
+
+    EPS = 2e-4
+    torch.manual_seed(args.seed)
+    scorer = load_scorer("clip", "cpu")
+    scorers = {"fp32": scorer, "int8": QuantizedCLIPScorer(scorer.model)}
+    with torch.no_grad():
+        text_features = scorer.encode_text(args.prompt).float()
+
+    seconds = {name: 0.0 for name in scorers}
+    candidates = 0
+    spearman, top1, top5, accept, verified = [], 0, [], 0, 0
+    for _ in range(args.mosaics):
+        # A partly post-processed mosaic: args.tiles random tiles left on white
+        colors = torch.rand(14 * 14, 3)
+        kept = torch.randperm(14 * 14)[: args.tiles]
+        colors[~torch.isin(torch.arange(14 * 14), kept)] = 1.0
+        colors = colors.reshape(14, 14, 3)
+        alive = [(k // 14, k % 14) for k in kept.tolist()]
+        images = torch.cat([tile_mosaic(colors), delete_candidates(colors, alive)])
+        losses = {}
+        for name, s in scorers.items():
+            clip_losses(s, text_features, images[:1], args.batch_size)  # warm-up
+            start = time.perf_counter()
+            losses[name] = clip_losses(s, text_features, images, args.batch_size)
+            seconds[name] += time.perf_counter() - start
+        candidates += len(images)
+
+        fp32, int8 = losses["fp32"], losses["int8"]
+        spearman.append(rank_correlation(fp32[1:], int8[1:]))
+        best_fp32, best_int8 = fp32[1:].argmin(), int8[1:].argmin()
+        top1 += int(best_fp32 == best_int8)
+        top5_fp32 = set(fp32[1:].topk(5, largest=False).indices.tolist())
+        top5_int8 = set(int8[1:].topk(5, largest=False).indices.tolist())
+        top5.append(len(top5_fp32 & top5_int8) / 5)
+        accept_fp32 = fp32[1 + best_fp32] < fp32[0] - EPS
+        accept_int8 = int8[1 + best_int8] < int8[0] - EPS
+        accept += int(accept_fp32 == accept_int8)
+        # The int8 choice, re-checked in fp32 as postprocess_* verify=True does
+        verified += int(accept_int8 and fp32[1 + best_int8] < fp32[0] - EPS)
+
+    for name in scorers:
+        print(
+            "{:>5s} {:8.2f} ms / candidate".format(
+                name, 1000 * seconds[name] / candidates
+            )
+        )
+    print("speedup: {:.2f}x".format(seconds["fp32"] / seconds["int8"]))
+    print(
+        "Spearman {:.3f} (min {:.3f}), top-1 agreement {:.2f}, top-5 overlap {:.2f}, "
+        "accept agreement {:.2f}, int8 accepts confirmed in fp32 {}".format(
+            sum(spearman) / len(spearman),
+            min(spearman),
+            top1 / args.mosaics,
+            sum(top5) / len(top5),
+            accept / args.mosaics,
+            verified,
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_scorer = subparsers.add_parser("scorer", help="scorer backend throughput")
+    parser_scorer.add_argument(
+        "--backends", nargs="+", choices=SCORER_BACKENDS, default=list(SCORER_BACKENDS)
+    )
+    parser_scorer.add_argument("--batch_size", type=int, default=4)
+    parser_scorer.add_argument("--repeat", type=int, default=10)
+    parser_scorer.set_defaults(func=bench_scorer)
+
+    parser_init = subparsers.add_parser(
+        "init", help="iterations to a pixel loss threshold per tile initialization"
+    )
+    parser_init.add_argument("--target_image", default="inputs/target_exp1.png")
+    parser_init.add_argument(
+        "--inits", nargs="+", choices=("random", "mean"), default=["random", "mean"]
+    )
+    parser_init.add_argument("--num_iterations", type=int, default=300)
+    parser_init.add_argument("--loss_threshold", type=float, default=0.01)
+    parser_init.add_argument("--seed", type=int, default=0)
+    parser_init.set_defaults(func=bench_init)
+
+    parser_layout = subparsers.add_parser(
+        "layout", help="grid against quadtree tile layout at equal tile count"
+    )
+    parser_layout.add_argument("--target_image", default="inputs/target_exp1.png")
+    parser_layout.add_argument(
+        "--init", choices=("random", "mean"), default="mean", help="tile colors"
+    )
+    parser_layout.add_argument("--num_iterations", type=int, default=100)
+    parser_layout.add_argument(
+        "--seconds", type=float, default=None, help="defaults to the grid's run time"
+    )
+    parser_layout.add_argument("--seed", type=int, default=0)
+    parser_layout.set_defaults(func=bench_layout)
+
+    parser_memory = subparsers.add_parser(
+        "memory",
+        help="peak memory against iteration time, activation checkpointing and "
+        "micro-batching of the augmented views",
+    )
+    parser_memory.add_argument(
+        "--backend", choices=("clip", "dummy"), default="clip"
+    )
+    parser_memory.add_argument("--num_augs", type=int, nargs="+", default=[4, 8, 16])
+    parser_memory.add_argument(
+        "--micro_batches",
+        type=int,
+        nargs="+",
+        default=[0, 1, 4],
+        help="0 scores all views in one batch",
+    )
+    parser_memory.add_argument("--repeat", type=int, default=3)
+    parser_memory.set_defaults(func=bench_memory)
+
+    parser_memory_run = subparsers.add_parser(
+        "memory_run", help="one configuration of memory, run in its own process"
+    )
+    parser_memory_run.add_argument("--backend", default="clip")
+    parser_memory_run.add_argument("--num_augs", type=int, default=4)
+    parser_memory_run.add_argument("--micro_batch", type=int, default=0)
+    parser_memory_run.add_argument("--activation_checkpointing", action="store_true")
+    parser_memory_run.add_argument("--repeat", type=int, default=3)
+    parser_memory_run.set_defaults(func=bench_memory_run)
+
+    parser_ranking = subparsers.add_parser(
+        "ranking",
+        help="fp32 against int8 quantized CLIP on post-processing candidates",
+    )
+    parser_ranking.add_argument("--prompt", default="a red heart")
+    parser_ranking.add_argument("--mosaics", type=int, default=5)
+    parser_ranking.add_argument(
+        "--tiles", type=int, default=60, help="tiles left in every mosaic"
+    )
+    parser_ranking.add_argument("--batch_size", type=int, default=16)
+    parser_ranking.add_argument("--seed", type=int, default=0)
+    parser_ranking.set_defaults(func=bench_ranking)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,92 @@
+import torch
+
+
+# ----------------------- Block statistics -----------------------
+#
+# Summed-area tables (integral images) of an image and of its square, built
+# once, answer the sum, mean, variance and squared error to the mean of any
+# axis-aligned rectangle with four lookups. Rectangles are (x, y, width, height)
+# cells as in layout.py; parts outside the image are ignored.
+
+
+class BlockStats:
+    def __init__(self, image):
+        # image is HxWxC (or HxW), the tables are accumulated in float64 so that
+        # differences of large sums stay exact enough for variances
+        if image.dim() == 2:
+            image = image.unsqueeze(-1)
+        self.height, self.width, self.channels = image.shape
+        image = image.detach().to(torch.float64)
+        self.sat = self._table(image)
+        self.sat_sq = self._table(image**2)
+
+    @staticmethod
+    def _table(image):
+        table = torch.zeros(
+            image.shape[0] + 1, image.shape[1] + 1, image.shape[2], dtype=image.dtype
+        )
+        table[1:, 1:] = image.cumsum(0).cumsum(1)
+        return table
+
+    def _bounds(self, cells):
+        cells = torch.as_tensor(cells, dtype=torch.int64).reshape(-1, 4)
+        x0 = cells[:, 0].clamp(0, self.width)
+        y0 = cells[:, 1].clamp(0, self.height)
+        x1 = (cells[:, 0] + cells[:, 2]).clamp(0, self.width)
+        y1 = (cells[:, 1] + cells[:, 3]).clamp(0, self.height)
+        return x0, y0, x1, y1
+
+    def _lookup(self, table, cells):
+        x0, y0, x1, y1 = self._bounds(cells)
+        return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+    def areas(self, cells):
+        x0, y0, x1, y1 = self._bounds(cells)
+        return ((x1 - x0) * (y1 - y0)).to(torch.float64)
+
+    def sums(self, cells):
+        # (N, C) sums of every cell
+        return self._lookup(self.sat, cells)
+
+    def mean(self, cells):
+        # (N, C) mean colors, zero for empty cells
+        return self.sums(cells) / self.areas(cells).clamp(min=1).unsqueeze(1)
+
+    def variance(self, cells):
+        # (N, C) per-channel variances
+        areas = self.areas(cells).clamp(min=1).unsqueeze(1)
+        mean = self.sums(cells) / areas
+        return (self._lookup(self.sat_sq, cells) / areas - mean**2).clamp(min=0)
+
+    def sse(self, cells):
+        # (N,) squared error of filling every cell with its mean color
+        return (self.variance(cells) * self.areas(cells).unsqueeze(1)).sum(1)
+
+    def grid(self, columns, rows):
+        # columns x rows cells covering the image exactly, column by column; cell
+        # edges are spread evenly, so sizes that are not multiples are handled
+        xs = torch.arange(columns + 1) * self.width // columns
+        ys = torch.arange(rows + 1) * self.height // rows
+        x0, y0 = torch.meshgrid(xs[:-1], ys[:-1], indexing="ij")
+        w, h = torch.meshgrid(xs.diff(), ys.diff(), indexing="ij")
+        return torch.stack([x0, y0, w, h], -1).reshape(-1, 4)
+
+    def pixel_loss(self, cells):
+        # Pixel loss of the image flattened to the mean colors of the cells, as
+        # target_best_params computes it. The cells are assumed not to overlap.
+        return self.sse(cells).sum().item() / (self.width * self.height)
+
+    def sweep(self, sizes):
+        # Pixel loss of the n x n grid for every n in sizes, in one batched pass
+        grids = [self.grid(n, n) for n in sizes]
+        sse = self.sse(torch.cat(grids)).split([len(g) for g in grids])
+        return [s.sum().item() / (self.width * self.height) for s in sse]
+
+    def fill(self, cells, colors=None):
+        # HxWxC image of the cells painted with colors, by default their means
+        colors = self.mean(cells) if colors is None else colors
+        image = torch.zeros(self.height, self.width, self.channels)
+        x0, y0, x1, y1 = self._bounds(cells)
+        for i in range(len(colors)):
+            image[y0[i] : y1[i], x0[i] : x1[i]] = colors[i].float()
+        return image
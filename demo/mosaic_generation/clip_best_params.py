@@ -1,7 +1,15 @@
 from subprocess import call
 import pydiffvg
 import torch
-from my_shape import PolygonRect, RotationalShapeGroup
+from layout import (
+    LAYOUTS,
+    grid_layout,
+    quadtree_layout,
+    saliency_cost,
+    saliency_map,
+    make_tiles,
+)
+from block_stats import BlockStats
 from utils import (
     cal_loss,
     postprocess_delete_rect,
@@ -9,285 +17,402 @@ from utils import (
     render_image,
 )
 import torchvision.transforms as transforms
-import clip
+from scorer import load_scorer, QuantizedCLIPScorer, SCORER_BACKENDS
 from torch.optim.lr_scheduler import StepLR
 import os
 import pickle
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "--prompt", help="prompt for mosaic generation", default="a red heart"
-)
-args = parser.parse_args()
-
 RESULTS_PATH = "../results/clip/"
 PKLS_PATH = os.path.join(RESULTS_PATH, "pkls")
+BEST_PARAMS_PATH = os.path.join(PKLS_PATH, "clip_best_params.pkl")
+NEG_PROMPT = "an ugly, messy picture."
+
+DEFAULT_PARAMS = {
+    "delta_lr": 0.01,
+    "angle_lr": 0.01,
+    "tranlation_lr": 0.01,
+    "color_lr": 0.01,
+    "neg_clip_coe": 0.3,
+    "reg_delta_coe_x": 1e-4,
+    "reg_delta_coe_y": 1e-4,
+    "reg_displacement_coe_x": 0.0,
+    "reg_displacement_coe_y": 0.0,
+    "angle_coe": 0.0,
+    "image_coe": 0.0,
+    "overlap_coe": 1e-4,
+    "neighbor_num": 1,
+    "neighbor_coe": 0.0,
+    "joint_coe": 1e-4,
+}
 
-# Create folder for saving results
-if not os.path.exists(PKLS_PATH):
-    print("Creating folder for saving results...")
-    os.makedirs(PKLS_PATH)
 
-# Load the best parameters
-if os.path.exists(os.path.join(PKLS_PATH, "clip_best_params.pkl")):
-    print("Loading best parameters...")
-    best_params = pickle.load(
-        open(os.path.join(PKLS_PATH, "clip_best_params.pkl"), "rb")
+def load_params(params_path=BEST_PARAMS_PATH, overrides=None):
+    # Best parameters of clip_find_best_params.py if they exist, else the defaults
+    if os.path.exists(params_path):
+        print("Loading best parameters...")
+        params = pickle.load(open(params_path, "rb"))
+        print("Best parameters: ")
+        print(params)
+    else:
+        print("No best parameters found, using default parameters...")
+        params = dict(DEFAULT_PARAMS)
+    params.update(overrides or {})
+
+    lrs = {
+        name: params[name]
+        for name in ("delta_lr", "angle_lr", "tranlation_lr", "color_lr")
+    }
+    coe_dict = {
+        "neg_clip_coe": params["neg_clip_coe"],
+        "delta_coe": torch.tensor(
+            [params["reg_delta_coe_x"], params["reg_delta_coe_y"]],
+            dtype=torch.float32,
+        ),
+        "displacement_coe": torch.tensor(
+            [params["reg_displacement_coe_x"], params["reg_displacement_coe_y"]],
+            dtype=torch.float32,
+        ),
+        "angle_coe": torch.tensor(params["angle_coe"], dtype=torch.float32),
+        "image_coe": torch.tensor(params["image_coe"], dtype=torch.float32),
+        "overlap_coe": torch.tensor(params["overlap_coe"], dtype=torch.float32),
+        "neighbor_num": params["neighbor_num"],
+        "neighbor_coe": torch.tensor(params["neighbor_coe"], dtype=torch.float32),
+        "joint_coe": torch.tensor(params["joint_coe"], dtype=torch.float32),
+        "threshold": "mean",
+    }
+    return lrs, coe_dict
+
+
+def augment_transform():
+    # Image Augmentation Transformation
+    return transforms.Compose(
+        [
+            transforms.RandomPerspective(fill=1, p=1, distortion_scale=0.5),
+            transforms.RandomResizedCrop(224, scale=(0.7, 0.9)),
+            transforms.Normalize(
+                (0.48145466, 0.4578275, 0.40821073),
+                (0.26862954, 0.26130258, 0.27577711),
+            ),
+        ]
     )
-    print("Best parameters: ")
-    print(best_params)
 
-    delta_lr = best_params["delta_lr"]
-    angle_lr = best_params["angle_lr"]
-    tranlation_lr = best_params["tranlation_lr"]
-    color_lr = best_params["color_lr"]
 
-    neg_clip_coe = best_params["neg_clip_coe"]
-
-    delta_coe = torch.tensor(
-        [best_params["reg_delta_coe_x"], best_params["reg_delta_coe_y"]],
-        dtype=torch.float32,
-    )
-    displacement_coe = torch.tensor(
-        [best_params["reg_displacement_coe_x"], best_params["reg_displacement_coe_y"]],
-        dtype=torch.float32,
+def generate(
+    prompt,
+    scorer,
+    results_path=RESULTS_PATH,
+    params_path=BEST_PARAMS_PATH,
+    overrides=None,
+    num_iterations=1000,
+    neg_prompt=NEG_PROMPT,
+    video=True,
+    layout="grid",
+    tile_budget=None,
+    num_augs=4,
+    micro_batch=None,
+    ranking_scorer=None,
+    verify_ranking=False,
+):
+    # Optimize a 14x14 grid of tiles towards the prompt, or with layout="quadtree"
+    # an adaptive layout of tile_budget tiles, then post-process it. The scorer is
+    # passed in so that it can be loaded once and reused across runs. num_augs
+    # views are scored per iteration, micro_batch at a time if it is set.
+    # ranking_scorer, e.g. a QuantizedCLIPScorer, ranks the post-processing
+    # candidates instead of scorer; verify_ranking re-checks its choices in fp32.
+    if layout not in LAYOUTS:
+        raise ValueError("Invalid layout. Use 'grid' or 'quadtree'.")
+    pkls_path = os.path.join(results_path, "pkls")
+
+    # Create folder for saving results
+    if not os.path.exists(pkls_path):
+        print("Creating folder for saving results...")
+        os.makedirs(pkls_path)
+
+    lrs, coe_dict = load_params(params_path, overrides)
+
+    with torch.no_grad():
+        text_features = scorer.encode_text(prompt)
+        text_features_neg = scorer.encode_text(neg_prompt)
+
+    gamma = 1.0
+    render = pydiffvg.RenderFunction.apply
+
+    canvas_width, canvas_height = 224, 224
+
+    augment_trans = augment_transform()
+
+    # 14x14 tiles with a 2 pixel gap, or as many laid out by a quadtree
+    cells = grid_layout(canvas_width, canvas_height, 16, 16)
+    if layout == "quadtree":
+        # Split where the similarity to the prompt is most sensitive to the
+        # pixels of a blank gray canvas
+        blank = torch.full(
+            (1, 3, canvas_height, canvas_width), 0.5, device=pydiffvg.get_device()
+        )
+        saliency = saliency_map(scorer, text_features, blank, augment_trans)
+        cells = quadtree_layout(
+            canvas_width,
+            canvas_height,
+            tile_budget or len(cells),
+            saliency_cost(BlockStats(saliency)),
+        )
+    shapes, shape_groups = make_tiles(
+        cells, canvas_width, canvas_height, fill=14.0 / 16.0
     )
-    angle_coe = torch.tensor(best_params["angle_coe"], dtype=torch.float32)
-
-    image_coe = torch.tensor(best_params["image_coe"], dtype=torch.float32)
 
-    overlap_coe = torch.tensor(best_params["overlap_coe"], dtype=torch.float32)
-
-    neighbor_num = best_params["neighbor_num"]
-    neighbor_coe = torch.tensor(best_params["neighbor_coe"], dtype=torch.float32)
-
-    joint_coe = torch.tensor(best_params["joint_coe"], dtype=torch.float32)
-else:
-    print("No best parameters found, using default parameters...")
-    delta_lr = 0.01
-    angle_lr = 0.01
-    tranlation_lr = 0.01
-    color_lr = 0.01
-
-    neg_clip_coe = 0.3
-
-    delta_coe = torch.tensor([1e-4, 1e-4], dtype=torch.float32)
-    displacement_coe = torch.tensor([0.0, 0.0], dtype=torch.float32)
-    angle_coe = torch.tensor(0.0, dtype=torch.float32)
-
-    image_coe = torch.tensor(0.0, dtype=torch.float32)
-
-    overlap_coe = torch.tensor(1e-4, dtype=torch.float32)
-
-    neighbor_num = 1
-    neighbor_coe = torch.tensor(0.0, dtype=torch.float32)
-
-    joint_coe = torch.tensor(1e-4, dtype=torch.float32)
-
-coe_dict = {
-    "neg_clip_coe": neg_clip_coe,
-    "delta_coe": delta_coe,
-    "displacement_coe": displacement_coe,
-    "angle_coe": angle_coe,
-    "image_coe": image_coe,
-    "overlap_coe": overlap_coe,
-    "neighbor_num": neighbor_num,
-    "neighbor_coe": neighbor_coe,
-    "joint_coe": joint_coe,
-    "threshold": "mean",
-}
-
-# Initialize CLIP text input
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device, jit=False)
+    for rect in shapes:
+        rect.update()
+    for rect_group in shape_groups:
+        rect_group.update()
 
-prompt = args.prompt
-neg_prompt = "an ugly, messy picture."
-text_input = clip.tokenize(prompt).to(device)
-text_input_neg = clip.tokenize(neg_prompt).to(device)
-use_neg = True
+    img = render_image(
+        canvas_width, canvas_height, shapes, shape_groups, render, seed=1
+    )
+    pydiffvg.imwrite(img.cpu(), os.path.join(results_path, "init.png"), gamma=gamma)
 
-with torch.no_grad():
-    text_features = model.encode_text(text_input)
-    text_features_neg = model.encode_text(text_input_neg)
+    optimizer_delta = torch.optim.Adam(
+        [rect.delta for rect in shapes], lr=lrs["delta_lr"]
+    )
+    optimizer_angle = torch.optim.Adam(
+        [rect_group.angle for rect_group in shape_groups], lr=lrs["angle_lr"]
+    )
+    optimizer_translation = torch.optim.Adam(
+        [rect_group.translation for rect_group in shape_groups],
+        lr=lrs["tranlation_lr"],
+    )
+    optimizer_color = torch.optim.Adam(
+        [rect_group.color for rect_group in shape_groups], lr=lrs["color_lr"]
+    )
 
-# Use GPU if available
-pydiffvg.set_use_gpu(torch.cuda.is_available())
+    # Run Adam iterations.
+    step_size = max(num_iterations // 3, 1)
+    scheduler_delta = StepLR(optimizer_delta, step_size=step_size, gamma=0.5)
+    scheduler_angle = StepLR(optimizer_angle, step_size=step_size, gamma=0.5)
+    scheduler_translation = StepLR(
+        optimizer_translation, step_size=step_size, gamma=0.5
+    )
+    scheduler_color = StepLR(optimizer_color, step_size=step_size, gamma=0.5)
 
-gamma = 1.0
-render = pydiffvg.RenderFunction.apply
+    for t in range(num_iterations):
+        print("Optimization iteration:", t)
 
-canvas_width, canvas_height = 224, 224
+        optimizer_delta.zero_grad()
+        optimizer_angle.zero_grad()
+        optimizer_translation.zero_grad()
+        optimizer_color.zero_grad()
 
-# Image Augmentation Transformation
-augment_trans = transforms.Compose(
-    [
-        transforms.RandomPerspective(fill=1, p=1, distortion_scale=0.5),
-        transforms.RandomResizedCrop(224, scale=(0.7, 0.9)),
-        transforms.Normalize(
-            (0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)
-        ),
-    ]
-)
+        for rect in shapes:
+            rect.update()
+        for rect_group in shape_groups:
+            rect_group.update()
 
-shapes = []
-shape_groups = []
-for x in range(0, 224, 16):
-    for y in range(0, 224, 16):
-        rect = PolygonRect(upper_left=torch.tensor([x, y]), width=14.0, height=14.0)
-        shapes.append(rect)
-        rect_group = RotationalShapeGroup(
-            shape_ids=torch.tensor([len(shapes) - 1]),
-            fill_color=torch.cat([torch.rand(3), torch.tensor([1.0])]),
-            transparent=False,
-            coe_ang=torch.tensor(1.0),
-            coe_trans=torch.tensor([canvas_width, canvas_height], dtype=torch.float32),
+        img = render_image(
+            canvas_width, canvas_height, shapes, shape_groups, render, seed=t + 1
         )
-        shape_groups.append(rect_group)
 
-for rect in shapes:
-    rect.update()
-for rect_group in shape_groups:
-    rect_group.update()
+        # Save the intermediate render.
+        if t % 5 == 0:
+            pydiffvg.imwrite(
+                img.cpu(),
+                os.path.join(results_path, "iter_{}.png".format(t // 5)),
+                gamma=gamma,
+            )
+
+        loss, _ = cal_loss(
+            img,
+            shapes,
+            shape_groups,
+            scorer,
+            text_features,
+            coe_dict,
+            use_aug=True,
+            augment_trans=augment_trans,
+            use_neg=True,
+            text_features_neg=text_features_neg,
+            verbose=True,
+            num_augs=num_augs,
+            micro_batch=micro_batch,
+        )
 
-img = render_image(canvas_width, canvas_height, shapes, shape_groups, render, seed=1)
-pydiffvg.imwrite(img.cpu(), os.path.join(RESULTS_PATH, "init.png"), gamma=gamma)
+        # Backpropagate the gradients.
+        loss.backward(retain_graph=True)
 
-optimizer_delta = torch.optim.Adam([rect.delta for rect in shapes], lr=delta_lr)
-optimizer_angle = torch.optim.Adam(
-    [rect_group.angle for rect_group in shape_groups], lr=angle_lr
-)
-optimizer_translation = torch.optim.Adam(
-    [rect_group.translation for rect_group in shape_groups], lr=tranlation_lr
-)
-optimizer_color = torch.optim.Adam(
-    [rect_group.color for rect_group in shape_groups], lr=color_lr
-)
+        # Take a gradient descent step.
+        optimizer_color.step()
+        optimizer_delta.step()
+        optimizer_angle.step()
+        optimizer_translation.step()
 
-# Run Adam iterations.
-num_interations = 1000
-scheduler_delta = StepLR(optimizer_delta, step_size=num_interations // 3, gamma=0.5)
-scheduler_angle = StepLR(optimizer_angle, step_size=num_interations // 3, gamma=0.5)
-scheduler_translation = StepLR(
-    optimizer_translation, step_size=num_interations // 3, gamma=0.5
-)
-scheduler_color = StepLR(optimizer_color, step_size=num_interations // 3, gamma=0.5)
+        # Take a scheduler step in the learning rate.
+        scheduler_color.step()
+        scheduler_delta.step()
+        scheduler_angle.step()
+        scheduler_translation.step()
 
-for t in range(num_interations):
-    print("Optimization iteration:", t)
+    img = render_image(
+        canvas_width, canvas_height, shapes, shape_groups, render, seed=102
+    )
+    pydiffvg.imwrite(
+        img.cpu(), os.path.join(results_path, "after_optimization.png"), gamma=gamma
+    )
 
-    optimizer_delta.zero_grad()
-    optimizer_angle.zero_grad()
-    optimizer_translation.zero_grad()
-    optimizer_color.zero_grad()
+    pickle.dump(shapes, open(os.path.join(pkls_path, "clip_shapes_no_pp.pkl"), "wb"))
+    pickle.dump(
+        shape_groups,
+        open(os.path.join(pkls_path, "clip_shape_groups_no_pp.pkl"), "wb"),
+    )
 
-    for rect in shapes:
-        rect.update()
-    for rect_group in shape_groups:
-        rect_group.update()
+    # We care only about pos_clip_loss when doing post-processing
+    postprocess_delete_rect(
+        canvas_width,
+        canvas_height,
+        render,
+        shapes,
+        shape_groups,
+        scorer,
+        text_features,
+        verbose=True,
+        ranking_scorer=ranking_scorer,
+        verify=verify_ranking,
+    )
 
     img = render_image(
-        canvas_width, canvas_height, shapes, shape_groups, render, seed=t + 1
+        canvas_width, canvas_height, shapes, shape_groups, render, seed=102
+    )
+    pydiffvg.imwrite(
+        img.cpu(), os.path.join(results_path, "after_delete.png"), gamma=gamma
     )
 
-    # Save the intermediate render.
-    if t % 5 == 0:
-        pydiffvg.imwrite(
-            img.cpu(),
-            os.path.join(RESULTS_PATH, "iter_{}.png".format(t // 5)),
-            gamma=gamma,
-        )
-
-    loss, _ = cal_loss(
-        img,
+    postprocess_scale_rect(
+        canvas_width,
+        canvas_height,
+        render,
         shapes,
         shape_groups,
-        model,
+        scorer,
         text_features,
-        coe_dict,
-        use_aug=True,
-        augment_trans=augment_trans,
-        use_neg=True,
-        text_features_neg=text_features_neg,
+        scale=1.2,
+        max_iter=100,
         verbose=True,
+        ranking_scorer=ranking_scorer,
+        verify=verify_ranking,
     )
 
-    # Backpropagate the gradients.
-    loss.backward(retain_graph=True)
+    img = render_image(
+        canvas_width, canvas_height, shapes, shape_groups, render, seed=102
+    )
+    pydiffvg.imwrite(
+        img.cpu(), os.path.join(results_path, "after_scale.png"), gamma=gamma
+    )
 
-    # Take a gradient descent step.
-    optimizer_color.step()
-    optimizer_delta.step()
-    optimizer_angle.step()
-    optimizer_translation.step()
+    # Render the final result.
+    img = render_image(
+        canvas_width, canvas_height, shapes, shape_groups, render, seed=102
+    )
+    # Save the images and differences.
+    pydiffvg.imwrite(img.cpu(), os.path.join(results_path, "final.png"), gamma=gamma)
 
-    # Take a scheduler step in the learning rate.
-    scheduler_color.step()
-    scheduler_delta.step()
-    scheduler_angle.step()
-    scheduler_translation.step()
+    pickle.dump(shapes, open(os.path.join(pkls_path, "clip_shapes.pkl"), "wb"))
+    pickle.dump(
+        shape_groups, open(os.path.join(pkls_path, "clip_shape_groups.pkl"), "wb")
+    )
 
-img = render_image(canvas_width, canvas_height, shapes, shape_groups, render, seed=102)
-pydiffvg.imwrite(
-    img.cpu(), os.path.join(RESULTS_PATH, "after_optimization.png"), gamma=gamma
-)
+    # Convert the intermediate renderings to a video.
+    if video:
+        call(
+            [
+                "ffmpeg",
+                "-framerate",
+                "24",
+                "-i",
+                os.path.join(results_path, "iter_%d.png"),
+                "-vb",
+                "20M",
+                os.path.join(results_path, "out.mp4"),
+            ]
+        )
 
-pickle.dump(shapes, open(os.path.join(PKLS_PATH, "clip_shapes_no_pp.pkl"), "wb"))
-pickle.dump(
-    shape_groups, open(os.path.join(PKLS_PATH, "clip_shape_groups_no_pp.pkl"), "wb")
-)
+    return {"loss": loss.item(), "tiles": len(shapes)}
 
-# We care only about pos_clip_loss when doing post-processing
-postprocess_delete_rect(
-    canvas_width,
-    canvas_height,
-    render,
-    shapes,
-    shape_groups,
-    model,
-    text_features,
-    verbose=True,
-)
 
-img = render_image(canvas_width, canvas_height, shapes, shape_groups, render, seed=102)
-pydiffvg.imwrite(img.cpu(), os.path.join(RESULTS_PATH, "after_delete.png"), gamma=gamma)
-
-postprocess_scale_rect(
-    canvas_width,
-    canvas_height,
-    render,
-    shapes,
-    shape_groups,
-    model,
-    text_features,
-    scale=1.2,
-    max_iter=100,
-    verbose=True,
-)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--prompt", help="prompt for mosaic generation", default="a red heart"
+    )
+    parser.add_argument(
+        "--scorer",
+        help="image-text scorer backend",
+        choices=SCORER_BACKENDS,
+        default="clip",
+    )
+    parser.add_argument(
+        "--scorer_checkpoint",
+        help="path to an exported TorchScript visual encoder (traced scorer only)",
+        default=None,
+    )
+    parser.add_argument(
+        "--layout",
+        help="uniform grid, or quadtree split by a CLIP-saliency proxy",
+        choices=LAYOUTS,
+        default="grid",
+    )
+    parser.add_argument(
+        "--tile_budget",
+        help="number of quadtree tiles, defaults to the grid's",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--activation_checkpointing",
+        help="recompute CLIP's visual block activations in backward to save memory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--num_augs", help="augmented views per iteration", type=int, default=4
+    )
+    parser.add_argument(
+        "--micro_batch",
+        help="score the views this many at a time, accumulating their gradients",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--int8_ranking",
+        help="rank post-processing candidates with an int8 quantized CLIP (CPU)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verify_ranking",
+        help="re-check every int8 post-processing step with the fp32 scorer",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if args.int8_ranking and args.scorer == "dummy":
+        parser.error("--int8_ranking needs a CLIP scorer backend, not 'dummy'")
+
+    # Initialize scorer
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    scorer = load_scorer(
+        args.scorer,
+        device,
+        checkpoint=args.scorer_checkpoint,
+        activation_checkpointing=args.activation_checkpointing,
+    )
 
-img = render_image(canvas_width, canvas_height, shapes, shape_groups, render, seed=102)
-pydiffvg.imwrite(img.cpu(), os.path.join(RESULTS_PATH, "after_scale.png"), gamma=gamma)
-
-
-# Render the final result.
-img = render_image(canvas_width, canvas_height, shapes, shape_groups, render, seed=102)
-# Save the images and differences.
-pydiffvg.imwrite(img.cpu(), os.path.join(RESULTS_PATH, "final.png"), gamma=gamma)
-
-pickle.dump(shapes, open(os.path.join(PKLS_PATH, "clip_shapes.pkl"), "wb"))
-pickle.dump(shape_groups, open(os.path.join(PKLS_PATH, "clip_shape_groups.pkl"), "wb"))
-
-# Convert the intermediate renderings to a video.
-call(
-    [
-        "ffmpeg",
-        "-framerate",
-        "24",
-        "-i",
-        os.path.join(RESULTS_PATH, "iter_%d.png"),
-        "-vb",
-        "20M",
-        os.path.join(RESULTS_PATH, "out.mp4"),
-    ]
-)
+    # Use GPU if available
+    pydiffvg.set_use_gpu(torch.cuda.is_available())
+
+    generate(
+        args.prompt,
+        scorer,
+        layout=args.layout,
+        tile_budget=args.tile_budget,
+        num_augs=args.num_augs,
+        micro_batch=args.micro_batch,
+        ranking_scorer=(
+            QuantizedCLIPScorer(scorer.model, device) if args.int8_ranking else None
+        ),
+        verify_ranking=args.verify_ranking,
+    )
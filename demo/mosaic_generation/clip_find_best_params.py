@@ -6,7 +6,7 @@ from utils import (
     render_image,
 )
 import torchvision.transforms as transforms
-import clip
+from scorer import load_scorer, SCORER_BACKENDS
 import optuna
 from torch.optim.lr_scheduler import StepLR
 import os
@@ -17,6 +17,17 @@ parser = argparse.ArgumentParser()
 parser.add_argument(
     "--prompt", help="prompt for mosaic generation", default="a red heart"
 )
+parser.add_argument(
+    "--scorer",
+    help="image-text scorer backend",
+    choices=SCORER_BACKENDS,
+    default="clip",
+)
+parser.add_argument(
+    "--scorer_checkpoint",
+    help="path to an exported TorchScript visual encoder (traced scorer only)",
+    default=None,
+)
 args = parser.parse_args()
 
 RESULTS_PATH = "../results/clip/"
@@ -27,19 +38,17 @@ if not os.path.exists(PKLS_PATH):
     print("Creating folder for saving results...")
     os.makedirs(PKLS_PATH)
 
-# Initialize CLIP text input
+# Initialize scorer and text input
 device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device, jit=False)
+scorer = load_scorer(args.scorer, device, checkpoint=args.scorer_checkpoint)
 
 prompt = args.prompt
 neg_prompt = "an ugly, messy picture."
-text_input = clip.tokenize(prompt).to(device)
-text_input_neg = clip.tokenize(neg_prompt).to(device)
 use_neg = True
 
 with torch.no_grad():
-    text_features = model.encode_text(text_input)
-    text_features_neg = model.encode_text(text_input_neg)
+    text_features = scorer.encode_text(prompt)
+    text_features_neg = scorer.encode_text(neg_prompt)
 
 # Use GPU if available
 pydiffvg.set_use_gpu(torch.cuda.is_available())
@@ -170,7 +179,7 @@ def objective(trial):
             img,
             shapes,
             shape_groups,
-            model,
+            scorer,
             text_features,
             coe_dict,
             use_aug=True,
@@ -0,0 +1,362 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+import traceback
+
+QUEUE_PATH = "../results/jobs.db"
+RESULTS_PATH = "../results/jobs/"
+JOB_KINDS = ("clip", "target")
+
+
+# ----------------------- Job queue -----------------------
+#
+# Jobs live in a SQLite table, so any process on the machine can submit them
+# and a restarted server picks up where it stopped. A job is a kind ("clip" or
+# "target") and a JSON spec of the keyword arguments of the matching generate().
+
+
+class JobQueue:
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                spec TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                worker INTEGER,
+                submitted REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                result TEXT,
+                error TEXT
+            )"""
+        )
+
+    def submit(self, kind, spec):
+        if kind not in JOB_KINDS:
+            raise ValueError("Invalid job kind. Use 'clip' or 'target'.")
+        cursor = self.db.execute(
+            "INSERT INTO jobs (kind, spec, submitted) VALUES (?, ?, ?)",
+            (kind, json.dumps(spec), time.time()),
+        )
+        return cursor.lastrowid
+
+    def claim(self, worker):
+        # Atomically take the oldest queued job, None if there is none
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute(
+                "SELECT id, kind, spec FROM jobs WHERE status = 'queued' "
+                "ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                self.db.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, started = ? "
+                    "WHERE id = ?",
+                    (worker, time.time(), row[0]),
+                )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def finish(self, job_id, result=None, error=None):
+        self.db.execute(
+            "UPDATE jobs SET status = ?, finished = ?, result = ?, error = ? "
+            "WHERE id = ?",
+            (
+                "failed" if error else "done",
+                time.time(),
+                None if result is None else json.dumps(result),
+                error,
+                job_id,
+            ),
+        )
+
+    def requeue_running(self):
+        # Jobs of workers that died with a previous server go back to the queue
+        cursor = self.db.execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL, started = NULL "
+            "WHERE status = 'running'"
+        )
+        return cursor.rowcount
+
+    def pending(self):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+        ).fetchone()[0]
+
+    def jobs(self):
+        cursor = self.db.execute(
+            "SELECT id, kind, status, worker, submitted, started, finished, result, "
+            "error FROM jobs ORDER BY id"
+        )
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def stats(self):
+        jobs = self.jobs()
+        counts = {}
+        for job in jobs:
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        started = [j for j in jobs if j["started"] is not None]
+        finished = [j for j in jobs if j["finished"] is not None]
+        stats = {"counts": counts}
+        if started:
+            stats["queue_latency"] = summarize(
+                [j["started"] - j["submitted"] for j in started]
+            )
+        if finished:
+            stats["run_time"] = summarize(
+                [j["finished"] - j["started"] for j in finished]
+            )
+            span = max(j["finished"] for j in finished) - min(
+                j["started"] for j in finished
+            )
+            stats["throughput_per_min"] = 60 * len(finished) / max(span, 1e-9)
+        return stats
+
+    def close(self):
+        self.db.close()
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        "mean": sum(values) / len(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(int(len(values) * 0.95), len(values) - 1)],
+        "max": values[-1],
+    }
+
+
+# ----------------------- Workers -----------------------
+
+
+def run_job(kind, spec, scorer, results_path):
+    # Run one job in the warm worker, its output and log go to results_path
+    import clip_best_params
+    import target_best_params
+
+    spec = dict(spec)
+    spec.pop("threads", None)
+    spec.setdefault("video", False)
+    os.makedirs(results_path, exist_ok=True)
+    with open(os.path.join(results_path, "log.txt"), "w") as log:
+        with contextlib.redirect_stdout(log):
+            if kind == "clip":
+                return clip_best_params.generate(
+                    spec.pop("prompt"), scorer, results_path=results_path, **spec
+                )
+            return target_best_params.generate(
+                spec.pop("target_image"), results_path=results_path, **spec
+            )
+
+
+def worker_main(
+    worker,
+    queue_path,
+    results_root,
+    backend,
+    checkpoint,
+    activation_checkpointing,
+    threads,
+    poll,
+):
+    # Imports, scorer loading and device setup are paid once per worker; the scorer
+    # is loaded on the first clip job, target-only workers never load it
+    import torch
+    import pydiffvg
+    from scorer import load_scorer
+
+    import clip_best_params  # noqa: F401
+    import target_best_params  # noqa: F401
+
+    torch.set_num_threads(threads)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    scorer = None
+    pydiffvg.set_use_gpu(torch.cuda.is_available())
+    print("Worker {} ready (pid {})".format(worker, os.getpid()), flush=True)
+
+    queue = JobQueue(queue_path)
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            time.sleep(poll)
+            continue
+        job_id, kind, spec = job
+        results_path = os.path.join(results_root, "job_{}".format(job_id))
+        torch.set_num_threads(spec.get("threads", threads))
+        start = time.perf_counter()
+        try:
+            if kind == "clip" and scorer is None:
+                scorer = load_scorer(
+                    backend,
+                    device,
+                    checkpoint=checkpoint,
+                    activation_checkpointing=activation_checkpointing,
+                )
+            result = run_job(kind, spec, scorer, results_path)
+            result["results_path"] = results_path
+            queue.finish(job_id, result=result)
+            print(
+                "Worker {} finished job {} in {:.2f}s".format(
+                    worker, job_id, time.perf_counter() - start
+                ),
+                flush=True,
+            )
+        except Exception as e:
+            queue.finish(job_id, error="{}: {}".format(type(e).__name__, e))
+            traceback.print_exc()
+        torch.set_num_threads(threads)
+
+
+def serve(args):
+    queue = JobQueue(args.queue)
+    requeued = queue.requeue_running()
+    if requeued:
+        print("Requeued {} interrupted jobs".format(requeued))
+
+    # Spawned workers import torch themselves instead of inheriting a forked copy
+    context = multiprocessing.get_context("spawn")
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    workers = [
+        context.Process(
+            target=worker_main,
+            args=(
+                i,
+                args.queue,
+                args.results,
+                args.scorer,
+                args.scorer_checkpoint,
+                args.activation_checkpointing,
+                threads,
+                args.poll,
+            ),
+            daemon=True,
+        )
+        for i in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    print(
+        "Serving {} with {} workers, {} torch threads each".format(
+            args.queue, args.workers, threads
+        )
+    )
+    try:
+        while all(worker.is_alive() for worker in workers):
+            time.sleep(args.poll)
+            if args.drain and queue.pending() == 0:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+    print_stats(queue.stats())
+
+
+def submit(args):
+    queue = JobQueue(args.queue)
+    spec = {"num_iterations": args.num_iterations}
+    if args.threads:
+        spec["threads"] = args.threads
+    if args.params:
+        spec["overrides"] = json.loads(args.params)
+    if args.prompt is not None:
+        kind, spec["prompt"] = "clip", args.prompt
+    else:
+        kind, spec["target_image"] = "target", os.path.abspath(args.target_image)
+    for _ in range(args.repeat):
+        job_id = queue.submit(kind, spec)
+        print("Submitted job {}".format(job_id))
+
+
+def print_stats(stats):
+    print("Jobs:", ", ".join("{} {}".format(v, k) for k, v in stats["counts"].items()))
+    for name in ("queue_latency", "run_time"):
+        if name in stats:
+            print(
+                "{}: mean {mean:.2f}s, p50 {p50:.2f}s, p95 {p95:.2f}s, "
+                "max {max:.2f}s".format(name, **stats[name])
+            )
+    if "throughput_per_min" in stats:
+        print("throughput: {:.2f} jobs/min".format(stats["throughput_per_min"]))
+
+
+def status(args):
+    queue = JobQueue(args.queue)
+    if args.jobs:
+        for job in queue.jobs():
+            print(
+                "{id:>5} {kind:>6} {status:>7} worker={worker} {result}{error}".format(
+                    **dict(job, result=job["result"] or "", error=job["error"] or "")
+                )
+            )
+    print_stats(queue.stats())
+
+
+if __name__ == "__main__":
+    from scorer import SCORER_BACKENDS
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--queue", help="path to the SQLite job queue", default=QUEUE_PATH
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_serve = subparsers.add_parser("serve", help="run warm workers on the queue")
+    parser_serve.add_argument("--workers", type=int, default=1, help="concurrent jobs")
+    parser_serve.add_argument(
+        "--threads", type=int, default=None, help="default torch threads per job"
+    )
+    parser_serve.add_argument("--results", help="per-job folders", default=RESULTS_PATH)
+    parser_serve.add_argument(
+        "--scorer",
+        help="image-text scorer backend",
+        choices=SCORER_BACKENDS,
+        default="clip",
+    )
+    parser_serve.add_argument("--scorer_checkpoint", default=None)
+    parser_serve.add_argument(
+        "--activation_checkpointing",
+        help="recompute CLIP's visual block activations in backward to save memory",
+        action="store_true",
+    )
+    parser_serve.add_argument("--poll", type=float, default=0.5, help="seconds")
+    parser_serve.add_argument(
+        "--drain", action="store_true", help="exit once the queue is empty"
+    )
+    parser_serve.set_defaults(func=serve)
+
+    parser_submit = subparsers.add_parser("submit", help="queue a generation job")
+    target = parser_submit.add_mutually_exclusive_group(required=True)
+    target.add_argument("--prompt", help="prompt of a CLIP-guided job")
+    target.add_argument("--target_image", help="target image of a target job")
+    parser_submit.add_argument("--num_iterations", type=int, default=1000)
+    parser_submit.add_argument("--threads", type=int, default=None)
+    parser_submit.add_argument(
+        "--params", help="JSON dict overriding the best parameters", default=None
+    )
+    parser_submit.add_argument("--repeat", type=int, default=1)
+    parser_submit.set_defaults(func=submit)
+
+    parser_status = subparsers.add_parser("status", help="queue latency and throughput")
+    parser_status.add_argument("--jobs", action="store_true", help="list every job")
+    parser_status.set_defaults(func=status)
+
+    args = parser.parse_args()
+    args.func(args)
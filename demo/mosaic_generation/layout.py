@@ -0,0 +1,103 @@
+import heapq
+import torch
+from my_shape import PolygonRect, RotationalShapeGroup
+
+LAYOUTS = ("grid", "quadtree")
+
+
+# ----------------------- Tile layouts -----------------------
+#
+# A layout is a list of (x, y, width, height) integer cells covering the
+# canvas. make_tiles turns the cells into the PolygonRect / RotationalShapeGroup
+# pairs the optimization works on.
+
+
+def grid_layout(canvas_width, canvas_height, step_x, step_y):
+    # Uniform grid, column by column as the scripts have always built it
+    return [
+        (x, y, step_x, step_y)
+        for x in range(0, canvas_width, step_x)
+        for y in range(0, canvas_height, step_y)
+    ]
+
+
+def split_cell(cell):
+    # Four quadrants of a cell, odd sizes split unevenly, empty ones dropped
+    x, y, w, h = cell
+    w0, h0 = w // 2, h // 2
+    children = [
+        (x, y, w0, h0),
+        (x + w0, y, w - w0, h0),
+        (x, y + h0, w0, h - h0),
+        (x + w0, y + h0, w - w0, h - h0),
+    ]
+    return [c for c in children if c[2] > 0 and c[3] > 0]
+
+
+def quadtree_layout(canvas_width, canvas_height, budget, cost, min_size=4):
+    # Repeatedly split the leaf of highest cost until the next split would
+    # exceed the tile budget. cost(cells) returns the error a single tile leaves
+    # in each of the cells; leaves smaller than 2 * min_size on a side are not split.
+    root = (0, 0, canvas_width, canvas_height)
+    counter = 0
+    heap = [(-float(cost([root])[0]), counter, root)]
+    final = []
+    while heap and len(heap) + len(final) + 3 <= budget:
+        _, _, cell = heapq.heappop(heap)
+        if cell[2] < 2 * min_size or cell[3] < 2 * min_size:
+            final.append(cell)
+            continue
+        children = split_cell(cell)
+        for child, child_cost in zip(children, cost(children).tolist()):
+            counter += 1
+            heapq.heappush(heap, (-child_cost, counter, child))
+    cells = final + [cell for _, _, cell in heap]
+    # Same column by column order as the grid
+    return sorted(cells, key=lambda c: (c[0], c[1]))
+
+
+def variance_cost(stats):
+    # Squared error of the mean color over cells, from the BlockStats of an image
+    return stats.sse
+
+
+def saliency_cost(stats):
+    # Saliency mass of cells, from the BlockStats of a saliency map
+    return lambda cells: stats.sums(cells)[:, 0]
+
+
+def saliency_map(scorer, text_features, image, augment_trans=None, num_augs=4):
+    # CLIP-saliency proxy of a text prompt: magnitude of the gradient of the
+    # image-text similarity with respect to the pixels of an NCHW image,
+    # averaged over augmented views as in cal_loss
+    image = image.detach().clone().requires_grad_(True)
+    views = [image]
+    if augment_trans is not None:
+        views += [augment_trans(image) for _ in range(num_augs - 1)]
+    features = scorer.encode_images(torch.cat(views))
+    torch.cosine_similarity(text_features, features, dim=1).sum().backward()
+    return image.grad.abs().sum(1)[0]
+
+
+def make_tiles(cells, canvas_width, canvas_height, colors=None, fill=1.0):
+    # One tile per cell with its upper left corner at the cell's, fill times the
+    # cell's size. Colors default to random.
+    shapes = []
+    shape_groups = []
+    for i, (x, y, w, h) in enumerate(cells):
+        rect = PolygonRect(
+            upper_left=torch.tensor([x, y]),
+            width=w * fill + 0.0,
+            height=h * fill + 0.0,
+        )
+        shapes.append(rect)
+        color = torch.rand(3) if colors is None else colors[i]
+        rect_group = RotationalShapeGroup(
+            shape_ids=torch.tensor([len(shapes) - 1]),
+            fill_color=torch.cat([color, torch.tensor([1.0])]),
+            transparent=False,
+            coe_ang=torch.tensor(1.0),
+            coe_trans=torch.tensor([canvas_width, canvas_height], dtype=torch.float32),
+        )
+        shape_groups.append(rect_group)
+    return shapes, shape_groups
@@ -0,0 +1,192 @@
+import copy
+import hashlib
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+# ----------------------- Image-text scorers -----------------------
+#
+# A scorer turns a batch of NCHW images into feature vectors that cal_loss
+# compares against text features with cosine similarity. Every backend exposes
+#   encode_images(batch) -> (N, D) features
+#   encode_text(prompts) -> (len(prompts), D) features
+
+
+class CheckpointedBlock(torch.nn.Module):
+    # Wraps a transformer block so that its activations are recomputed in the
+    # backward pass instead of being kept, trading compute for memory
+    def __init__(self, block):
+        super().__init__()
+        self.block = block
+
+    def forward(self, x):
+        if torch.is_grad_enabled():
+            return checkpoint(self.block, x, use_reentrant=False)
+        return self.block(x)
+
+
+def enable_activation_checkpointing(model):
+    # Checkpoint every residual block of CLIP's visual transformer, in place
+    transformer = model.visual.transformer
+    blocks = list(transformer.resblocks)
+    if not any(isinstance(block, CheckpointedBlock) for block in blocks):
+        transformer.resblocks = torch.nn.Sequential(
+            *[CheckpointedBlock(block) for block in blocks]
+        )
+    return model
+
+
+class CLIPScorer:
+    # With activation_checkpointing=True, only the inputs of the visual
+    # transformer blocks are kept for the backward pass, so the activation memory
+    # of encode_images with gradients no longer grows with the block count
+    def __init__(self, model, device="cpu", activation_checkpointing=False):
+        self.model = model
+        self.device = device
+        if model is not None:
+            # Gradients only ever flow to the images, CLIP itself stays fixed
+            model.requires_grad_(False)
+        if activation_checkpointing:
+            enable_activation_checkpointing(model)
+
+    def encode_images(self, batch):
+        return self.model.encode_image(batch)
+
+    def encode_text(self, prompts):
+        import clip
+
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        return self.model.encode_text(clip.tokenize(prompts).to(self.device))
+
+
+class TracedCLIPScorer(CLIPScorer):
+    # CPU variant of CLIPScorer: the visual tower is traced with TorchScript.
+    # With freeze=True the module is also frozen and optimized for inference,
+    # which is faster but only suitable for no-grad ranking (post-processing).
+    def __init__(self, model, visual=None, device="cpu", freeze=False, resolution=224):
+        super().__init__(model, device=device)
+        if visual is None:
+            visual = self.trace_visual(model, device, resolution)
+            if freeze:
+                visual = torch.jit.optimize_for_inference(torch.jit.freeze(visual))
+        self.visual = visual
+        self.dtype = next(model.parameters()).dtype if model is not None else None
+
+    @staticmethod
+    def trace_visual(model, device="cpu", resolution=224):
+        model.visual.eval()
+        example = torch.zeros(1, 3, resolution, resolution, device=device)
+        with torch.no_grad():
+            return torch.jit.trace(model.visual, example.type(model.dtype))
+
+    def encode_images(self, batch):
+        if self.dtype is not None:
+            batch = batch.type(self.dtype)
+        return self.visual(batch)
+
+    def encode_text(self, prompts):
+        if self.model is None:
+            raise ValueError(
+                "Traced checkpoint has no text encoder, pass model= when loading."
+            )
+        return super().encode_text(prompts)
+
+    def save(self, path):
+        # Export the (possibly frozen) visual tower as a local checkpoint
+        self.visual.save(path)
+
+    @classmethod
+    def load(cls, path, model=None, device="cpu"):
+        visual = torch.jit.load(path, map_location=device)
+        return cls(model, visual=visual, device=device)
+
+
+class QuantizedCLIPScorer(CLIPScorer):
+    # Variant of CLIPScorer for no-grad ranking (post-processing): the linear
+    # layers of a float32 CPU copy of the visual tower are dynamically quantized
+    # to int8, weights ahead of time and activations per batch. Dynamic
+    # quantization runs on the CPU only, so images are scored there whatever the
+    # model's device, and the features are returned on the images' device. Text
+    # encoding stays with the model, which is left untouched for training and
+    # re-verification.
+    def __init__(self, model, device="cpu"):
+        super().__init__(model, device=device)
+        self.visual = torch.ao.quantization.quantize_dynamic(
+            copy.deepcopy(model.visual).float().cpu(),
+            {torch.nn.Linear},
+            dtype=torch.qint8,
+        )
+
+    def encode_images(self, batch):
+        with torch.no_grad():
+            features = self.visual(batch.detach().float().cpu())
+        return features.to(device=batch.device, dtype=self.model.dtype)
+
+
+class DeterministicScorer:
+    # Lightweight scorer for tests and benchmarks: average-pools the image to a
+    # small grid and applies a fixed random projection. Text features are a
+    # seeded function of the prompt, so results are reproducible across runs.
+    def __init__(self, dim=512, grid=8, seed=0, device="cpu"):
+        self.dim = dim
+        self.grid = grid
+        self.device = device
+        generator = torch.Generator().manual_seed(seed)
+        self.projection = torch.randn(3 * grid * grid, dim, generator=generator).to(
+            device
+        )
+
+    def encode_images(self, batch):
+        pooled = torch.nn.functional.adaptive_avg_pool2d(batch, self.grid)
+        return pooled.flatten(1) @ self.projection
+
+    def encode_text(self, prompts):
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        features = []
+        for prompt in prompts:
+            seed = int.from_bytes(hashlib.sha256(prompt.encode()).digest()[:8], "little")
+            generator = torch.Generator().manual_seed(seed)
+            features.append(torch.randn(self.dim, generator=generator))
+        return torch.stack(features).to(self.device)
+
+
+def as_scorer(model):
+    # Accept a raw CLIP model wherever a scorer is expected
+    if hasattr(model, "encode_images"):
+        return model
+    return CLIPScorer(model, device=next(model.parameters()).device)
+
+
+def load_scorer(
+    backend="clip", device="cpu", checkpoint=None, activation_checkpointing=False
+):
+    if activation_checkpointing and backend != "clip":
+        raise ValueError("Activation checkpointing needs the 'clip' scorer backend.")
+    if backend == "dummy":
+        return DeterministicScorer(device=device)
+
+    import clip
+
+    model, _ = clip.load("ViT-B/32", device, jit=False)
+    if backend == "clip":
+        return CLIPScorer(
+            model, device=device, activation_checkpointing=activation_checkpointing
+        )
+    elif backend == "traced":
+        if checkpoint is not None:
+            return TracedCLIPScorer.load(checkpoint, model=model, device=device)
+        return TracedCLIPScorer(model, device=device)
+    elif backend == "traced_frozen":
+        return TracedCLIPScorer(model, device=device, freeze=True)
+    elif backend == "quantized":
+        return QuantizedCLIPScorer(model, device=device)
+    else:
+        raise ValueError(
+            "Invalid scorer backend. Use 'clip', 'traced', 'traced_frozen', "
+            "'quantized' or 'dummy'."
+        )
+
+
+SCORER_BACKENDS = ("clip", "traced", "traced_frozen", "quantized", "dummy")
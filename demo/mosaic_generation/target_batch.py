@@ -0,0 +1,197 @@
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+RESULTS_PATH = "../results/target_batch/"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".webp")
+CSV_FIELDS = (
+    "target_image",
+    "results_path",
+    "pixel_loss",
+    "loss",
+    "tiles",
+    "iterations",
+    "seconds",
+    "worker",
+    "error",
+)
+
+
+def find_targets(source):
+    # Target images of a folder, or the paths listed in a manifest file (one per
+    # line, relative to the manifest, '#' starts a comment)
+    if os.path.isdir(source):
+        return [
+            os.path.join(source, name)
+            for name in sorted(os.listdir(source))
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+    targets = []
+    with open(source) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                targets.append(os.path.join(os.path.dirname(source), line))
+    return targets
+
+
+def output_folders(targets, results_root):
+    # One folder per target named after it, numbered when two names collide
+    folders, seen = [], {}
+    for target in targets:
+        name = os.path.splitext(os.path.basename(target))[0]
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1:
+            name = "{}_{}".format(name, seen[name])
+        folders.append(os.path.join(results_root, name, ""))
+    return folders
+
+
+def init_worker(threads):
+    # Runs once per pool process: thread limit, device and imports are shared by
+    # all the targets the process handles
+    import torch
+    import pydiffvg
+    import target_best_params  # noqa: F401
+
+    torch.set_num_threads(threads)
+    pydiffvg.set_use_gpu(torch.cuda.is_available())
+
+
+def run_target(target_image, results_path, kwargs):
+    import target_best_params
+
+    row = {
+        "target_image": target_image,
+        "results_path": results_path,
+        "worker": os.getpid(),
+    }
+    os.makedirs(results_path, exist_ok=True)
+    start = time.perf_counter()
+    try:
+        with open(os.path.join(results_path, "log.txt"), "w") as log:
+            with contextlib.redirect_stdout(log):
+                result = target_best_params.generate(
+                    target_image, results_path=results_path, **kwargs
+                )
+        for key in ("pixel_loss", "loss", "tiles", "iterations"):
+            row[key] = result[key]
+    except Exception as e:
+        row["error"] = "{}: {}".format(type(e).__name__, e)
+    row["seconds"] = time.perf_counter() - start
+    return row
+
+
+def run_batch(targets, results_root=RESULTS_PATH, workers=1, threads=None, **kwargs):
+    # Shard the targets over a pool of `workers` processes with `threads` torch
+    # threads each, and write the loss and run time of every target to a CSV
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    folders = output_folders(targets, results_root)
+    os.makedirs(results_root, exist_ok=True)
+    csv_path = os.path.join(results_root, "summary.csv")
+    print(
+        "Running {} targets on {} workers, {} torch threads each".format(
+            len(targets), workers, threads
+        )
+    )
+
+    # Spawned workers import torch themselves instead of inheriting a forked copy
+    start = time.perf_counter()
+    rows = []
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(threads,),
+        ) as pool:
+            futures = {
+                pool.submit(run_target, target, folder, kwargs): (target, folder)
+                for target, folder in zip(targets, folders)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    row = future.result()
+                except Exception as e:
+                    # The worker itself died (e.g. killed for memory, or a failed
+                    # init), which breaks the pool: the target is recorded as failed
+                    target, folder = futures[future]
+                    row = {
+                        "target_image": target,
+                        "results_path": folder,
+                        "error": "{}: {}".format(type(e).__name__, e),
+                    }
+                rows.append(row)
+                writer.writerow(row)
+                f.flush()
+                print(
+                    "{} / {} {}: {}".format(
+                        len(rows),
+                        len(targets),
+                        row["target_image"],
+                        row.get("error")
+                        or "pixel loss {:.5f} in {:.1f}s".format(
+                            row["pixel_loss"], row["seconds"]
+                        ),
+                    )
+                )
+    elapsed = time.perf_counter() - start
+    print(
+        "{} targets in {:.1f}s ({:.2f} targets/min, {} failed), summary in {}".format(
+            len(rows),
+            elapsed,
+            60 * len(rows) / max(elapsed, 1e-9),
+            sum("error" in row for row in rows),
+            csv_path,
+        )
+    )
+    return rows
+
+
+if __name__ == "__main__":
+    from target_best_params import INITS
+    from layout import LAYOUTS
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "targets", help="folder of target images, or a manifest listing them"
+    )
+    parser.add_argument(
+        "--results", help="per-target folders and summary.csv", default=RESULTS_PATH
+    )
+    parser.add_argument("--workers", type=int, default=1, help="concurrent targets")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="torch threads per worker, defaults to the CPUs split between workers",
+    )
+    parser.add_argument("--num_iterations", type=int, default=1000)
+    parser.add_argument("--init", choices=INITS, default="random")
+    parser.add_argument("--layout", choices=LAYOUTS, default="grid")
+    parser.add_argument("--tile_budget", type=int, default=None)
+    parser.add_argument(
+        "--params", help="JSON dict overriding the best parameters", default=None
+    )
+    parser.add_argument("--video", action="store_true", help="render out.mp4 files")
+    args = parser.parse_args()
+
+    run_batch(
+        find_targets(args.targets),
+        results_root=args.results,
+        workers=args.workers,
+        threads=args.threads,
+        num_iterations=args.num_iterations,
+        init=args.init,
+        layout=args.layout,
+        tile_budget=args.tile_budget,
+        overrides=json.loads(args.params) if args.params else None,
+        video=args.video,
+    )
@@ -1,7 +1,14 @@
 from subprocess import call
 import pydiffvg
 import torch
-from my_shape import PolygonRect, RotationalShapeGroup
+from layout import (
+    LAYOUTS,
+    grid_layout,
+    quadtree_layout,
+    variance_cost,
+    make_tiles,
+)
+from block_stats import BlockStats
 from utils import (
     diffvg_regularization_term,
     pairwise_diffvg_regularization_term,
@@ -13,140 +20,136 @@ import pickle
 import numpy as np
 from PIL import Image
 import os
+import time
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "--target_image", help="path to target image", default="inputs/target_exp1.png"
-)
-args = parser.parse_args()
-
 RESULTS_PATH = "../results/target/"
+INITS = ("random", "mean")
 PKLS_PATH = os.path.join(RESULTS_PATH, "pkls")
-
-# Create folder for saving results
-if not os.path.exists(PKLS_PATH):
-    print("Creating folder for saving results...")
-    os.makedirs(PKLS_PATH)
-
-# Load the best parameters
-if os.path.exists(os.path.join(PKLS_PATH, "target_best_params.pkl")):
-    print("Loading best parameters...")
-    best_params = pickle.load(
-        open(os.path.join(PKLS_PATH, "target_best_params.pkl"), "rb")
-    )
-    print("Best parameters: ")
-    print(best_params)
-
-    delta_lr = best_params["delta_lr"]
-    angle_lr = best_params["angle_lr"]
-    tranlation_lr = best_params["tranlation_lr"]
-    color_lr = best_params["color_lr"]
-
-    delta_coe = torch.tensor(
-        [best_params["reg_delta_coe_x"], best_params["reg_delta_coe_y"]],
-        dtype=torch.float32,
-    )
-    displacement_coe = torch.tensor(
-        [best_params["reg_displacement_coe_x"], best_params["reg_displacement_coe_y"]],
-        dtype=torch.float32,
-    )
-    angle_coe = torch.tensor(best_params["angle_coe"], dtype=torch.float32)
-
-    overlap_coe = torch.tensor(best_params["overlap_coe"], dtype=torch.float32)
-
-    neighbor_num = best_params["neighbor_num"]
-    neighbor_coe = torch.tensor(best_params["neighbor_coe"], dtype=torch.float32)
-
-    joint_coe = torch.tensor(best_params["joint_coe"], dtype=torch.float32)
-else:
-    print("No best parameters found, using default parameters...")
-    delta_lr = 0.01
-    angle_lr = 0.01
-    tranlation_lr = 0.01
-    color_lr = 0.01
-
-    delta_coe = torch.tensor([1e-4, 1e-4], dtype=torch.float32)
-    displacement_coe = torch.tensor([1e-2, 1e-2], dtype=torch.float32)
-    angle_coe = torch.tensor(0.0, dtype=torch.float32)
-
-    overlap_coe = torch.tensor(0.0, dtype=torch.float32)
-
-    neighbor_num = 0
-    neighbor_coe = torch.tensor(0.0, dtype=torch.float32)
-
-    joint_coe = torch.tensor(0.0, dtype=torch.float32)
-
-# Use GPU if available
-pydiffvg.set_use_gpu(torch.cuda.is_available())
-
-gamma = 2.2
-render = pydiffvg.RenderFunction.apply
-
-# Load target image
-target = Image.open(args.target_image)
-target = (torch.from_numpy(np.array(target)).float() / 255.0) ** gamma
-target = target[:, :, 3:4] * target[:, :, :3] + torch.ones(
-    target.shape[0], target.shape[1], 3, device=pydiffvg.get_device()
-) * (1 - target[:, :, 3:4])
-target = target[:, :, :3]
-canvas_width, canvas_height = target.shape[1], target.shape[0]
-
-# Initializations
-shapes = []
-shape_groups = []
-for x in range(0, canvas_width, canvas_width // 10):
-    for y in range(0, canvas_height, canvas_height // 10):
-        rect = PolygonRect(
-            upper_left=torch.tensor([x, y]),
-            width=canvas_width // 10 + 0.0,
-            height=canvas_height // 10 + 0.0,
-        )
-        shapes.append(rect)
-        rect_group = RotationalShapeGroup(
-            shape_ids=torch.tensor([len(shapes) - 1]),
-            fill_color=torch.cat([torch.rand(3), torch.tensor([1.0])]),
-            transparent=False,
-            coe_ang=torch.tensor(1.0),
-            coe_trans=torch.tensor([canvas_width, canvas_height], dtype=torch.float32),
+BEST_PARAMS_PATH = os.path.join(PKLS_PATH, "target_best_params.pkl")
+
+DEFAULT_PARAMS = {
+    "delta_lr": 0.01,
+    "angle_lr": 0.01,
+    "tranlation_lr": 0.01,
+    "color_lr": 0.01,
+    "reg_delta_coe_x": 1e-4,
+    "reg_delta_coe_y": 1e-4,
+    "reg_displacement_coe_x": 1e-2,
+    "reg_displacement_coe_y": 1e-2,
+    "angle_coe": 0.0,
+    "overlap_coe": 0.0,
+    "neighbor_num": 0,
+    "neighbor_coe": 0.0,
+    "joint_coe": 0.0,
+}
+
+
+def load_params(params_path=BEST_PARAMS_PATH, overrides=None):
+    # Best parameters of target_find_best_params.py if they exist, else the defaults
+    if os.path.exists(params_path):
+        print("Loading best parameters...")
+        params = pickle.load(open(params_path, "rb"))
+        print("Best parameters: ")
+        print(params)
+    else:
+        print("No best parameters found, using default parameters...")
+        params = dict(DEFAULT_PARAMS)
+    params.update(overrides or {})
+
+    lrs = {
+        name: params[name]
+        for name in ("delta_lr", "angle_lr", "tranlation_lr", "color_lr")
+    }
+    coe_dict = {
+        "delta_coe": torch.tensor(
+            [params["reg_delta_coe_x"], params["reg_delta_coe_y"]],
+            dtype=torch.float32,
+        ),
+        "displacement_coe": torch.tensor(
+            [params["reg_displacement_coe_x"], params["reg_displacement_coe_y"]],
+            dtype=torch.float32,
+        ),
+        "angle_coe": torch.tensor(params["angle_coe"], dtype=torch.float32),
+        "overlap_coe": torch.tensor(params["overlap_coe"], dtype=torch.float32),
+        "neighbor_num": params["neighbor_num"],
+        "neighbor_coe": torch.tensor(params["neighbor_coe"], dtype=torch.float32),
+        "joint_coe": torch.tensor(params["joint_coe"], dtype=torch.float32),
+    }
+    return lrs, coe_dict
+
+
+def load_target(path, gamma=2.2):
+    # Linear RGB target composited over white, HxWx3
+    target = Image.open(path)
+    target = (torch.from_numpy(np.array(target)).float() / 255.0) ** gamma
+    target = target[:, :, 3:4] * target[:, :, :3] + torch.ones(
+        target.shape[0], target.shape[1], 3, device=pydiffvg.get_device()
+    ) * (1 - target[:, :, 3:4])
+    return target[:, :, :3]
+
+
+def generate(
+    target_image,
+    results_path=RESULTS_PATH,
+    params_path=BEST_PARAMS_PATH,
+    overrides=None,
+    num_iterations=1000,
+    video=True,
+    init="random",
+    loss_threshold=None,
+    layout="grid",
+    tile_budget=None,
+    max_seconds=None,
+):
+    # Optimize a 10x10 grid of tiles towards the target image, or with
+    # layout="quadtree" an adaptive layout of tile_budget tiles. With init="mean"
+    # the tiles start from the target's mean color under them instead of random
+    # colors. The first iteration whose pixel loss is at most loss_threshold is
+    # reported as iterations_to_threshold. The optimization stops early once it
+    # has run for max_seconds.
+    if init not in INITS:
+        raise ValueError("Invalid init. Use 'random' or 'mean'.")
+    if layout not in LAYOUTS:
+        raise ValueError("Invalid layout. Use 'grid' or 'quadtree'.")
+    pkls_path = os.path.join(results_path, "pkls")
+
+    # Create folder for saving results
+    if not os.path.exists(pkls_path):
+        print("Creating folder for saving results...")
+        os.makedirs(pkls_path)
+
+    lrs, coe_dict = load_params(params_path, overrides)
+    delta_coe = coe_dict["delta_coe"]
+    displacement_coe = coe_dict["displacement_coe"]
+    angle_coe = coe_dict["angle_coe"]
+    overlap_coe = coe_dict["overlap_coe"]
+    neighbor_num = coe_dict["neighbor_num"]
+    neighbor_coe = coe_dict["neighbor_coe"]
+    joint_coe = coe_dict["joint_coe"]
+
+    gamma = 2.2
+    render = pydiffvg.RenderFunction.apply
+
+    # Load target image
+    target = load_target(target_image, gamma)
+    canvas_width, canvas_height = target.shape[1], target.shape[0]
+
+    # Initializations
+    stats = BlockStats(target)
+    block_width, block_height = canvas_width // 10, canvas_height // 10
+    cells = grid_layout(canvas_width, canvas_height, block_width, block_height)
+    if layout == "quadtree":
+        # As many tiles as the grid by default, split where the target varies most
+        cells = quadtree_layout(
+            canvas_width, canvas_height, tile_budget or len(cells), variance_cost(stats)
         )
-        shape_groups.append(rect_group)
-
-for rect in shapes:
-    rect.update()
-for rect_group in shape_groups:
-    rect_group.update()
-
-img = render_image(canvas_width, canvas_height, shapes, shape_groups, render, seed=1)
-pydiffvg.imwrite(img.cpu(), os.path.join(RESULTS_PATH, "init.png"), gamma=gamma)
-
-optimizer_delta = torch.optim.Adam([rect.delta for rect in shapes], lr=delta_lr)
-optimizer_angle = torch.optim.Adam(
-    [rect_group.angle for rect_group in shape_groups], lr=angle_lr
-)
-optimizer_translation = torch.optim.Adam(
-    [rect_group.translation for rect_group in shape_groups], lr=tranlation_lr
-)
-optimizer_color = torch.optim.Adam(
-    [rect_group.color for rect_group in shape_groups], lr=color_lr
-)
-
-num_interations = 1000
-scheduler_delta = StepLR(optimizer_delta, step_size=num_interations // 3, gamma=0.5)
-scheduler_angle = StepLR(optimizer_angle, step_size=num_interations // 3, gamma=0.5)
-scheduler_translation = StepLR(
-    optimizer_translation, step_size=num_interations // 3, gamma=0.5
-)
-scheduler_color = StepLR(optimizer_color, step_size=num_interations // 3, gamma=0.5)
-
-# Run optimization iterations.
-for t in range(num_interations):
-    print("iteration:", t)
-
-    optimizer_delta.zero_grad()
-    optimizer_angle.zero_grad()
-    optimizer_translation.zero_grad()
-    optimizer_color.zero_grad()
+    colors = None
+    if init == "mean":
+        # Both the target and the rendered colors are linear (gamma is only
+        # applied when writing images), so the block means are the colors to match
+        colors = stats.mean(cells).float()
+    shapes, shape_groups = make_tiles(cells, canvas_width, canvas_height, colors)
 
     for rect in shapes:
         rect.update()
@@ -154,111 +157,224 @@ for t in range(num_interations):
         rect_group.update()
 
     img = render_image(
-        canvas_width, canvas_height, shapes, shape_groups, render, seed=t + 1
+        canvas_width, canvas_height, shapes, shape_groups, render, seed=1
     )
+    pydiffvg.imwrite(img.cpu(), os.path.join(results_path, "init.png"), gamma=gamma)
 
-    # Save the intermediate render.
-    if t % 5 == 0:
-        pydiffvg.imwrite(
-            img.cpu(),
-            os.path.join(RESULTS_PATH, "iter_{}.png".format(t // 5)),
-            gamma=gamma,
+    optimizer_delta = torch.optim.Adam(
+        [rect.delta for rect in shapes], lr=lrs["delta_lr"]
+    )
+    optimizer_angle = torch.optim.Adam(
+        [rect_group.angle for rect_group in shape_groups], lr=lrs["angle_lr"]
+    )
+    optimizer_translation = torch.optim.Adam(
+        [rect_group.translation for rect_group in shape_groups],
+        lr=lrs["tranlation_lr"],
+    )
+    optimizer_color = torch.optim.Adam(
+        [rect_group.color for rect_group in shape_groups], lr=lrs["color_lr"]
+    )
+
+    step_size = max(num_iterations // 3, 1)
+    scheduler_delta = StepLR(optimizer_delta, step_size=step_size, gamma=0.5)
+    scheduler_angle = StepLR(optimizer_angle, step_size=step_size, gamma=0.5)
+    scheduler_translation = StepLR(
+        optimizer_translation, step_size=step_size, gamma=0.5
+    )
+    scheduler_color = StepLR(optimizer_color, step_size=step_size, gamma=0.5)
+
+    # Run optimization iterations.
+    iterations_to_threshold = None
+    iterations = 0
+    start = time.perf_counter()
+    for t in range(num_iterations):
+        if max_seconds is not None and time.perf_counter() - start > max_seconds:
+            print("Time budget reached after {} iterations.".format(t))
+            break
+        print("iteration:", t)
+
+        optimizer_delta.zero_grad()
+        optimizer_angle.zero_grad()
+        optimizer_translation.zero_grad()
+        optimizer_color.zero_grad()
+
+        for rect in shapes:
+            rect.update()
+        for rect_group in shape_groups:
+            rect_group.update()
+
+        img = render_image(
+            canvas_width, canvas_height, shapes, shape_groups, render, seed=t + 1
         )
 
-    # Pixel-wise loss.
-    img = img[:, :, 3:4] * img[:, :, :3] + torch.ones(
-        img.shape[0], img.shape[1], 3, device=pydiffvg.get_device()
-    ) * (1 - img[:, :, 3:4])
-    img = img[:, :, :3]
-    pixel_loss = torch.sum((img - target) ** 2) / (canvas_width * canvas_height)
-
-    img = img.unsqueeze(0)
-    img = img.permute(0, 3, 1, 2)  # NHWC -> NCHW
-
-    # Regularization term
-    diffvg_regularization_loss = torch.zeros(1, device=pydiffvg.get_device())
-    if (
-        torch.norm(delta_coe) > 0
-        or torch.norm(displacement_coe) > 0
-        or torch.norm(angle_coe) > 0
-    ):
-        diffvg_regularization_loss = diffvg_regularization_term(
-            shapes,
-            shape_groups,
-            coe_delta=delta_coe,
-            coe_displacement=displacement_coe,
-            coe_angle=angle_coe,
+        # Save the intermediate render.
+        if t % 5 == 0:
+            pydiffvg.imwrite(
+                img.cpu(),
+                os.path.join(results_path, "iter_{}.png".format(t // 5)),
+                gamma=gamma,
+            )
+
+        # Pixel-wise loss.
+        img = img[:, :, 3:4] * img[:, :, :3] + torch.ones(
+            img.shape[0], img.shape[1], 3, device=pydiffvg.get_device()
+        ) * (1 - img[:, :, 3:4])
+        img = img[:, :, :3]
+        pixel_loss = torch.sum((img - target) ** 2) / (canvas_width * canvas_height)
+        if (
+            loss_threshold is not None
+            and iterations_to_threshold is None
+            and pixel_loss.item() <= loss_threshold
+        ):
+            iterations_to_threshold = t
+            print("Pixel loss threshold reached at iteration:", t)
+
+        img = img.unsqueeze(0)
+        img = img.permute(0, 3, 1, 2)  # NHWC -> NCHW
+
+        # Regularization term
+        diffvg_regularization_loss = torch.zeros(1, device=pydiffvg.get_device())
+        if (
+            torch.norm(delta_coe) > 0
+            or torch.norm(displacement_coe) > 0
+            or torch.norm(angle_coe) > 0
+        ):
+            diffvg_regularization_loss = diffvg_regularization_term(
+                shapes,
+                shape_groups,
+                coe_delta=delta_coe,
+                coe_displacement=displacement_coe,
+                coe_angle=angle_coe,
+            )
+        pairwise_diffvg_regularization_loss = torch.zeros(
+            1, device=pydiffvg.get_device()
         )
-    pairwise_diffvg_regularization_loss = torch.zeros(1, device=pydiffvg.get_device())
-    if torch.norm(overlap_coe) > 0 or torch.norm(neighbor_coe) > 0:
-        pairwise_diffvg_regularization_loss = pairwise_diffvg_regularization_term(
-            shapes,
-            shape_groups,
-            coe_overlap=overlap_coe,
-            num_neighbor=neighbor_num,
-            coe_neighbor=neighbor_coe,
+        if torch.norm(overlap_coe) > 0 or torch.norm(neighbor_coe) > 0:
+            pairwise_diffvg_regularization_loss = pairwise_diffvg_regularization_term(
+                shapes,
+                shape_groups,
+                coe_overlap=overlap_coe,
+                num_neighbor=neighbor_num,
+                coe_neighbor=neighbor_coe,
+            )
+        joint_regularization_loss = torch.zeros(1, device=pydiffvg.get_device())
+        if torch.norm(joint_coe) > 0:
+            joint_regularization_loss = joint_regularization_term(
+                shapes,
+                shape_groups,
+                img,
+                num_neighbor=1,
+                coe_joint=joint_coe,
+                threshold="max",
+            )
+        loss = (
+            pixel_loss
+            + diffvg_regularization_loss
+            + pairwise_diffvg_regularization_loss
+            + joint_regularization_loss
         )
-    joint_regularization_loss = torch.zeros(1, device=pydiffvg.get_device())
-    if torch.norm(joint_coe) > 0:
-        joint_regularization_loss = joint_regularization_term(
-            shapes,
-            shape_groups,
-            img,
-            num_neighbor=1,
-            coe_joint=joint_coe,
-            threshold="max",
+
+        print("pixel_loss:", pixel_loss.item())
+        print("diffvg_regularization_loss:", diffvg_regularization_loss.item())
+        print(
+            "pairwise_diffvg_regularization_loss:",
+            pairwise_diffvg_regularization_loss.item(),
         )
-    loss = (
-        pixel_loss
-        + diffvg_regularization_loss
-        + pairwise_diffvg_regularization_loss
-        + joint_regularization_loss
+        print("joint_regularization_loss:", joint_regularization_loss.item())
+        print("loss:", loss.item())
+
+        # Backpropagate the gradients.
+        loss.backward(retain_graph=True)
+
+        # Take a gradient descent step.
+        optimizer_delta.step()
+        optimizer_angle.step()
+        optimizer_translation.step()
+        optimizer_color.step()
+
+        # Take a scheduler step in the learning rate.
+        scheduler_delta.step()
+        scheduler_angle.step()
+        scheduler_translation.step()
+        scheduler_color.step()
+        iterations += 1
+
+    # Render the final result.
+    img = render_image(
+        canvas_width, canvas_height, shapes, shape_groups, render, seed=102
     )
+    # Save the images and differences.
+    pydiffvg.imwrite(img.cpu(), os.path.join(results_path, "final.png"), gamma=gamma)
 
-    print("pixel_loss:", pixel_loss.item())
-    print("diffvg_regularization_loss:", diffvg_regularization_loss.item())
-    print(
-        "pairwise_diffvg_regularization_loss:",
-        pairwise_diffvg_regularization_loss.item(),
+    pickle.dump(shapes, open(os.path.join(pkls_path, "target_shapes.pkl"), "wb"))
+    pickle.dump(
+        shape_groups, open(os.path.join(pkls_path, "target_shape_groups.pkl"), "wb")
     )
-    print("joint_regularization_loss:", joint_regularization_loss.item())
-    print("loss:", loss.item())
-
-    # Backpropagate the gradients.
-    loss.backward(retain_graph=True)
-
-    # Take a gradient descent step.
-    optimizer_delta.step()
-    optimizer_angle.step()
-    optimizer_translation.step()
-    optimizer_color.step()
-
-    # Take a scheduler step in the learning rate.
-    scheduler_delta.step()
-    scheduler_angle.step()
-    scheduler_translation.step()
-    scheduler_color.step()
-
-# Render the final result.
-img = render_image(canvas_width, canvas_height, shapes, shape_groups, render, seed=102)
-# Save the images and differences.
-pydiffvg.imwrite(img.cpu(), os.path.join(RESULTS_PATH, "final.png"), gamma=gamma)
-
-pickle.dump(shapes, open(os.path.join(PKLS_PATH, "target_shapes.pkl"), "wb"))
-pickle.dump(
-    shape_groups, open(os.path.join(PKLS_PATH, "target_shape_groups.pkl"), "wb")
-)
 
-# Convert the intermediate renderings to a video.
-call(
-    [
-        "ffmpeg",
-        "-framerate",
-        "24",
-        "-i",
-        os.path.join(RESULTS_PATH, "iter_%d.png"),
-        "-vb",
-        "20M",
-        os.path.join(RESULTS_PATH, "out.mp4"),
-    ]
-)
+    # Convert the intermediate renderings to a video.
+    if video:
+        call(
+            [
+                "ffmpeg",
+                "-framerate",
+                "24",
+                "-i",
+                os.path.join(results_path, "iter_%d.png"),
+                "-vb",
+                "20M",
+                os.path.join(results_path, "out.mp4"),
+            ]
+        )
+
+    return {
+        "pixel_loss": pixel_loss.item(),
+        "loss": loss.item(),
+        "tiles": len(shapes),
+        "iterations_to_threshold": iterations_to_threshold,
+        "iterations": iterations,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--target_image", help="path to target image", default="inputs/target_exp1.png"
+    )
+    parser.add_argument(
+        "--init",
+        help="initial tile colors: random, or the target's mean color under each tile",
+        choices=INITS,
+        default="random",
+    )
+    parser.add_argument(
+        "--loss_threshold",
+        help="report the first iteration whose pixel loss is at most this",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--layout",
+        help="uniform grid, or quadtree split by the target's color variance",
+        choices=LAYOUTS,
+        default="grid",
+    )
+    parser.add_argument(
+        "--tile_budget",
+        help="number of quadtree tiles, defaults to the grid's",
+        type=int,
+        default=None,
+    )
+    args = parser.parse_args()
+
+    # Use GPU if available
+    pydiffvg.set_use_gpu(torch.cuda.is_available())
+
+    result = generate(
+        args.target_image,
+        init=args.init,
+        loss_threshold=args.loss_threshold,
+        layout=args.layout,
+        tile_budget=args.tile_budget,
+    )
+    if args.loss_threshold is not None:
+        print("Iterations to threshold:", result["iterations_to_threshold"])
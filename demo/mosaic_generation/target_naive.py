@@ -1,14 +1,28 @@
 import torch
-import numpy as np
 from PIL import Image
-import pydiffvg
 import os
+import time
 import argparse
+from block_stats import BlockStats
+from layout import quadtree_layout, variance_cost
+from target_best_params import load_target
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "--target_image", help="path to target image", default="inputs/target_exp1.png"
 )
+parser.add_argument(
+    "--grid_sizes",
+    help="evaluate an n x n grid of blocks for every n",
+    type=int,
+    nargs="+",
+    default=[10],
+)
+parser.add_argument(
+    "--quadtree",
+    help="also evaluate a quadtree layout with as many blocks as each grid",
+    action="store_true",
+)
 args = parser.parse_args()
 
 RESULTS_PATH = "../results/target/"
@@ -20,28 +34,35 @@ if not os.path.exists(RESULTS_PATH):
 
 gamma = 2.2
 
-target = Image.open(args.target_image)
-target = (torch.from_numpy(np.array(target)).float() / 255.0) ** gamma
-target = target[:, :, 3:4] * target[:, :, :3] + torch.ones(
-    target.shape[0], target.shape[1], 3, device=pydiffvg.get_device()
-) * (1 - target[:, :, 3:4])
-target = target[:, :, :3]
-
-discrete_target = torch.zeros(target.shape)
-canvas_width, canvas_height = target.shape[0], target.shape[1]
-
-for x in range(0, canvas_width, canvas_width // 10):
-    for y in range(0, canvas_height, canvas_height // 10):
-        discrete_target[
-            x : x + canvas_width // 10, y : y + canvas_height // 10, :
-        ] = torch.mean(
-            target[x : x + canvas_width // 10, y : y + canvas_height // 10, :],
-            dim=(0, 1),
-            keepdim=True,
-        )
+target = load_target(args.target_image, gamma)
 
-pixel_loss = torch.sum((discrete_target - target) ** 2) / (canvas_width * canvas_height)
-print("Pixel loss: {}".format(pixel_loss.item()))
-Image.fromarray((discrete_target ** (1 / gamma) * 255).byte().cpu().numpy()).save(
-    os.path.join(RESULTS_PATH, "discrete_target.png")
+# Every block mean comes from the summed-area tables of the target, so the whole
+# sweep is a handful of vectorized lookups
+start = time.perf_counter()
+stats = BlockStats(target)
+losses = stats.sweep(args.grid_sizes)
+print(
+    "Evaluated {} grid sizes in {:.2f} ms".format(
+        len(args.grid_sizes), (time.perf_counter() - start) * 1000
+    )
 )
+
+for n, pixel_loss in zip(args.grid_sizes, losses):
+    print("Pixel loss ({0}x{0} grid): {1}".format(n, pixel_loss))
+    if args.quadtree:
+        cells = quadtree_layout(
+            stats.width, stats.height, n * n, variance_cost(stats)
+        )
+        print(
+            "Pixel loss ({} block quadtree): {}".format(
+                len(cells), stats.pixel_loss(cells)
+            )
+        )
+
+    name = "discrete_target.png"
+    if len(args.grid_sizes) > 1:
+        name = "discrete_target_{}.png".format(n)
+    discrete_target = stats.fill(stats.grid(n, n))
+    Image.fromarray(
+        (discrete_target ** (1 / gamma) * 255).byte().cpu().numpy()
+    ).save(os.path.join(RESULTS_PATH, name))
@@ -2,6 +2,7 @@ import torch
 import torchvision.transforms as transforms
 import pydiffvg
 import sys
+from scorer import as_scorer
 
 TWO_PI = 2 * torch.pi
 
@@ -201,7 +202,7 @@ def cal_loss(
     image,
     shapes,
     shape_groups,
-    clip_model,
+    scorer,
     text_features,
     coe_dict,
     use_aug=True,
@@ -209,7 +210,11 @@ def cal_loss(
     use_neg=True,
     text_features_neg=None,
     verbose=True,
+    num_augs=4,
+    micro_batch=None,
 ):
+    # With micro_batch set, the augmented views go through the scorer micro_batch
+    # at a time, see micro_batched_clip_loss
     # Transform image for CLIP input
     image = image[:, :, 3:4] * image[:, :, :3] + torch.ones(
         image.shape[0], image.shape[1], 3, device=pydiffvg.get_device()
@@ -224,22 +229,32 @@ def cal_loss(
     NUM_AUGS = 1
     img_augs = [image]
     if use_aug:
-        NUM_AUGS = 4
+        NUM_AUGS = num_augs
         for n in range(NUM_AUGS - 1):
             img_augs.append(augment_trans(image))
     img_batch = torch.cat(img_augs)
-    image_features = clip_model.encode_image(img_batch)
-    for n in range(NUM_AUGS):
-        pos_clip_loss -= torch.cosine_similarity(
-            text_features, image_features[n : n + 1], dim=1
+    if micro_batch is not None:
+        pos_clip_loss, neg_clip_loss = micro_batched_clip_loss(
+            img_batch,
+            scorer,
+            text_features,
+            text_features_neg if use_neg else None,
+            coe_dict["neg_clip_coe"],
+            micro_batch,
         )
-        if use_neg:
-            neg_clip_loss += (
-                torch.cosine_similarity(
-                    text_features_neg, image_features[n : n + 1], dim=1
-                )
-                * coe_dict["neg_clip_coe"]
+    else:
+        image_features = as_scorer(scorer).encode_images(img_batch)
+        for n in range(NUM_AUGS):
+            pos_clip_loss -= torch.cosine_similarity(
+                text_features, image_features[n : n + 1], dim=1
             )
+            if use_neg:
+                neg_clip_loss += (
+                    torch.cosine_similarity(
+                        text_features_neg, image_features[n : n + 1], dim=1
+                    )
+                    * coe_dict["neg_clip_coe"]
+                )
 
     # Regularization term
     diffvg_regularization_loss = torch.zeros(1, device=pydiffvg.get_device())
@@ -311,20 +326,94 @@ def cal_loss(
     return loss, pos_clip_loss
 
 
+def micro_batched_clip_loss(
+    img_batch,
+    scorer,
+    text_features,
+    text_features_neg,
+    neg_clip_coe,
+    micro_batch,
+):
+    # Positive and negative CLIP losses of a batch of views, encoded micro_batch
+    # views at a time. If img_batch requires grad, the gradient of every micro-batch
+    # with respect to its views is taken right away, so that only one
+    # micro-batch of scorer activations is alive at a time, and accumulated into
+    # a surrogate term: its value is zero and its gradient with respect to
+    # img_batch is the accumulated one, so loss.backward() works as usual.
+    scorer = as_scorer(scorer)
+    views = img_batch.detach()
+    grad = torch.zeros_like(views)
+    pos_clip_loss = torch.zeros(1, device=views.device)
+    neg_clip_loss = torch.zeros(1, device=views.device)
+    for start in range(0, len(views), micro_batch):
+        chunk = views[start : start + micro_batch]
+        if img_batch.requires_grad:
+            chunk = chunk.clone().requires_grad_(True)
+        image_features = scorer.encode_images(chunk)
+        pos = -torch.cosine_similarity(text_features, image_features, dim=1).sum()
+        neg = torch.zeros((), device=views.device)
+        if text_features_neg is not None:
+            neg = (
+                torch.cosine_similarity(text_features_neg, image_features, dim=1).sum()
+                * neg_clip_coe
+            )
+        if img_batch.requires_grad:
+            (grad[start : start + micro_batch],) = torch.autograd.grad(pos + neg, chunk)
+        pos_clip_loss += pos.detach()
+        neg_clip_loss += neg.detach()
+    if img_batch.requires_grad:
+        pos_clip_loss = pos_clip_loss + torch.sum((img_batch - views) * grad)
+    return pos_clip_loss, neg_clip_loss
+
+
 # ----------------------- Post-processing -----------------------
 
 
+def rendered_clip_loss(
+    canvas_width,
+    canvas_height,
+    render,
+    shapes,
+    shape_groups,
+    scorer,
+    text_features,
+    coe_dict,
+    seed=1,
+):
+    # pos_clip_loss of the rendered shapes, as the post-processing steps rank them
+    img = render_image(
+        canvas_width, canvas_height, shapes, shape_groups, render, seed=seed
+    )
+    _, loss = cal_loss(
+        img,
+        shapes,
+        shape_groups,
+        scorer,
+        text_features,
+        coe_dict,
+        use_aug=False,
+        augment_trans=None,
+        use_neg=False,
+        text_features_neg=None,
+        verbose=False,
+    )
+    return loss
+
+
 def delete_rect_iter(
     canvas_width,
     canvas_height,
     render,
     shapes,
     shape_groups,
-    clip_model,
+    scorer,
     text_features,
     coe_dict,
     seed=0,
+    verify_scorer=None,
 ):
+    # scorer ranks the candidates; with verify_scorer set, the chosen deletion is
+    # only kept if verify_scorer confirms it
     # Early stop if the maximum margin is less than EPS
     EPS = 2e-4
 
@@ -335,7 +424,7 @@ def delete_rect_iter(
         img,
         shapes,
         shape_groups,
-        clip_model,
+        scorer,
         text_features,
         coe_dict,
         use_aug=False,
@@ -362,7 +451,7 @@ def delete_rect_iter(
             img,
             shapes,
             shape_groups,
-            clip_model,
+            scorer,
             text_features,
             coe_dict,
             use_aug=False,
@@ -383,10 +472,40 @@ def delete_rect_iter(
         shape_groups.insert(idx, rect_group)
 
     if idx_delete != -1:
-        shapes.pop(idx_delete)
-        shape_groups.pop(idx_delete)
+        if verify_scorer is not None:
+            # Re-check the choice of the ranking scorer in full precision
+            loss_before = rendered_clip_loss(
+                canvas_width,
+                canvas_height,
+                render,
+                shapes,
+                shape_groups,
+                verify_scorer,
+                text_features,
+                coe_dict,
+                seed=seed + 1,
+            )
+        rect = shapes.pop(idx_delete)
+        rect_group = shape_groups.pop(idx_delete)
         for i in range(idx_delete, len(shapes)):
             shape_groups[i].shape_ids -= 1
+        if verify_scorer is not None:
+            loss_after = rendered_clip_loss(
+                canvas_width,
+                canvas_height,
+                render,
+                shapes,
+                shape_groups,
+                verify_scorer,
+                text_features,
+                coe_dict,
+                seed=seed + 1,
+            )
+            if not loss_after < loss_before - EPS:
+                for i in range(idx_delete, len(shapes)):
+                    shape_groups[i].shape_ids += 1
+                shapes.insert(idx_delete, rect)
+                shape_groups.insert(idx_delete, rect_group)
 
     return loss_before, loss_after
 
@@ -397,11 +516,16 @@ def postprocess_delete_rect(
     render,
     shapes,
     shape_groups,
-    clip_model,
+    scorer,
     text_features,
     max_iter=sys.maxsize,
     verbose=True,
+    ranking_scorer=None,
+    verify=False,
 ):
+    # ranking_scorer (by default scorer) ranks the candidates, e.g. a
+    # QuantizedCLIPScorer; with verify=True every accepted step is re-checked
+    # with scorer
     assert len(shapes) == len(shape_groups)
     # We care only about pos_clip_loss when doing post-processing
     coe_dict = {
@@ -415,6 +539,8 @@ def postprocess_delete_rect(
         "neighbor_coe": torch.tensor(0.0, dtype=torch.float32),
         "joint_coe": torch.tensor(0.0, dtype=torch.float32),
     }
+    verify_scorer = scorer if verify and ranking_scorer is not None else None
+    ranking_scorer = ranking_scorer or scorer
 
     t = 0
     while len(shapes) > 0 and t < max_iter:
@@ -428,10 +554,11 @@ def postprocess_delete_rect(
                 render,
                 shapes,
                 shape_groups,
-                clip_model,
+                ranking_scorer,
                 text_features,
                 coe_dict,
                 seed=t,
+                verify_scorer=verify_scorer,
             )
         len_after = len(shapes)
         if len_after == len_before:
@@ -445,18 +572,49 @@ def postprocess_delete_rect(
         t += 1
 
 
+def scale_rect(rect, scale, inverse=False):
+    # Scale a PolygonRect about its upper left corner, or undo the scaling. Also
+    # scale raw_points and delta to keep consistency
+    if inverse:
+        rect.size /= scale
+    else:
+        rect.size *= scale
+    rect.raw_points = torch.tensor(
+        [
+            [rect.upper_left[0], rect.upper_left[1]],
+            [
+                rect.upper_left[0] + rect.size[0],
+                rect.upper_left[1],
+            ],
+            [
+                rect.upper_left[0] + rect.size[0],
+                rect.upper_left[1] + rect.size[1],
+            ],
+            [rect.upper_left[0], rect.upper_left[1] + rect.size[1]],
+        ]
+    )
+    if inverse:
+        rect.delta /= scale
+    else:
+        rect.delta *= scale
+    rect.update()
+
+
 def scale_rect_iter(
     canvas_width,
     canvas_height,
     render,
     shapes,
     shape_groups,
-    clip_model,
+    scorer,
     text_features,
     coe_dict,
     scale=2.0,
     seed=0,
+    verify_scorer=None,
 ):
+    # scorer ranks the candidates; with verify_scorer set, the chosen scaling is
+    # only kept if verify_scorer confirms it
     # Early stop if the maximum margin is less than EPS
     EPS = 2e-4
 
@@ -467,7 +625,7 @@ def scale_rect_iter(
         img,
         shapes,
         shape_groups,
-        clip_model,
+        scorer,
         text_features,
         coe_dict,
         use_aug=False,
@@ -480,24 +638,7 @@ def scale_rect_iter(
     loss_after = torch.zeros(1, device=pydiffvg.get_device())
     idx_scale = -1
     for idx, (rect, rect_group) in enumerate(zip(shapes, shape_groups)):
-        # Also scale raw_points and delta to keep consistency
-        rect.size *= scale
-        rect.raw_points = torch.tensor(
-            [
-                [rect.upper_left[0], rect.upper_left[1]],
-                [
-                    rect.upper_left[0] + rect.size[0],
-                    rect.upper_left[1],
-                ],
-                [
-                    rect.upper_left[0] + rect.size[0],
-                    rect.upper_left[1] + rect.size[1],
-                ],
-                [rect.upper_left[0], rect.upper_left[1] + rect.size[1]],
-            ]
-        )
-        rect.delta *= scale
-        rect.update()
+        scale_rect(rect, scale)
 
         img = render_image(
             canvas_width, canvas_height, shapes, shape_groups, render, seed=seed + 1
@@ -507,7 +648,7 @@ def scale_rect_iter(
             img,
             shapes,
             shape_groups,
-            clip_model,
+            scorer,
             text_features,
             coe_dict,
             use_aug=False,
@@ -522,45 +663,40 @@ def scale_rect_iter(
             idx_scale = idx
 
         # Recover original shapes and shape_groups
-        rect.size /= scale
-        rect.raw_points = torch.tensor(
-            [
-                [rect.upper_left[0], rect.upper_left[1]],
-                [
-                    rect.upper_left[0] + rect.size[0],
-                    rect.upper_left[1],
-                ],
-                [
-                    rect.upper_left[0] + rect.size[0],
-                    rect.upper_left[1] + rect.size[1],
-                ],
-                [rect.upper_left[0], rect.upper_left[1] + rect.size[1]],
-            ]
-        )
-        rect.delta /= scale
-        rect.update()
+        scale_rect(rect, scale, inverse=True)
 
     scaled = False
     if idx_scale != -1:
-        rect = shapes[idx_scale]
-        rect.size *= scale
-        rect.raw_points = torch.tensor(
-            [
-                [rect.upper_left[0], rect.upper_left[1]],
-                [
-                    rect.upper_left[0] + rect.size[0],
-                    rect.upper_left[1],
-                ],
-                [
-                    rect.upper_left[0] + rect.size[0],
-                    rect.upper_left[1] + rect.size[1],
-                ],
-                [rect.upper_left[0], rect.upper_left[1] + rect.size[1]],
-            ]
-        )
-        rect.delta *= scale
-        rect.update()
+        if verify_scorer is not None:
+            # Re-check the choice of the ranking scorer in full precision
+            loss_before = rendered_clip_loss(
+                canvas_width,
+                canvas_height,
+                render,
+                shapes,
+                shape_groups,
+                verify_scorer,
+                text_features,
+                coe_dict,
+                seed=seed + 1,
+            )
+        scale_rect(shapes[idx_scale], scale)
         scaled = True
+        if verify_scorer is not None:
+            loss_after = rendered_clip_loss(
+                canvas_width,
+                canvas_height,
+                render,
+                shapes,
+                shape_groups,
+                verify_scorer,
+                text_features,
+                coe_dict,
+                seed=seed + 1,
+            )
+            if not loss_after < loss_before - EPS:
+                scale_rect(shapes[idx_scale], scale, inverse=True)
+                scaled = False
 
     return loss_before, loss_after, scaled
 
@@ -571,12 +707,17 @@ def postprocess_scale_rect(
     render,
     shapes,
     shape_groups,
-    clip_model,
+    scorer,
     text_features,
     scale=1.2,
     max_iter=100,
     verbose=True,
+    ranking_scorer=None,
+    verify=False,
 ):
+    # ranking_scorer (by default scorer) ranks the candidates, e.g. a
+    # QuantizedCLIPScorer; with verify=True every accepted step is re-checked
+    # with scorer
     assert len(shapes) == len(shape_groups)
     # We care only about pos_clip_loss when doing post-processing
     coe_dict = {
@@ -590,6 +731,8 @@ def postprocess_scale_rect(
         "neighbor_coe": torch.tensor(0.0, dtype=torch.float32),
         "joint_coe": torch.tensor(0.0, dtype=torch.float32),
     }
+    verify_scorer = scorer if verify and ranking_scorer is not None else None
+    ranking_scorer = ranking_scorer or scorer
 
     for t in range(max_iter):
         print("Post-process(scale) iteration:", t)
@@ -601,11 +744,12 @@ def postprocess_scale_rect(
                 render,
                 shapes,
                 shape_groups,
-                clip_model,
+                ranking_scorer,
                 text_features,
                 coe_dict,
                 scale=scale,
                 seed=t,
+                verify_scorer=verify_scorer,
             )
         if not scaled:
             print("No more rectangles to be scaled. Early stop.")